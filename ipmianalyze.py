@@ -0,0 +1,644 @@
+import sys
+import os
+import gzip
+import json
+import time
+import datetime
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from ipmilogger import log_segments
+
+#
+# configuration
+#
+READ_SIZE = 4*1024*1024         # bytes parsed at once, about 25 times that in memory per worker
+SENSOR_WIDTH = 32               # longest sensor name of a sample line
+VALUE_WIDTH = 15                # longest value converted with the others
+WORKERS = min( 8, os.cpu_count() or 1 )
+STAMP_WIDTH = 19                # "%Y-%m-%d_%H:%M:%S"
+SEPARATOR = b" -- "
+VALUE_CHARS = b"0123456789.eE+-"
+ON_VALUES = [ "1", "on", "true", "start" ]
+OFF_VALUES = [ "0", "off", "false", "stop" ]
+EPOCH = datetime.datetime(1970,1,1)
+
+def _days_from_civil(y, m, d):
+    """
+    This function returns the days since 1970-01-01 of arrays of dates.
+    """
+
+    y = y - (m <= 2)
+    era = np.floor_divide(y, 400)
+    yoe = y - era*400
+    doy = (153*(m + np.where(m > 2, -3, 9)) + 2)//5 + d - 1
+    doe = yoe*365 + yoe//4 - yoe//100 + doy
+    return era*146097 + doe - 719468
+
+def to_datetime(seconds):
+    """
+    This function returns the ( naive, like the log ) datetime of seconds
+    returned by the analysis.
+    """
+
+    return EPOCH + datetime.timedelta(seconds=float(seconds))
+
+def to_seconds(dt):
+
+    return (dt - EPOCH).total_seconds()
+
+class IpmiLogData:
+    """
+    This class holds what parse_log() read from a log: the samples of each
+    sensor, the /log markers and the sensor descriptions of the header.
+
+    The log has one second timestamps, so the samples are kept per sensor as
+    one row per second: series[sensor] = ( seconds, mean, peak, count ) where
+    seconds are int64 seconds since 1970 ( of the log's local time ) and mean
+    and peak are the mean and largest value logged in that second.  Memory
+    grows with the length of the capture, not with the sample rate or the
+    size of the log.
+    """
+
+    def __init__(self):
+
+        self.series     = {}
+        self.markers    = []        # ( seconds, message ) in log order
+        self.sensors    = {}        # sensor -> description, from the SENSOR lines
+        self.lines      = 0
+        self.samples    = 0
+        self.bytes      = 0
+
+    def sensor_names(self):
+
+        return sorted( self.series.keys() )
+
+class _Accumulator:
+    """
+    This class gathers the per second rows of each sensor over the chunks of
+    a log and merges them at the end.
+    """
+
+    def __init__(self):
+
+        self.parts      = {}
+
+    def add(self, parts):
+
+        for name, part in parts:
+            self.parts.setdefault( name, [] ).append( part )
+
+    def series(self):
+
+        series = {}
+        for name, parts in self.parts.items():
+            ts, sums, peaks, counts = [ np.concatenate(c) for c in zip(*parts) ]
+            if len(parts) > 1:
+                # chunks may overlap by a second, or be out of order
+                order = np.argsort(ts, kind="stable")
+                ts, sums, peaks, counts = ts[order], sums[order], peaks[order], counts[order]
+                first = np.flatnonzero( np.r_[ True, ts[1:] != ts[:-1] ] )
+                if len(first) < len(ts):
+                    ts, sums = ts[first], np.add.reduceat(sums, first)
+                    peaks, counts = np.maximum.reduceat(peaks, first), np.add.reduceat(counts, first)
+            series[name] = ( ts, sums/counts, peaks, counts )
+        return series
+
+VALUE_CODES = np.zeros(256, dtype=np.uint8)    # 0 not in a value, 1 in a value, 2 a digit
+VALUE_CODES[ np.frombuffer(VALUE_CHARS + b" ", dtype=np.uint8) ] = 1
+VALUE_CODES[ np.frombuffer(b"0123456789", dtype=np.uint8) ] = 2
+SEPARATOR_WORD = np.uint64( int.from_bytes(SEPARATOR, "little") )
+STAMP_DIGITS = [ 0,1,2,3, 5,6, 8,9, 11,12, 14,15, 17,18 ]
+STAMP_WEIGHTS = np.zeros( (14, 6), dtype=np.int64 )
+for _field, _cols in enumerate( [ (0,1,2,3), (4,5), (6,7), (8,9), (10,11), (12,13) ] ):
+    for _i, _col in enumerate(_cols): STAMP_WEIGHTS[_col, _field] = 10**(len(_cols) - 1 - _i)
+WINDOW_PAD = 64
+
+def _aggregate(names, sid, ts, val):
+    """
+    This function returns the samples of a chunk as ( sensor, ( seconds,
+    sums, peaks, counts ) ) with one row per sensor and second.
+    """
+
+    if not len(ts):
+        return []
+    # one row per ( sensor, second ), counted into bins when the seconds are close together
+    t0, span = ts.min(), int(ts.max() - ts.min()) + 1
+    if span*len(names) <= 4*len(ts) + 1024:
+        key = sid*span + (ts - t0)
+        size = span*len(names)
+        counts = np.bincount(key, minlength=size)
+        sums = np.bincount(key, weights=val, minlength=size)
+        peaks = np.full(size, -np.inf)
+        np.maximum.at(peaks, key, val)
+        rows = np.flatnonzero(counts)
+        sids, ts = rows // span, rows % span + t0
+        counts, sums, peaks = counts[rows], sums[rows], peaks[rows]
+    else:
+        key = sid.astype(np.int64) << 40 | (ts - t0)
+        order = np.argsort(key, kind="stable")
+        key, ts, val, sid = key[order], ts[order], val[order], sid[order]
+        first = np.flatnonzero( np.r_[ True, key[1:] != key[:-1] ] )
+        sums = np.add.reduceat(val, first)
+        peaks = np.maximum.reduceat(val, first)
+        counts = np.diff( np.r_[ first, len(key) ] )
+        sids, ts = sid[first], ts[first]
+    bounds = np.flatnonzero( np.r_[ True, sids[1:] != sids[:-1], True ] )
+    return [ ( names[sids[a]], ( ts[a:b], sums[a:b], peaks[a:b], counts[a:b] ) ) for a, b in zip( bounds[:-1], bounds[1:] ) ]
+
+def _window(a, starts, width):
+    """
+    This function returns the 'width' bytes from each start, as rows ( a
+    must be padded by at least 'width' bytes. )
+    """
+
+    return np.lib.stride_tricks.sliding_window_view(a, width)[starts]
+
+def _names(names, lengths):
+    """
+    This function returns the distinct sensor names, of the given lengths
+    at the start of each row, and the index of each row's name in them.
+    The names are compared by a hash, and by value only if two of them
+    share a hash.
+    """
+
+    words = names.view(np.uint64).copy()
+    for i in range(words.shape[1]):
+        # the bytes past the name are cleared ( little endian: the high ones )
+        keep = np.clip(lengths - 8*i, 0, 8).astype(np.uint64)
+        words[:,i] &= np.where( keep == 8, np.uint64(0xffffffffffffffff), ( np.uint64(1) << (keep*np.uint64(8)) ) - np.uint64(1) )
+    h = np.zeros(len(words), dtype=np.uint64)
+    for i in range(words.shape[1]):
+        h = (h ^ words[:,i]) * np.uint64(0x100000001b3)
+    unique, first, inverse = np.unique(h, return_index=True, return_inverse=True)
+    if not ( words == words[first][inverse] ).all():
+        unique, first, inverse = np.unique(words.view("S%d" % SENSOR_WIDTH).ravel(), return_index=True, return_inverse=True)
+    return [ words[i].tobytes().rstrip(b"\0").decode(errors="replace") for i in first ], inverse.ravel()
+
+def _parse_chunk(chunk):
+    """
+    This function parses a chunk of whole lines.  Each line has the
+    timestamp and separator at fixed offsets, and a sample line
+    ( "stamp -- sensor : value" ) a short sensor and value after them, so
+    the lines are converted as rows of fixed width windows on the bytes;
+    only the other lines are handled one by one.  It returns a dict of
+    'lines', 'samples', 'parts' ( see _aggregate ), 'markers' and 'sensors'.
+    """
+
+    a = np.frombuffer(chunk + b" "*WINDOW_PAD, dtype=np.uint8)
+    ends = np.flatnonzero(a == 10)
+    starts = np.r_[ 0, ends[:-1] + 1 ]
+    result = { 'lines': len(ends), 'markers': [], 'sensors': {} }
+
+    # the timestamp and separator, converted once per distinct timestamp
+    whole = starts + STAMP_WIDTH + len(SEPARATOR) <= ends
+    starts, ends = starts[whole], ends[whole]
+    head = _window(a, starts, 24).view(np.uint64)
+    head[:,2] &= np.uint64(0x00ffffffffffffff)     # the first byte of the message
+    separated = head[:,2] >> np.uint64(24) == SEPARATOR_WORD
+    starts, ends, head = starts[separated], ends[separated], head[separated]
+    changed = np.r_[ True, ( head[1:] != head[:-1] ).any(1) ]
+    stamp = np.cumsum(changed) - 1
+    changed = np.flatnonzero(changed)
+    digits = head[changed].view(np.uint8)[:, STAMP_DIGITS] - np.uint8(48)
+    year, month, day, hour, minute, second = ( digits.astype(np.int64) @ STAMP_WEIGHTS ).T
+    stamps = _days_from_civil(year, month, day)*86400 + hour*3600 + minute*60 + second
+    ok = ( digits <= 9 ).all(1) & ( month >= 1 ) & ( month <= 12 ) & ( day >= 1 )
+    valid = ok[stamp]
+    starts, ends, ts = starts[valid], ends[valid], stamps[stamp][valid]
+    m = starts + STAMP_WIDTH + len(SEPARATOR)
+
+    # the first " : " splits the sensor, which has no spaces, from the value
+    win = _window(a, m, SENSOR_WIDTH + 3)
+    colon = (win[:, :-2] == 32) & (win[:, 1:-1] == 58) & (win[:, 2:] == 32)
+    k = colon.argmax(1)
+    vs = m + k + 3
+    sample = colon.any(1) & ( k > 0 ) & ( (win == 32).argmax(1) == k ) & ( vs < ends )
+
+    # the values, checked and blanked past their end, in one float conversion
+    vlen = ends - vs
+    long = sample & ( vlen > VALUE_WIDTH )
+    sample &= ~long
+    values = _window(a, vs[sample], VALUE_WIDTH + 1)
+    values[ np.arange(VALUE_WIDTH + 1) >= vlen[sample][:,None] ] = 32
+    code = VALUE_CODES[values]
+    checked = code.all(1) & ( code == 2 ).any(1)
+    sample[sample] = checked
+    values = values[checked]
+    val = np.fromstring(values.tobytes(), sep=" ")
+    if len(val) != len(values):
+        # a value such as "1-2" reads as two numbers: convert those lines one by one
+        val = np.array( [ _float(chunk[i:j]) for i, j in zip(vs[sample], ends[sample]) ] )
+
+    # the sensor names, padded to a fixed width
+    names, sid = _names( win[sample, :SENSOR_WIDTH], k[sample] )
+    ts_sample = ts[sample]
+
+    # values too long for the window
+    if long.any():
+        extra = [ ( chunk[ m[i]:m[i] + k[i] ].decode(errors="replace"), _float(chunk[ vs[i]:ends[i] ]), ts[i] ) for i in np.flatnonzero(long) ]
+        extra = [ x for x in extra if x[1] == x[1] ]
+        for name in sorted( set( x[0] for x in extra ) - set(names) ):
+            names.append(name)
+        index = dict( (name, i) for i, name in enumerate(names) )
+        sid = np.r_[ sid, np.array( [ index[x[0]] for x in extra ], dtype=sid.dtype ) ]
+        val = np.r_[ val, np.array( [ x[1] for x in extra ] ) ]
+        ts_sample = np.r_[ ts_sample, np.array( [ x[2] for x in extra ], dtype=ts.dtype ) ]
+
+    keep = ~np.isnan(val)
+    result['parts'] = _aggregate( names, sid[keep], ts_sample[keep], val[keep] )
+    result['samples'] = int(keep.sum())
+
+    # markers and headers
+    for i in np.flatnonzero( ~sample & ~long ):
+        message = chunk[ m[i]:ends[i] ].decode(errors="replace")
+        if message.startswith("SENSOR: "):
+            fields = message[8:].rsplit(" ", 2)
+            if len(fields) == 3:
+                name, record_id = fields[0], fields[1]
+                result['sensors'][record_id] = name
+                if ":" in name:
+                    result['sensors'][ "%s:%s" % (name.split(":",1)[0], record_id) ] = name
+        elif " = " in message:
+            result['markers'].append( ( int(ts[i]), message ) )
+    return result
+
+def _float(b):
+
+    try:
+        return float(b)
+    except ValueError:
+        return np.nan
+
+def _chunks(path, read_size, start=None, end=None):
+    """
+    This function yields the log at path ( all its segments if it was
+    rotated, compressed ones too, or only those overlapping the start and
+    end datetimes ) as chunks of about read_size bytes of whole lines.
+    """
+
+    for name in log_segments(path, start, end):
+        if not os.path.exists(name) and os.path.exists(name + ".gz"):
+            name += ".gz"   # compressed since the manifest was read
+        f = gzip.open(name,'rb') if name.endswith(".gz") else open(name, 'rb')
+        with f:
+            rest = b""
+            while True:
+                block = f.read(read_size)
+                if not block:
+                    break
+                block = rest + block
+                cut = block.rfind(b"\n") + 1
+                rest = block[cut:]
+                if cut: yield block[:cut]
+            if rest:
+                yield rest + b"\n"
+
+def parse_log(path, read_size=READ_SIZE, workers=WORKERS, start=None, end=None):
+    """
+    This function reads an ipmicap log read_size bytes at a time and returns
+    an IpmiLogData.  Given start or end datetimes, only the segments of a
+    rotated log that overlap them are read ( lines at the edges are kept ).  The chunks are parsed on 'workers' threads ( numpy
+    releases the GIL for most of the work ), with at most one chunk per
+    worker read ahead, so memory stays bounded by the chunks in flight.
+    """
+
+    data = IpmiLogData()
+    acc = _Accumulator()
+
+    def merge(result):
+        data.lines += result['lines']
+        data.samples += result['samples']
+        data.markers.extend( result['markers'] )
+        data.sensors.update( result['sensors'] )
+        acc.add( result['parts'] )
+
+    with ThreadPoolExecutor( max_workers=max(1, workers), thread_name_prefix="IpmiAnalyze" ) as pool:
+        pending = collections.deque()
+        for chunk in _chunks(path, read_size, start, end):
+            data.bytes += len(chunk)
+            pending.append( pool.submit( _parse_chunk, chunk ) )
+            if len(pending) > workers:
+                merge( pending.popleft().result() )
+        while pending:
+            merge( pending.popleft().result() )
+    data.series = acc.series()
+    return data
+
+def marker_intervals(markers, end=None):
+    """
+    This function pairs the /log markers into intervals, in log order:
+
+        start = name ... stop = name                    interval 'name'
+        start_session = id ... stop_session = id        interval 'session id'
+        stress = 1 ... stress = 0                       interval 'stress'
+
+    The last form applies to any key which only takes the values of
+    ON_VALUES and OFF_VALUES in the log, so cpu = 1 ... cpu = 0 is not an
+    interval if the log also has cpu = 2.  Each interval also gets the
+    labels, i.e. the latest value of every other key ( not an interval
+    itself ) logged before it started ( e.g. cpu = 12 ).  Intervals still
+    open at the end of the log end at 'end' and are flagged.  It returns a
+    list of dicts with 'name', 'start', 'end' ( in seconds, see
+    to_datetime ), 'labels' and 'open'.
+    """
+
+    items = []
+    for ts, message in markers:
+        for item in message.split(","):
+            if " = " in item:
+                key, value = [ x.strip() for x in item.split(" = ", 1) ]
+                items.append( ( ts, key, value ) )
+
+    # a key is switched on and off if it only takes those values ( cpu = 1 is a label )
+    values = {}
+    for ts, key, value in items:
+        values.setdefault( key, set() ).add( value.lower() )
+    toggles = set( k for k, v in values.items() if v <= set(ON_VALUES + OFF_VALUES) and v & set(OFF_VALUES) )
+
+    labels = {}
+    opened = {}
+    intervals = []
+    for ts, key, value in items:
+        if key in ( "start", "start_session" ):
+            name = value if key == "start" else "session %s" % value
+            opened[name] = { 'name': name, 'start': ts, 'labels': dict(labels) }
+        elif key in ( "stop", "stop_session" ):
+            name = value if key == "stop" else "session %s" % value
+            if name in opened:
+                intervals.append( dict( opened.pop(name), end=ts, open=False ) )
+        elif key in toggles and value.lower() in ON_VALUES:
+            opened.setdefault( key, { 'name': key, 'start': ts, 'labels': dict(labels) } )
+        elif key in toggles:
+            if key in opened:
+                intervals.append( dict( opened.pop(key), end=ts, open=False ) )
+        else:
+            labels[key] = value
+
+    for interval in opened.values():
+        last = interval['start'] if end is None else max(end, interval['start'])
+        intervals.append( dict( interval, end=last, open=True ) )
+    return sorted( intervals, key=lambda i: (i['start'], i['end']) )
+
+def interval_stats(data, intervals, sensors=None):
+    """
+    This function computes, for every interval and sensor, the energy ( the
+    trapezoid integral of the per second means, clamped to the interval ),
+    the mean power ( energy / duration ) and the peak ( the largest value
+    logged within the interval. )  Each sensor is handled for all the
+    intervals at once.  It returns the intervals with 'duration', 'sensors'
+    ( name -> { energy, mean, peak, samples } ) and 'energy', the total of
+    the sensors.
+    """
+
+    starts = np.array( [ i['start'] for i in intervals ], dtype=np.float64 )
+    ends = np.array( [ i['end'] for i in intervals ], dtype=np.float64 )
+    durations = ends - starts
+    results = [ dict( i, duration=float(d), sensors={}, energy=0.0 ) for i, d in zip(intervals, durations) ]
+    if not intervals:
+        return results
+
+    for name in ( sensors or data.sensor_names() ):
+        if name not in data.series:
+            continue
+        ts, mean, peak, count = data.series[name]
+        t = ts.astype(np.float64)
+        # cumulative energy at each second, and at the interval edges
+        cum = np.r_[ 0.0, np.cumsum( 0.5*(mean[1:] + mean[:-1])*np.diff(t) ) ]
+        energy = np.interp(ends, t, cum) - np.interp(starts, t, cum)
+
+        i0 = np.searchsorted(ts, starts, side="left")
+        i1 = np.searchsorted(ts, ends, side="right")
+        cum_count = np.r_[ 0, np.cumsum(count) ]
+        samples = cum_count[i1] - cum_count[i0]
+        cum_sum = np.r_[ 0.0, np.cumsum(mean*count) ]
+        sample_means = ( cum_sum[i1] - cum_sum[i0] ) / np.where( samples > 0, samples, 1 )
+        padded = np.r_[ peak, -np.inf ]
+        peaks = np.maximum.reduceat( padded, np.ravel( np.column_stack( (i0, i1) ) ) )[::2]
+        peaks = np.where( i1 > i0, peaks, np.nan )
+        # without a second to integrate over, the mean is that of the samples
+        means = np.where( durations > 0, energy/np.where(durations > 0, durations, 1), np.where( samples > 0, sample_means, np.nan ) )
+        for r, e, mu, pk, c in zip(results, energy, means, peaks, samples):
+            if c == 0 and e == 0.0:
+                continue
+            r['sensors'][name] = { 'energy': float(e), 'mean': float(mu), 'peak': float(pk), 'samples': int(c) }
+            r['energy'] += float(e)
+    return results
+
+def analyze(path, sensors=None, read_size=READ_SIZE, workers=WORKERS, start=None, end=None):
+    """
+    This function parses the log at path ( see parse_log for start and end )
+    and returns ( data, stats ) with the statistics of every marker interval.
+    """
+
+    data = parse_log(path, read_size, workers, start, end)
+    end = max( [ int(s[0][-1]) for s in data.series.values() ] + [ 0 ] ) or None
+    return data, interval_stats( data, marker_intervals(data.markers, end), sensors )
+
+def write_synthetic_log(path, megabytes, sensors=8, rate=10, stress_period=60, seed=0):
+    """
+    This function writes a log like one from ipmicap, of about the given
+    size: a header, SENSOR lines, 'sensors' sensors sampled 'rate' times a
+    second, and cpu = n, stress = 1 / stress = 0 markers every
+    'stress_period' seconds, with the power higher under stress.  It returns
+    the start, in seconds, and the power of each sensor under stress and idle.
+    """
+
+    rng = np.random.default_rng(seed)
+    t0 = to_seconds( datetime.datetime(2021,6,4,5,14,3) )
+    idle = 100.0 + 20.0*np.arange(sensors)
+    busy = idle + 150.0
+    with open(path, "w") as f:
+        f.write("IpmiLogger: %s\n" % path)
+        for s in range(sensors):
+            f.write("%s -- SENSOR: PSU%d Input Power %d %d\n" % (to_datetime(t0).strftime("%Y-%m-%d_%H:%M:%S"), s, 18 + s, 100 + s))
+        written, second = 0, 0
+        while written < megabytes*1024*1024:
+            stamp = to_datetime(t0 + second).strftime("%Y-%m-%d_%H:%M:%S")
+            phase = second % stress_period
+            lines = []
+            if phase == 0:
+                lines.append("%s -- cpu = %d" % (stamp, second // stress_period))
+                lines.append("%s -- stress = 1" % stamp)
+            elif phase == stress_period//2:
+                lines.append("%s -- stress = 0" % stamp)
+            power = busy if phase < stress_period//2 else idle
+            noise = rng.integers(-2, 3, size=(rate, sensors))
+            for r in range(rate):
+                for s in range(sensors):
+                    lines.append("%s -- %d : %.1f" % (stamp, 18 + s, power[s] + noise[r, s]))
+            block = "\n".join(lines) + "\n"
+            f.write(block)
+            written += len(block)
+            second += 1
+    return t0, busy, idle
+
+def _parse_naive(path):
+    """
+    This function parses a log line by line, as the notebook did.  It is
+    the reference for the tests and the baseline of the benchmark.
+    """
+
+    samples = {}
+    for line in open(path):
+        fields = line.rstrip("\n").split(" -- ", 1)
+        if len(fields) != 2 or " : " not in fields[1]:
+            continue
+        sensor, value = fields[1].split(" : ", 1)
+        dt = datetime.datetime.strptime(fields[0], "%Y-%m-%d_%H:%M:%S")
+        samples.setdefault(sensor, []).append( ( dt, float(value) ) )
+    return samples
+
+def print_stats(stats):
+
+    print("%-16s %-20s %-19s %9s %12s %10s %10s  %s" % ("interval", "labels", "start", "seconds", "energy_J", "mean_W", "peak_W", "sensors"))
+    for r in stats:
+        labels = ",".join( "%s=%s" % kv for kv in r['labels'].items() )
+        peak = max( [ s['peak'] for s in r['sensors'].values() ] + [ float("nan") ] )
+        mean = sum( s['mean'] for s in r['sensors'].values() )
+        print("%-16s %-20s %-19s %9.0f %12.1f %10.1f %10.1f  %d%s" % ( r['name'], labels[:20], to_datetime(r['start']).strftime("%Y-%m-%d_%H:%M:%S"),
+                r['duration'], r['energy'], mean, peak, len(r['sensors']), " (open)" if r['open'] else "" ))
+
+def benchmark(megabytes, read_size=READ_SIZE, workers=WORKERS, naive=True):
+    """
+    This function times parse_log() and analyze() on a synthetic log of the
+    given size, and the line by line parser for comparison.
+    """
+
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "synthetic.log")
+        write_synthetic_log(path, megabytes)
+        size = os.path.getsize(path)
+
+        start = time.perf_counter()
+        data, stats = analyze(path, read_size=read_size, workers=workers)
+        elapsed = time.perf_counter() - start
+        print("%s: analyzed %.0f MB ( %d lines, %d samples, %d intervals ) in %.2f s, %.0f MB/s" % \
+                ( sys.argv[0], size/1e6, data.lines, data.samples, len(stats), elapsed, size/1e6/elapsed ))
+        result = { 'bytes': size, 'lines': data.lines, 'seconds': elapsed, 'mb_per_s': size/1e6/elapsed }
+        if naive:
+            start = time.perf_counter()
+            _parse_naive(path)
+            baseline = time.perf_counter() - start
+            print("%s: parsed line by line in %.2f s, %.0f MB/s ( %.1fx slower )" % (sys.argv[0], baseline, size/1e6/baseline, baseline/elapsed))
+            result['line_by_line_seconds'] = baseline
+    return result
+
+#
+# To run the unit tests below, type "python ipmianalyze.py" ( with no log. )
+# "python ipmianalyze.py --benchmark 500" times it on a synthetic 500 MB log.
+#
+if __name__ == "__main__":
+
+    import argparse
+    parser  = argparse.ArgumentParser(description='Marker interval energy, mean and peak power from ipmicap logs.')
+    parser.add_argument('logs',         nargs='*', help='The log files ( the path given to --log, rotated segments are found from it )')
+    parser.add_argument('--sensors',    dest='sensors', nargs='+', default=None, help='The sensors to report (default: all)')
+    parser.add_argument('--start',      dest='start', type=datetime.datetime.fromisoformat, default=None, help='Only read the segments of a rotated log after this ISO 8601 time')
+    parser.add_argument('--end',        dest='end', type=datetime.datetime.fromisoformat, default=None, help='Only read the segments of a rotated log before this ISO 8601 time')
+    parser.add_argument('--json',       dest='json', default=None, help='Also write the intervals to this JSON file')
+    parser.add_argument('--read-size',  dest='read_size', type=int, default=READ_SIZE, help='Bytes parsed at once')
+    parser.add_argument('--workers',    dest='workers', type=int, default=WORKERS, help='The number of threads parsing chunks')
+    parser.add_argument('--benchmark',  dest='benchmark', type=float, default=None, help='Time the analysis of a synthetic log of this many MB')
+    args    = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.read_size, args.workers)
+        sys.exit(0)
+
+    if args.logs:
+        results = []
+        for path in args.logs:
+            data, stats = analyze(path, args.sensors, args.read_size, args.workers, args.start, args.end)
+            print("%s: %s: %d samples of %d sensors, %d intervals" % (sys.argv[0], path, data.samples, len(data.series), len(stats)))
+            print_stats(stats)
+            results.append( { 'log': path, 'sensors': data.sensors, 'intervals': stats } )
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+        sys.exit(0)
+
+    import tempfile
+    from ipmilogger import IpmiLogger
+
+    # a log written by IpmiLogger, rotated and compressed, with markers
+    path = os.path.join( tempfile.mkdtemp(), "capture" )
+    logger = IpmiLogger( path=path, buffered=True, flush_interval=0.05, rotate_size=20000, compress=True )
+    t0 = datetime.datetime(2021,6,4,5,14,3)
+    logger.log("SENSOR: PSU1 Input Power 18 160", date=t0)
+    logger.log("SENSOR: node01:PSU2 Input Power 19 161", date=t0)
+    logger.log("cpu = 1", date=t0)
+    for i in range(600):
+        dt = t0 + datetime.timedelta(seconds=i//4)
+        if i == 40: logger.log("stress = 1", date=dt)
+        if i == 200: logger.log("stress = 0", date=dt)
+        if i == 240: logger.log("start = build,index = ivf", date=dt)
+        if i == 280: logger.log("start_session = abc", date=dt)
+        if i == 400: logger.log("stop = build", date=dt)
+        if i == 440: logger.log("stop_session = abc", date=dt)
+        power = 300.0 if 40 <= i < 200 else 100.0
+        logger.log("18 : %f" % power, date=dt, sensor="18")
+        logger.log("node01:19 : %f" % (power/2), date=dt, sensor="node01:19")
+        logger.log("nvidia-0 : 1e1", date=dt, sensor="nvidia-0")
+        if i == 500: logger.log("not a sample : x", date=dt)
+    logger.log("stress = 1", date=t0 + datetime.timedelta(seconds=149))
+    logger.close()
+
+    for read_size, workers in ( ( 997, 1 ), ( 997, 4 ), ( READ_SIZE, WORKERS ) ):
+        data, stats = analyze(path, read_size=read_size, workers=workers)
+        assert sorted(data.series.keys()) == [ "18", "node01:19", "nvidia-0" ], data.series.keys()
+        assert data.samples == 1800 and data.sensors["18"] == "PSU1 Input Power" and "node01:19" in data.sensors
+        ts, mean, peak, count = data.series["18"]
+        assert len(ts) == 150 and (count == 4).all() and mean[10] == 300.0 and mean[50] == 100.0
+        assert [ (s['name'], s['labels'], s['open']) for s in stats ] == [ ( "stress", { "cpu": "1" }, False ),
+                ( "build", { "cpu": "1" }, False ), ( "session abc", { "cpu": "1", "index": "ivf" }, False ),
+                ( "stress", { "cpu": "1", "index": "ivf" }, True ) ], stats
+        stress = stats[0]
+        assert stress['duration'] == 40 and stress['sensors']['18']['peak'] == 300.0 and stress['sensors']['18']['samples'] == 164
+        # 39 s at 300 W and the last second ramping down to 100 W
+        assert abs(stress['sensors']['18']['energy'] - (39*300 + 200)) < 1e-9, stress['sensors']['18']
+        assert abs(stress['sensors']['node01:19']['energy'] - (39*300 + 200)/2) < 1e-9
+        assert abs(stress['energy'] - (39*300 + 200)*1.5 - 400) < 1e-9
+        assert stats[1]['duration'] == 40 and abs(stats[1]['sensors']['18']['mean'] - 100.0) < 1e-9
+        assert stats[3]['start'] == stats[3]['end'] and stats[3]['sensors']['18']['mean'] == 100.0
+
+    # a window reads only the segments overlapping it
+    data = parse_log(path, start=t0 + datetime.timedelta(seconds=100), end=t0 + datetime.timedelta(seconds=110))
+    ts = data.series["18"][0]
+    assert 0 < len(ts) < 150 and ts[0] <= to_seconds(t0) + 100 and ts[-1] >= to_seconds(t0) + 110, ( len(ts), ts[0], ts[-1] )
+
+    # an interval without a second to integrate over takes the mean of its samples
+    path = os.path.join( tempfile.mkdtemp(), "capture" )
+    logger = IpmiLogger( path=path )
+    t1 = datetime.datetime(2021,6,5,0,0,0)
+    logger.log("18 : 200.0", date=t1 - datetime.timedelta(seconds=1))
+    logger.log("start = spike", date=t1)
+    for power in ( 100.0, 300.0, 300.0 ):
+        logger.log("18 : %f" % power, date=t1)
+    logger.log("stop = spike", date=t1)
+    logger.close()
+    data, stats = analyze(path)
+    assert stats[0]['duration'] == 0 and stats[0]['sensors']['18'] == { 'energy': 0.0, 'mean': 700.0/3, 'peak': 300.0, 'samples': 3 }, stats
+
+    # the same values as the line by line parser
+    plain = tempfile.mkstemp()[1]
+    t0, busy, idle = write_synthetic_log(plain, 2, sensors=3, rate=7)
+    data, stats = analyze(plain, read_size=100000)
+    naive = _parse_naive(plain)
+    for sensor, samples in naive.items():
+        seconds = np.array( [ to_seconds(dt) for dt, v in samples ] )
+        values = np.array( [ v for dt, v in samples ] )
+        ts, mean, peak, count = data.series[sensor]
+        assert (np.unique(seconds) == ts).all() and count.sum() == len(values)
+        assert np.allclose( mean, np.bincount( np.searchsorted(ts, seconds), values ) / count )
+    full = [ s for s in stats if s['name'] == "stress" and not s['open'] ]
+    assert len(full) > 10 and [ s['labels']['cpu'] for s in full[:3] ] == [ "0", "1", "2" ]
+    for s in full:
+        for k in range(3):
+            assert abs( s['sensors'][str(18 + k)]['mean'] - busy[k] ) < 5.0, s
+    os.unlink(plain)
+
+    benchmark(10)
+    print("%s: all tests passed" % sys.argv[0])
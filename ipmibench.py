@@ -0,0 +1,168 @@
+import sys
+import os
+import time
+import json
+import shutil
+import resource
+import subprocess
+import numpy as np
+
+from ipmimon import IpmiMon
+
+class IpmiBench:
+    """
+    This class measures the end-to-end sampling rate of IpmiMon against a
+    simulated BMC ( see ipmisim.py ) running in its own process, so that the
+    CPU use reported is that of the sampler alone.  For each transport, record
+    count and concurrency it reports samples/s, per-read latency percentiles,
+    the mean sweep time and the CPU use of the sampler ( including any
+    ipmitool child processes. )
+    """
+
+    def __init__(self,  latency=0.002,
+                        jitter=0.001,
+                        error_rate=0.0,
+                        bmc_parallel=8,
+                        duration=5.0,
+                        debug=False):
+
+        self.latency    = latency
+        self.jitter     = jitter
+        self.error_rate = error_rate
+        self.bmc_parallel = bmc_parallel
+        self.duration   = duration
+        self.debug      = debug
+        self.process    = None
+        self.port       = None
+
+    def start_bmc(self, records):
+        """
+        This function starts the simulated BMC and waits until it is listening.
+        """
+
+        cmd = [ sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "ipmisim.py"),
+                "--port", "0", "--records", str(records),
+                "--latency", str(self.latency), "--jitter", str(self.jitter),
+                "--error-rate", str(self.error_rate), "--parallel", str(self.bmc_parallel) ]
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+        line = self.process.stdout.readline()
+        self.port = int(line.strip().split(":")[-1])
+        return self.port
+
+    def stop_bmc(self):
+
+        if self.process:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+    def run(self, transport, records, concurrency):
+        """
+        This function samples all records continuously for the configured
+        duration and returns the measurements.
+        """
+
+        class Counter:
+            def __init__(self): self.count = 0
+            def sensor(self, dt, sensor_id, value): self.count += 1
+
+        counter = Counter()
+        mon = IpmiMon(  ip              = "127.0.0.1",
+                        port            = self.port,
+                        iface           = "lan",
+                        transport       = transport,
+                        username        = "admin",
+                        password        = "admin",
+                        records         = list(range(1, records+1)),
+                        session_manager = counter,
+                        max_consec_errors = 1<<30,
+                        concurrency     = concurrency,
+                        debug           = self.debug )
+        mon.connect()
+        mon.get_sensors()
+
+        latencies = []
+        failures = []       # appended to from the pool threads
+        read_sensor = mon._read_sensor
+        def timed_read_sensor(s, connection):
+            start = time.perf_counter()
+            reading = read_sensor(s, connection)
+            latencies.append( time.perf_counter() - start )
+            if reading == False: failures.append( s.id )
+            return reading
+        mon._read_sensor = timed_read_sensor
+
+        sweeps = []
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        while time.perf_counter() - start < self.duration:
+            mon._sample_sensors()
+            sweeps.append( mon.last_sweep_time )
+        elapsed = time.perf_counter() - start
+        cpu = resource.getrusage(resource.RUSAGE_SELF).ru_utime - usage.ru_utime \
+            + resource.getrusage(resource.RUSAGE_SELF).ru_stime - usage.ru_stime \
+            + resource.getrusage(resource.RUSAGE_CHILDREN).ru_utime - child_usage.ru_utime \
+            + resource.getrusage(resource.RUSAGE_CHILDREN).ru_stime - child_usage.ru_stime
+
+        mon.disconnect()
+
+        p50, p90, p99 = np.percentile( np.array(latencies)*1000, [50, 90, 99] )
+        return {    'transport'     : transport,
+                    'records'       : records,
+                    'concurrency'   : concurrency,
+                    'samples_per_s' : counter.count / elapsed,
+                    'errors'        : len(failures),
+                    'p50_ms'        : p50,
+                    'p90_ms'        : p90,
+                    'p99_ms'        : p99,
+                    'sweep_ms'      : 1000*float(np.mean(sweeps)),
+                    'cpu_percent'   : 100*cpu/elapsed }
+
+#
+# To run the benchmark, type "python ipmibench.py --transports rmcp --records 1 10 20 --concurrency 1 4"
+#
+if __name__ == "__main__":
+
+    import argparse
+    parser  = argparse.ArgumentParser(description='IPMI sampling rate benchmark against a simulated BMC.')
+    parser.add_argument('--transports', dest='transports', nargs='+', default=None, help='The transports to measure (default: rmcp, and ipmitool when installed)')
+    parser.add_argument('--records',    dest='records', type=int, nargs='+', default=[1, 10, 20], help='The record counts to measure')
+    parser.add_argument('--concurrency',dest='concurrency', type=int, nargs='+', default=[1, 4], help='The read concurrency levels to measure')
+    parser.add_argument('--duration',   dest='duration', type=float, default=5.0, help='Seconds to sample for each combination')
+    parser.add_argument('--latency',    dest='latency', type=float, default=0.002, help='Simulated BMC latency in seconds')
+    parser.add_argument('--jitter',     dest='jitter', type=float, default=0.001, help='Simulated BMC latency jitter in seconds')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0.0, help='Fraction of simulated sensor reads that fail')
+    parser.add_argument('--bmc-parallel', dest='bmc_parallel', type=int, default=8, help='The number of requests the simulated BMC works on at once')
+    parser.add_argument('--json',       dest='json', default=None, help='Also write the results to this JSON file')
+    parser.add_argument('--debug',      dest='debug', action='store_true', help='Verbose debug mode')
+    args    = parser.parse_args()
+
+    transports = args.transports
+    if not transports:
+        transports = [ "rmcp" ] + ( [ "ipmitool" ] if shutil.which("ipmitool") else [] )
+
+    bench = IpmiBench(  latency     = args.latency,
+                        jitter      = args.jitter,
+                        error_rate  = args.error_rate,
+                        bmc_parallel= args.bmc_parallel,
+                        duration    = args.duration,
+                        debug       = args.debug )
+
+    print("%-9s %7s %5s %10s %8s %8s %8s %9s %6s %6s" % ("transport", "records", "conc", "samples/s", "p50_ms", "p90_ms", "p99_ms", "sweep_ms", "cpu%", "errors"))
+    results = []
+    for records in args.records:
+        bench.start_bmc(records)
+        try:
+            for transport in transports:
+                for concurrency in args.concurrency:
+                    r = bench.run(transport, records, concurrency)
+                    results.append(r)
+                    print("%-9s %7d %5d %10.1f %8.2f %8.2f %8.2f %9.2f %6.1f %6d" % ( r['transport'], r['records'], r['concurrency'],
+                            r['samples_per_s'], r['p50_ms'], r['p90_ms'], r['p99_ms'], r['sweep_ms'], r['cpu_percent'], r['errors'] ), flush=True)
+        finally:
+            bench.stop_bmc()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
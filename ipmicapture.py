@@ -0,0 +1,286 @@
+import sys
+import os
+import json
+import time
+import atexit
+import threading
+import numpy as np
+from ipmistore import datetime_to_ns, to_ns
+
+#
+# configuration
+#
+CAPTURE_MAGIC   = b"IPMICAP1"
+HEADER_SIZE     = 64
+BLOCK_SIZE      = 1024      # records per time index entry
+SAMPLE_DTYPE    = np.dtype( [ ('ts','<i8'), ('sensor','<u4'), ('value','<f8') ] )   # 20 bytes, packed
+INDEX_DTYPE     = np.dtype( [ ('min_ts','<i8'), ('max_ts','<i8') ] )
+SAMPLES_FILE    = "samples.bin"
+INDEX_FILE      = "index.bin"
+SENSORS_FILE    = "sensors.json"
+EVENTS_FILE     = "events.jsonl"
+
+class IpmiCaptureWriter:
+    """
+    This class writes a capture directory next to the text log:
+
+        samples.bin     a 64 byte header then fixed width sample records
+                        ( int64 ns timestamp, uint32 sensor index, float64 value )
+        index.bin       the min and max timestamp of each block of BLOCK_SIZE
+                        records, so a reader can seek straight to a time range
+        sensors.json    the sensor name of each sensor index
+        events.jsonl    the markers ( /log messages, session start and stop )
+                        as one JSON object per line
+
+    Samples may arrive slightly out of time order ( several sources, several
+    threads ), which is why the index keeps both ends of each block.  The
+    records of the block being filled are kept in memory and written by
+    flush(), which is called every flush_count samples, every flush_interval
+    seconds and on close().
+    """
+
+    def __init__(self, path, flush_count=256, flush_interval=1.0, debug=False):
+
+        self.path       = path
+        self.flush_count = flush_count
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.debug      = debug
+        self.lock       = threading.Lock()
+        self.sensor_ids = {}
+        self.block      = np.empty( BLOCK_SIZE, dtype=SAMPLE_DTYPE )
+        self.count      = 0     # records in the current block
+        self.written    = 0     # records of the current block already in the file
+        self.closed     = False
+
+        os.makedirs(path, exist_ok=True)
+        for name in ( SAMPLES_FILE, INDEX_FILE, SENSORS_FILE, EVENTS_FILE ):
+            if os.path.exists( os.path.join(path, name) ):
+                raise Exception("ERR: Capture '%s' already exists." % path)
+
+        header = CAPTURE_MAGIC + np.array( [ 1, SAMPLE_DTYPE.itemsize, BLOCK_SIZE ], dtype='<u4' ).tobytes()
+        self.samples = open( os.path.join(path, SAMPLES_FILE), "wb" )
+        self.samples.write( header.ljust(HEADER_SIZE, b"\0") )
+        self.samples.flush()
+        self.index = open( os.path.join(path, INDEX_FILE), "wb" )
+        self.events = open( os.path.join(path, EVENTS_FILE), "a" )
+        self._write_sensors()
+        atexit.register(self.close)
+
+    def sample(self, ts, sensor, value):
+        """
+        This function adds one sample of the named sensor.
+        """
+
+        with self.lock:
+            if self.closed:
+                return
+            index = self.sensor_ids.get(sensor)
+            if index is None:
+                index = self.sensor_ids[sensor] = len(self.sensor_ids)
+                self._write_sensors()
+            self.block[self.count] = ( to_ns(ts), index, value )
+            self.count += 1
+            if self.count == BLOCK_SIZE or self.count - self.written >= self.flush_count \
+                    or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def event(self, ts, message):
+        """
+        This function adds one marker to the event stream.
+        """
+
+        with self.lock:
+            if self.closed:
+                return
+            self.events.write( json.dumps( { "ts": to_ns(ts), "message": message } ) + "\n" )
+            self.events.flush()
+
+    def event_batch(self, entries):
+        """
+        This function adds a list of (ts, message) markers with one write.
+        """
+
+        with self.lock:
+            if self.closed:
+                return
+            self.events.write( "".join( json.dumps( { "ts": to_ns(ts), "message": message } ) + "\n" for ts, message in entries ) )
+            self.events.flush()
+
+    def flush(self):
+
+        with self.lock:
+            if not self.closed:
+                self._flush()
+
+    def close(self):
+
+        with self.lock:
+            if self.closed:
+                return
+            self._flush()
+            self.samples.close()
+            self.index.close()
+            self.events.close()
+            self.closed = True
+
+    def _flush(self):
+
+        if self.count > self.written:
+            self.samples.write( self.block[self.written:self.count].tobytes() )
+            self.written = self.count
+        if self.count == BLOCK_SIZE:
+            ts = self.block['ts']
+            self.index.write( np.array( [ (ts.min(), ts.max()) ], dtype=INDEX_DTYPE ).tobytes() )
+            self.count = 0
+            self.written = 0
+        self.samples.flush()
+        self.index.flush()
+        self.last_flush = time.monotonic()
+
+    def _write_sensors(self):
+
+        names = [ None ] * len(self.sensor_ids)
+        for name, index in self.sensor_ids.items():
+            names[index] = name
+        tmp = os.path.join(self.path, SENSORS_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump( names, f )
+        os.replace( tmp, os.path.join(self.path, SENSORS_FILE) )
+
+class IpmiCaptureReader:
+    """
+    This class reads a capture directory.  The sample records are memory
+    mapped into a NumPy structured array ( fields 'ts', 'sensor', 'value' ),
+    so opening a capture of any size reads only its header, index and
+    sensor table.  A capture that is still being written can be read; only
+    the records written so far are seen.
+    """
+
+    def __init__(self, path):
+
+        self.path       = path
+        with open( os.path.join(path, SAMPLES_FILE), "rb" ) as f:
+            header = f.read(HEADER_SIZE)
+        if header[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            raise Exception("ERR: '%s' is not a capture." % path)
+        version, itemsize, self.block_size = np.frombuffer( header[8:20], dtype='<u4' )
+        if itemsize != SAMPLE_DTYPE.itemsize:
+            raise Exception("ERR: Unsupported capture record size %d in '%s'." % (itemsize, path))
+
+        size = os.path.getsize( os.path.join(path, SAMPLES_FILE) ) - HEADER_SIZE
+        count = size // SAMPLE_DTYPE.itemsize
+        if count:
+            self.records = np.memmap( os.path.join(path, SAMPLES_FILE), dtype=SAMPLE_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,) )
+        else:
+            self.records = np.empty( 0, dtype=SAMPLE_DTYPE )
+        index = np.fromfile( os.path.join(path, INDEX_FILE), dtype=INDEX_DTYPE )
+        self.index = index[ : count // self.block_size ]
+        with open( os.path.join(path, SENSORS_FILE) ) as f:
+            self.sensors = json.load(f)
+
+    def __len__(self):
+        return len(self.records)
+
+    def sensor_index(self, sensor):
+        """
+        This function returns the index of a sensor name ( e.g. "18",
+        "nvidia-0" or "node01:18" ) in the 'sensor' field of the records.
+        """
+
+        return self.sensors.index( str(sensor) )
+
+    def window(self, t0, t1):
+        """
+        This function returns the records of the blocks which may hold samples
+        taken in [t0, t1] ( ns ), as a view of the mapped file.  Records
+        outside the range at either end are not removed; see samples().
+        """
+
+        hits = np.nonzero( (self.index['max_ts'] >= t0) & (self.index['min_ts'] <= t1) )[0]
+        first = hits[0]*self.block_size if len(hits) else len(self.index)*self.block_size
+        last = (hits[-1]+1)*self.block_size if len(hits) else first
+        # the records after the last full block are not indexed, so check them directly
+        tail = len(self.index)*self.block_size
+        ts = self.records['ts'][tail:]
+        if len(ts) and ts.max() >= t0 and ts.min() <= t1:
+            last = len(self.records)
+            if not len(hits): first = tail
+        return self.records[first:last]
+
+    def samples(self, t0=None, t1=None, sensor=None):
+        """
+        This function returns the timestamps and values of the samples taken
+        in [t0, t1], optionally of one sensor, in time order.
+        """
+
+        t0 = np.iinfo(np.int64).min if t0 is None else t0
+        t1 = np.iinfo(np.int64).max if t1 is None else t1
+        records = self.window(t0, t1)
+        mask = (records['ts'] >= t0) & (records['ts'] <= t1)
+        if sensor is not None:
+            mask &= records['sensor'] == self.sensor_index(sensor)
+        selected = records[mask]
+        order = np.argsort( selected['ts'], kind='stable' )
+        return selected['ts'][order], selected['value'][order]
+
+    def events(self, t0=None, t1=None):
+        """
+        This function returns the (ns timestamp, message) markers taken in [t0, t1].
+        """
+
+        events = []
+        with open( os.path.join(self.path, EVENTS_FILE) ) as f:
+            for line in f:
+                if not line.strip(): continue
+                e = json.loads(line)
+                if (t0 is None or e["ts"] >= t0) and (t1 is None or e["ts"] <= t1):
+                    events.append( (e["ts"], e["message"]) )
+        return events
+
+#
+# To run the unit tests below, type "python ipmicapture.py"
+#
+if __name__ == "__main__":
+
+    import datetime
+    import tempfile
+
+    t0 = datetime.datetime(2021,6,2,22,0,0)
+    sec = lambda s: t0 + datetime.timedelta(seconds=s)
+    ns = lambda s: datetime_to_ns(sec(s))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "capture.cap")
+        writer = IpmiCaptureWriter(path, flush_interval=3600)
+        writer.event( sec(0), "start_session = a" )
+        n = 3*BLOCK_SIZE + 100
+        for i in range(n):
+            # two sensors, with the second one's samples arriving a little late
+            writer.sample( sec(i*0.01), "18", 100.0 + i )
+            if i % 2: writer.sample( sec(i*0.01 - 0.005), "nvidia-0", 50.0 )
+        writer.event_batch( [ ( sec(n*0.01), "stop_session = a" ) ] )
+
+        # readable while open, up to the last flush
+        reader = IpmiCaptureReader(path)
+        assert len(reader) % 256 == 0 and len(reader) > 0
+        writer.close()
+
+        reader = IpmiCaptureReader(path)
+        assert isinstance(reader.records, np.memmap)
+        assert len(reader) == n + n//2 and len(reader.index) == len(reader)//BLOCK_SIZE
+        assert reader.sensors == [ "18", "nvidia-0" ]
+
+        ts, val = reader.samples( ns(20.0), ns(25.0), sensor=18 )
+        assert len(ts) == 501 and ts[0] == ns(20.0) and val[0] == 2100.0 and val[-1] == 2600.0, (len(ts), val)
+        window = reader.window( ns(20.0), ns(25.0) )
+        assert len(window) == 2*BLOCK_SIZE and np.shares_memory(window, reader.records)
+        ts, val = reader.samples( ns(30.5), None, sensor="18" )
+        assert len(ts) == n - 3050 and val[-1] == 100.0 + n - 1, len(ts)
+        ts, val = reader.samples( sensor="nvidia-0" )
+        assert len(ts) == n//2 and np.all( np.diff(ts) > 0 )
+
+        assert reader.events() == [ (ns(0), "start_session = a"), (ns(n*0.01), "stop_session = a") ]
+        assert reader.events( ns(1) ) == [ (ns(n*0.01), "stop_session = a") ]
+
+    print("%s: all tests passed" % sys.argv[0])
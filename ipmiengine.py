@@ -0,0 +1,393 @@
+import sys
+import time
+import math
+import json
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from ipmimon import IpmiMon
+
+#
+# configuration
+#
+NODE_DEFAULTS = {   "port"          : 623,
+                    "iface"         : "lan",
+                    "transport"     : "rmcp",
+                    "keep_alive"    : 1,
+                    "username"      : "admin",
+                    "password"      : "admin",
+                    "records"       : [],
+                    "rate"          : None,
+                    "max_consec_errors" : 50 }
+RECONNECT_DELAY = 5.0
+
+def load_config(path):
+    """
+    This function reads the list of BMCs to monitor from a JSON file:
+
+        { "defaults": { "username": "admin", "password": "admin", "rate": 4 },
+          "nodes": [ { "name": "node01", "ip": "10.0.0.1", "records": [ 18, 19 ] },
+                     { "name": "node02", "ip": "10.0.0.2", "records": [ 18 ], "port": 6230 } ] }
+
+    Each node takes the settings it does not give from 'defaults', then from
+    NODE_DEFAULTS.  'rate' is the sampling rate in Hz.
+    """
+
+    with open(path) as f:
+        config = json.load(f)
+
+    defaults = dict(NODE_DEFAULTS)
+    defaults.update( config.get("defaults", {}) )
+    nodes = []
+    for entry in config.get("nodes", []):
+        node = dict(defaults)
+        node.update(entry)
+        if "ip" not in node:
+            raise Exception("ERR: Node %s in '%s' has no 'ip'." % (entry, path))
+        node.setdefault("name", node["ip"])
+        nodes.append(node)
+
+    names = [ n["name"] for n in nodes ]
+    if len(set(names)) != len(names):
+        raise Exception("ERR: Node names in '%s' are not unique." % path)
+    if not nodes:
+        raise Exception("ERR: No nodes in '%s'." % path)
+    return nodes
+
+class IpmiEngine:
+    """
+    This class monitors many BMCs from one process on one asyncio event loop.
+
+    Each node is an IpmiMon with one session to its BMC and a coroutine which
+    samples its records on fixed deadlines ( start + k * period ), skipping
+    deadlines that have passed.  The blocking reads run on one thread pool of
+    'workers' threads shared by all nodes.  The sessions are kept alive by a
+    coroutine per node, which sends a Get Device ID on the same pool when the
+    session has been idle for 'keep_alive' seconds, instead of a pyipmi
+    thread per session, so the number of threads does not grow with the
+    number of nodes.  A node that fails is reconnected without stopping the
+    others.
+
+    Samples reach the session manager with the node name, so sessions can be
+    limited to a subset of the nodes.
+    """
+
+    def __init__(self,  nodes,
+                        logger=None,
+                        session_manager=None,
+                        delay=0.25,
+                        workers=16,
+                        sweep_report=0,
+                        capture=None,
+                        broadcaster=None,
+                        metrics=None,
+                        rollups=None,
+                        sdr_cache=None,
+                        debug=False):
+
+        self.nodes      = nodes
+        self.logger     = logger
+        self.session_manager = session_manager
+        self.delay      = delay
+        self.workers    = workers
+        self.sweep_report = sweep_report
+        self.capture    = capture
+        self.broadcaster = broadcaster
+        self.metrics    = metrics
+        self.rollups    = rollups
+        self.sdr_cache  = sdr_cache
+        self.debug      = debug
+        self.mons       = {}
+        self.stats      = {}
+        self.pool       = ThreadPoolExecutor( max_workers=workers, thread_name_prefix="IpmiEngine" )
+        self.tasks      = []
+        self.last_request = {}          # the loop time of each node's last request
+        self.last_report = None
+
+    def connect(self):
+        """
+        This function connects to all the BMCs ( on the shared pool ) and
+        retrieves the records of each.  Nodes that cannot be reached are
+        reported and retried by run().
+        """
+
+        self._create_mons()
+        for name, ok in zip( self.mons.keys(), self.pool.map(self._connect_node, self.mons.values()) ):
+            if not ok: print("%s: ERROR: Could not connect to node %s" % (sys.argv[0], name))
+
+    def enumerate(self):
+        """
+        This function lists the sensors of every node ( see
+        IpmiMon.enumerate_sensors ), one node at a time.  It returns the
+        number of nodes that could not be enumerated.
+        """
+
+        self._create_mons()
+        failed = 0
+        for name, mon in self.mons.items():
+            print("%s: Sensors of node %s ( %s ):" % (sys.argv[0], name, mon.ip))
+            try:
+                mon.connect()
+                mon.enumerate_sensors()
+            except:
+                print("%s: ERROR: Could not enumerate node %s:" % (sys.argv[0], name), sys.exc_info()[1])
+                failed += 1
+            finally:
+                if mon.connected: mon.disconnect()
+        return failed
+
+    def _create_mons(self):
+
+        for node in self.nodes:
+            self.mons[node["name"]] = IpmiMon(  ip              = node["ip"],
+                                                port            = node["port"],
+                                                iface           = node["iface"],
+                                                transport       = node["transport"],
+                                                keep_alive      = 0,    # sent by _keep_alive_node
+                                                username        = node["username"],
+                                                password        = node["password"],
+                                                records         = node["records"],
+                                                max_consec_errors = node["max_consec_errors"],
+                                                logger          = self.logger,
+                                                session_manager = self.session_manager,
+                                                delay           = self.delay,
+                                                name            = node["name"],
+                                                capture         = self.capture,
+                                                broadcaster     = self.broadcaster,
+                                                metrics         = self.metrics,
+                                                rollups         = self.rollups,
+                                                sdr_cache       = self.sdr_cache,
+                                                debug           = self.debug )
+            self.stats[node["name"]] = {    'period'    : self._period(node),
+                                            'fired'     : 0,
+                                            'missed'    : 0,
+                                            'overruns'  : 0,
+                                            'errors'    : 0,
+                                            'keepalives': 0,
+                                            'max_late'  : 0.0 }
+
+    def disconnect(self):
+
+        # let sweeps still running on the pool finish before closing their sessions
+        self.pool.shutdown()
+        for mon in self.mons.values():
+            if mon.connected: mon.disconnect()
+
+    def start(self):
+        """
+        This function starts sampling every node on the running event loop.
+        """
+
+        self.last_report = time.monotonic()
+        for node in self.nodes:
+            self.tasks.append( asyncio.ensure_future( self._run_node(node) ) )
+            if node["keep_alive"] and node["transport"] == "rmcp":
+                self.tasks.append( asyncio.ensure_future( self._keep_alive_node(node) ) )
+
+    def stop(self):
+
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        self.log_stats()
+
+    def run(self, seconds=None):
+        """
+        This function samples every node on a new event loop until interrupted,
+        or for the given number of seconds.
+        """
+
+        async def main():
+            self.start()
+            try:
+                if seconds is None:
+                    await asyncio.gather( *self.tasks )
+                else:
+                    await asyncio.sleep(seconds)
+            finally:
+                self.stop()
+
+        try:
+            asyncio.run( main() )
+        except KeyboardInterrupt:
+            pass
+
+    def log_stats(self):
+
+        for name, s in self.stats.items():
+            message = "SCHEDULE: task=%s period=%g fired=%d missed=%d overruns=%d errors=%d max_late_ms=%.2f" % \
+                ( name, s['period'], s['fired'], s['missed'], s['overruns'], s['errors'], 1000*s['max_late'] )
+            if self.logger: self.logger.log(message, echo=self.debug)
+            elif self.debug: print("%s:" % sys.argv[0], message)
+
+    def _period(self, node):
+
+        return 1.0/node["rate"] if node["rate"] else self.delay
+
+    def _connect_node(self, mon):
+
+        try:
+            mon.connect()
+            mon.get_sensors()
+            for descr in mon.get_sensor_descriptions():
+                message = "SENSOR: %s:%s %d %d" % (mon.name, descr['name'], descr['record_id'], descr['number'] )
+                if self.logger: self.logger.log(message)
+            mon.consec_ipmi_errors = 0
+            return True
+        except:
+            if self.debug: traceback.print_exc()
+            try:
+                mon.disconnect()
+            except:
+                pass
+            return False
+
+    async def _run_node(self, node):
+
+        loop = asyncio.get_running_loop()
+        mon = self.mons[node["name"]]
+        stats = self.stats[node["name"]]
+        period = stats['period']
+        start = loop.time()
+        k = 0
+
+        while True:
+            deadline = start + k*period
+            wait = deadline - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            started = self.last_request[node["name"]] = loop.time()
+            stats['max_late'] = max(stats['max_late'], started - deadline)
+            if not mon.connected:
+                if not await loop.run_in_executor( self.pool, self._connect_node, mon ):
+                    stats['errors'] += 1
+                    await asyncio.sleep(RECONNECT_DELAY)
+                    start, k = loop.time(), 0
+                    continue
+            try:
+                await loop.run_in_executor( self.pool, mon._sample_sensors )
+            except asyncio.CancelledError:
+                raise
+            except:
+                print("%s: ERROR: Sampling node %s failed, reconnecting:" % (sys.argv[0], node["name"]), sys.exc_info()[1])
+                stats['errors'] += 1
+                if self.metrics: self.metrics.error("ipmi", node["name"])
+                await loop.run_in_executor( self.pool, mon.disconnect )
+            finished = self.last_request[node["name"]] = loop.time()
+            stats['fired'] += 1
+            if finished - started > period:
+                stats['overruns'] += 1
+
+            # the next deadline still in the future, skipping any already passed
+            k += 1
+            if start + k*period <= finished:
+                missed = int(math.floor((finished - start - k*period)/period)) + 1
+                stats['missed'] += missed
+                k += missed
+
+            now = time.monotonic()
+            if self.sweep_report and now - self.last_report >= self.sweep_report:
+                self.last_report = now
+                self.log_stats()
+
+    async def _keep_alive_node(self, node):
+        """
+        This coroutine sends a keepalive request on the shared pool whenever
+        the node's session has been idle for keep_alive seconds.
+        """
+
+        loop = asyncio.get_running_loop()
+        mon = self.mons[node["name"]]
+        stats = self.stats[node["name"]]
+        interval = node["keep_alive"]
+        self.last_request.setdefault( node["name"], loop.time() )
+
+        while True:
+            idle = loop.time() - self.last_request[node["name"]]
+            if idle < interval:
+                await asyncio.sleep(interval - idle)
+                continue
+            self.last_request[node["name"]] = loop.time()
+            if not mon.connected:
+                continue
+            try:
+                await loop.run_in_executor( self.pool, mon.keep_alive_session )
+                stats['keepalives'] += 1
+            except asyncio.CancelledError:
+                raise
+            except:
+                # a lost session is found and reconnected by the sampling
+                if self.debug: traceback.print_exc()
+
+#
+# To run the unit tests below for IpmiEngine, type "python ipmiengine.py"
+#
+if __name__ == "__main__":
+
+    import os
+    from ipmistore import now_ns
+    import tempfile
+    from ipmisim import IpmiSimBmc
+    from ipmisession import IpmiSessionManager
+
+    bmcs = [ IpmiSimBmc( port=0, records=3, latency=0.002, seed=i ) for i in range(4) ]
+    ports = [ bmc.start() for bmc in bmcs ]
+
+    config = { "defaults": { "rate": 20, "records": [ 1, 2 ] },
+               "nodes": [ { "name": "node%02d" % i, "ip": "127.0.0.1", "port": port } for i, port in enumerate(ports) ] }
+    config["nodes"][3]["records"] = [ 3 ]
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(config, f)
+    nodes = load_config(f.name)
+    os.unlink(f.name)
+    assert nodes[0]["records"] == [ 1, 2 ] and nodes[3]["records"] == [ 3 ] and nodes[1]["transport"] == "rmcp"
+    assert all( n["keep_alive"] == 1 for n in nodes )
+
+    manager = IpmiSessionManager()
+    engine = IpmiEngine( nodes, session_manager=manager, workers=2 )
+    engine.connect()
+
+    async def capture():
+        engine.start()
+        await asyncio.sleep(0.3)
+        manager.start( now_ns(), "all" )
+        manager.start( now_ns(), "some", nodes=[ "node01", "node03" ] )
+        await asyncio.sleep(1.0)
+        stats_all = manager.stop( now_ns(), "all", all_stats=True )
+        stats_some = manager.stop( now_ns(), "some", all_stats=True )
+        engine.stop()
+        return stats_all, stats_some
+
+    stats_all, stats_some = asyncio.run( capture() )
+    engine.disconnect()
+
+    # the threads do not grow with the nodes, the sessions are kept alive from the event loop
+    import threading
+    def engine_threads(count):
+        nodes = [ dict( NODE_DEFAULTS, name="n%d" % i, ip="127.0.0.1", port=ports[i % len(ports)],
+                        records=[ 1 ], rate=2, keep_alive=0.2 ) for i in range(count) ]
+        engine = IpmiEngine( nodes, workers=2 )
+        engine.connect()
+        engine.run(1.2)
+        threads = [ t.name for t in threading.enumerate() if not t.name.startswith( ("IpmiSimBmc", "ThreadPoolExecutor") ) ]
+        keepalives = min( s['keepalives'] for s in engine.stats.values() )
+        engine.disconnect()
+        return threads, keepalives
+    threads2, keepalives2 = engine_threads(2)
+    threads16, keepalives16 = engine_threads(16)
+    assert len(threads16) == len(threads2) <= 3, (threads2, threads16)
+    assert keepalives2 >= 1 and keepalives16 >= 1, (keepalives2, keepalives16)
+
+    for bmc in bmcs: bmc.stop()
+
+    assert sorted(stats_all["nodes"].keys()) == [ "node00", "node01", "node02", "node03" ], stats_all["nodes"]
+    assert sorted(stats_all["powers"].keys()) == [ "node00:1", "node00:2", "node01:1", "node01:2", "node02:1", "node02:2", "node03:3" ]
+    assert sorted(stats_some["nodes"].keys()) == [ "node01", "node03" ], stats_some["nodes"]
+    assert abs(stats_all["tot_power"] - sum(stats_all["nodes"].values())) < 1e-6
+    assert all( e > 0 for e in stats_all["nodes"].values() )
+    for name, s in engine.stats.items():
+        assert s['fired'] >= 20 and s['errors'] == 0, (name, s)
+
+    print("%s: all tests passed" % sys.argv[0])
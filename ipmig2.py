@@ -0,0 +1,95 @@
+import sys
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from ipmistore import now_ns
+
+#
+# configuration
+#
+
+#Power (V)       : 27.429188
+GSI_TOOL_POWER_REGEX = re.compile(r"Power\s*\(V\)\s+\:\s+(\S+)")
+
+class GsiToolReader:
+    """
+    This class reads the power of several GSI G2 APUs with one gsi_tool
+    invocation per sample ( 'gsi_tool info apu-00 apu-01 ...' ), taking the
+    n-th power line of the output as the power of the n-th device.
+
+    If the output does not hold one power line per device ( a gsi_tool that
+    only takes one device ), the reader falls back to running one gsi_tool per
+    device, all at the same time, for the rest of the capture.
+    """
+
+    def __init__(self, devices, cmd="gsi_tool", debug=False):
+
+        self.devices    = list(devices)
+        self.cmd        = cmd
+        self.debug      = debug
+        self.batched    = True
+        self.pool       = None
+
+    def stop(self):
+
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+
+    def poll(self):
+        """
+        This function returns a list of (device, watts, ts) readings, one per
+        device that reported its power.
+        """
+
+        if self.batched:
+            powers = self._run( self.devices )
+            if len(powers) == len(self.devices):
+                ts = now_ns()
+                return [ (device, power, ts) for device, power in zip(self.devices, powers) ]
+            if len(self.devices) == 1:
+                raise Exception("ERR: No power reading in gsi_tool output for apu-%02d." % self.devices[0])
+            print("%s: gsi_tool returned %d power readings for %d devices, running one gsi_tool per device" % \
+                    ( sys.argv[0], len(powers), len(self.devices) ))
+            self.batched = False
+
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor( max_workers=len(self.devices), thread_name_prefix="GsiToolReader" )
+        readings = []
+        for device, powers in zip( self.devices, self.pool.map(lambda d: self._run([d]), self.devices) ):
+            if powers:
+                readings.append( (device, powers[0], now_ns()) )
+            else:
+                print("%s: No power reading in gsi_tool output for apu-%02d" % ( sys.argv[0], device ))
+        return readings
+
+    def _run(self, devices):
+
+        args = [ self.cmd, "info" ] + [ "apu-%02d" % d for d in devices ]
+        if self.debug: print("running gsi_tool command:", " ".join(args))
+        outp = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+        if self.debug: print("result of cmd=", outp)
+        return [ float(m) for m in GSI_TOOL_POWER_REGEX.findall(outp) ]
+
+#
+# To run the unit tests below, type "python ipmig2.py"
+# ( they use tests/fake_gsi_tool.py )
+#
+if __name__ == "__main__":
+
+    fake = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "fake_gsi_tool.py")
+
+    reader = GsiToolReader( [ 0, 3, 12 ], cmd=fake )
+    readings = reader.poll()
+    assert reader.batched
+    assert [ (r[0], r[1]) for r in readings ] == [ (0, 20.5), (3, 23.5), (12, 32.5) ], readings
+
+    os.environ["FAKE_GSI_TOOL_SINGLE"] = "1"
+    reader = GsiToolReader( [ 0, 3, 12 ], cmd=fake )
+    readings = reader.poll()
+    reader.stop()
+    assert not reader.batched
+    assert [ (r[0], r[1]) for r in readings ] == [ (0, 20.5), (3, 23.5), (12, 32.5) ], readings
+
+    print("%s: all tests passed" % sys.argv[0])
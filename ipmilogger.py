@@ -2,27 +2,77 @@ import os
 import datetime
 import tempfile
 import sys
-from scipy.integrate import simps
-from numpy import trapz
-import pandas as pd
+import time
+import atexit
+import queue
+import threading
+import json
+import gzip
+import shutil
 import traceback
+from ipmistore import now_ns, to_ns, ns_to_datetime
+
+#
+# configuration
+#
+FSYNC_POLICIES = [ "never", "flush", "always" ]
+MANIFEST_SUFFIX = ".manifest.json"
 
 class IpmiLogger:
-    """This class abstracts to logging-to-file functions needed by the 
+    """This class abstracts to logging-to-file functions needed by the
     ipmicap package.
+
+    By default every call to log() opens, appends to and closes the log file.
+    In buffered mode the file is kept open and log lines are handed to a
+    bounded queue which a dedicated writer thread drains in groups.  The
+    timestamp of a line is always taken when log() is called, not when the
+    line reaches the file.  Times are int64 nanoseconds since the epoch off
+    the monotonic clock ( see ipmistore.now_ns ), datetimes are accepted too.
+
+    With rotate_size ( bytes ) or rotate_interval ( seconds ) the log is
+    written as numbered segments ( path.00000, path.00001, ... ) and a
+    manifest ( path.manifest.json ) lists the time range, size and sensors
+    of each segment.  With compress, closed segments are gzipped in the
+    background.  See log_segments() and read_log() for reading them back.
     """
 
-    def __init__(self,  path=None, overwrite=False, echo=False, sessions=False ):
-        
+    def __init__(self,  path=None, overwrite=False, echo=False, sessions=False,
+                        buffered=False,
+                        queue_size=10000,
+                        flush_interval=1.0,
+                        fsync="never",
+                        rotate_size=0,
+                        rotate_interval=0,
+                        compress=False,
+                        metrics=None ):
+
         if path!=None and  not overwrite and os.path.exists(path):
             raise Exception("The file '%s' exists." % path)
 
-        f = open(path,'w')
+        if fsync not in FSYNC_POLICIES:
+            raise Exception("ERR: Invalid fsync policy '%s'." % fsync)
+
+        self.path = path
+        self.rotate_size        = rotate_size
+        self.rotate_interval    = rotate_interval
+        self.compress           = compress
+        self.metrics            = metrics
+        self.segments           = []
+        self.compressors        = []
+        self.lock               = threading.Lock()
+        self.queue_lock         = threading.Lock()     # orders queued lines before close()
+        self.closed             = False
+        self.stamp              = ( None, None )    # the last second formatted
+        if self.rotate_size or self.rotate_interval:
+            self._open_segment( now_ns() )
+        else:
+            self.segment        = { 'file': path, 'start': None, 'end': None, 'lines': 0, 'bytes': 0, 'sensors': set() }
+
+        f = open(self.segment['file'],'w')
         f.write("IpmiLogger: %s\n" % path )
         f.flush()
         f.close()
 
-        self.path = path
         self.echo = echo
         self.sessions = sessions
         self.cur_cap_session    = None
@@ -30,19 +80,83 @@ class IpmiLogger:
         self.session_started    = False
         self.started            = None
         self.sensors            = {}
+        self.buffered           = buffered
+        self.flush_interval     = flush_interval
+        self.fsync              = fsync
+        self.queue              = None
+        self.writer             = None
+        self.file               = None
 
-    def log(self, message, echo=None, date=None):
+        if self.buffered:
+            self.file   = open(self.segment['file'],'a')
+            self.queue  = queue.Queue(maxsize=queue_size)
+            self.writer = threading.Thread(target=self._writer_loop, name="IpmiLoggerWriter", daemon=True)
+            self.writer.start()
+            atexit.register(self.close)
+
+    def log(self, message, echo=None, date=None, sensor=None):
         """"
-        This function logs a messages to the log file.
+        This function logs a messages to the log file.  The sensor a sample
+        line belongs to is recorded in the manifest when rotating.  It returns
+        the time of the line in nanoseconds.
         """
 
-        f = open(self.path,'a')
-        if date: now = date
-        else: now = datetime.datetime.now()
-        line = now.strftime("%Y-%m-%d_%H:%M:%S") + " -- " + message
-        f.write( line  + "\n" )
-        f.flush()
-        f.close()
+        now = now_ns() if date is None else to_ns(date)
+        line = self._stamp(now) + " -- " + message
+
+        # blocks the caller if the writer falls behind by a full queue
+        if not ( self.buffered and self._queue( ( line + "\n", now, sensor ) ) ):
+            with self.lock:
+                self._append( [ ( line + "\n", now, sensor ) ] )
+
+        self._echo(line, echo)
+        return now
+
+    def log_batch(self, entries, echo=None):
+        """
+        This function logs a list of (message, date) entries with one write,
+        or as one item of the queue when buffered.  A date of None is now.
+        It returns the time of each entry in nanoseconds.
+        """
+
+        now = now_ns()
+        items = []
+        for message, date in entries:
+            date = now if date is None else to_ns(date)
+            line = self._stamp(date) + " -- " + message
+            items.append( ( line + "\n", date, None ) )
+            self._echo(line, echo)
+
+        if items and not ( self.buffered and self._queue( items ) ):
+            with self.lock:
+                self._append( items )
+
+        return [ item[1] for item in items ]
+
+    def _queue(self, item):
+        """
+        This function hands an item to the writer thread, or returns False
+        once the logger is closed.  close() queues its sentinel under the
+        same lock, so no line is queued after the writer's last drain.
+        """
+
+        with self.queue_lock:
+            if self.closed: return False
+            self.queue.put( item )
+            return True
+
+    def _stamp(self, ns):
+        """
+        This function formats the time of a line, once per second.
+        """
+
+        second = ns // 1000000000
+        stamp = self.stamp
+        if stamp[0] != second:
+            stamp = self.stamp = ( second, ns_to_datetime(ns).strftime("%Y-%m-%d_%H:%M:%S") )
+        return stamp[1]
+
+    def _echo(self, line, echo):
 
         if self.echo:
             if echo==None or echo==True: print("%s:" % sys.argv[0], line)
@@ -50,8 +164,213 @@ class IpmiLogger:
         else:
             if echo==True: print("%s:" % sys.argv[0], line)
             else: pass
-        
-        return now
+
+    def close(self):
+        """
+        This function drains any queued lines to the log file and stops the
+        writer thread.  It is safe to call more than once.
+        """
+
+        with self.queue_lock:
+            if self.closed: return
+            self.closed = True
+            if self.buffered: self.queue.put(None)
+
+        if self.buffered:
+            self.writer.join()
+            with self.lock:
+                self.file.flush()
+                if self.fsync!="never": os.fsync(self.file.fileno())
+                self.file.close()
+                # lines logged from now on are written directly
+                self.buffered = False
+
+        if self.rotate_size or self.rotate_interval:
+            with self.lock:
+                self.segments.append( self.segment )
+                self._write_manifest()
+            for compressor in self.compressors:
+                compressor.join()
+
+    def _append(self, entries):
+        """
+        This function writes (line, dt, sensor) entries to the current segment,
+        moving on to a new segment when the current one is full or too old.
+        """
+
+        start = time.perf_counter()
+        f = self.file if self.buffered else open(self.segment['file'],'a')
+        first = False
+        try:
+            for line, dt, sensor in entries:
+                if self._segment_full(dt):
+                    if not self.buffered: f.close()
+                    self._rotate(dt)
+                    f = self.file if self.buffered else open(self.segment['file'],'a')
+                f.write( line )
+                segment = self.segment
+                first = first or segment['start'] is None
+                if segment['start'] is None or dt < segment['start']: segment['start'] = dt
+                if segment['end'] is None or dt > segment['end']: segment['end'] = dt
+                segment['lines'] += 1
+                segment['bytes'] += len(line)
+                if sensor is not None: segment['sensors'].add( str(sensor) )
+        finally:
+            if not self.buffered:
+                f.flush()
+                f.close()
+            # the manifest shows when the open segment starts, for readers of a running log
+            if first and ( self.rotate_size or self.rotate_interval ):
+                self._write_manifest()
+            if self.metrics:
+                self.metrics.observe( "ipmicap_log_write_seconds", time.perf_counter() - start )
+
+    def _segment_full(self, dt):
+
+        segment = self.segment
+        if self.rotate_size and segment['bytes'] >= self.rotate_size:
+            return True
+        if self.rotate_interval and segment['opened'] and (dt - segment['opened'])/1e9 >= self.rotate_interval:
+            return True
+        return False
+
+    def _open_segment(self, dt):
+
+        name = "%s.%05d" % (self.path, len(self.segments))
+        self.segment = { 'file': name, 'opened': dt, 'start': None, 'end': None, 'lines': 0, 'bytes': 0, 'sensors': set() }
+        self._write_manifest()
+
+    def _rotate(self, dt):
+
+        if self.buffered:
+            self.file.flush()
+            if self.fsync!="never": os.fsync(self.file.fileno())
+            self.file.close()
+        segment = self.segment
+        self.segments.append( segment )
+        if self.compress:
+            compressor = threading.Thread(target=self._compress, args=(segment,), name="IpmiLoggerCompress", daemon=True)
+            self.compressors = [ c for c in self.compressors if c.is_alive() ] + [ compressor ]
+            compressor.start()
+        self._open_segment(dt)
+        if self.buffered:
+            self.file = open(self.segment['file'],'a')
+
+    def _compress(self, segment):
+        """
+        This function gzips a closed segment and points the manifest at it.
+        """
+
+        try:
+            with open(segment['file'],'rb') as src, gzip.open(segment['file'] + ".gz",'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            with self.lock:
+                os.unlink(segment['file'])
+                segment['file'] += ".gz"
+                self._write_manifest()
+        except:
+            print("%s: ERROR: could not compress log segment %s" % (sys.argv[0], segment['file']))
+            traceback.print_exc()
+
+    def _write_manifest(self):
+
+        entries = []
+        for segment in self.segments + ( [ self.segment ] if self.segment not in self.segments else [] ):
+            entries.append( {   'file'      : os.path.basename(segment['file']),
+                                'start'     : ns_to_datetime(segment['start']).isoformat() if segment['start'] else None,
+                                'end'       : ns_to_datetime(segment['end']).isoformat() if segment['end'] else None,
+                                'lines'     : segment['lines'],
+                                'bytes'     : segment['bytes'],
+                                'sensors'   : sorted(segment['sensors']),
+                                'open'      : segment is self.segment and not self.closed } )
+        tmp = self.path + MANIFEST_SUFFIX + ".tmp"
+        with open(tmp,'w') as f:
+            json.dump( { 'segments': entries }, f, indent=1 )
+        os.replace( tmp, self.path + MANIFEST_SUFFIX )
+
+    def _writer_loop(self):
+        """
+        This function runs in the writer thread.  It waits for queued lines,
+        writes all lines available at that moment as one group, and flushes
+        the file every flush_interval seconds.
+        """
+
+        last_flush = time.monotonic()
+        done = False
+        while not done:
+            try:
+                lines = [ self.queue.get(timeout=self.flush_interval) ]
+            except queue.Empty:
+                lines = []
+
+            while True:
+                try:
+                    lines.append( self.queue.get_nowait() )
+                except queue.Empty:
+                    break
+
+            if None in lines:
+                done = True
+                lines = [ ln for ln in lines if ln is not None ]
+            # a batch ( see log_batch ) is queued as one list of lines
+            lines = [ ln for item in lines for ln in ( item if isinstance(item, list) else [ item ] ) ]
+
+            try:
+                if lines:
+                    with self.lock:
+                        self._append( lines )
+
+                now = time.monotonic()
+                if self.fsync=="always" and lines:
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                    last_flush = now
+                elif now - last_flush >= self.flush_interval:
+                    self.file.flush()
+                    if self.fsync=="flush": os.fsync(self.file.fileno())
+                    last_flush = now
+            except:
+                print("%s: ERROR: log writer failed" % sys.argv[0])
+                traceback.print_exc()
+
+def log_segments(path, start=None, end=None):
+    """
+    This function returns the files of the log at path which may hold lines
+    logged between the start and end datetimes, oldest first.  A log written
+    without rotation is the one file at path.  The open segment ( of a log
+    still being written, or of a capture that was killed ) is always read
+    past its start, as its end in the manifest is not kept up to date.
+    """
+
+    manifest = path + MANIFEST_SUFFIX
+    if not os.path.exists(manifest):
+        return [ path ]
+
+    with open(manifest) as f:
+        segments = json.load(f)['segments']
+    files = []
+    for segment in segments:
+        if segment['start'] is None:
+            if not segment.get('open'): continue
+        elif end is not None and datetime.datetime.fromisoformat(segment['start']) > end: continue
+        elif start is not None and not segment.get('open') and datetime.datetime.fromisoformat(segment['end']) < start: continue
+        files.append( os.path.join( os.path.dirname(path), segment['file'] ) )
+    return files
+
+def read_log(path, start=None, end=None):
+    """
+    This function yields the lines of the log segments that overlap the start
+    and end datetimes, reading compressed segments transparently.  Lines at
+    the edges of the range are not filtered.
+    """
+
+    for name in log_segments(path, start, end):
+        if not os.path.exists(name) and os.path.exists(name + ".gz"):
+            name += ".gz"   # compressed since the manifest was read
+        f = gzip.open(name,'rt') if name.endswith(".gz") else open(name)
+        with f:
+            for line in f:
+                yield line.rstrip("\n")
 
 #
 # To run the unit tests below for IpmiLogger, type "python ipmilogger.py"
@@ -70,3 +389,88 @@ if __name__ == "__main__":
     print("%s: log file contents->\n%s" % (sys.argv[0],contents))
 
     os.unlink(path)
+
+    # buffered mode keeps the sample time and drains everything on close
+    path = tempfile.mkstemp()[1]
+    logger = IpmiLogger( path=path, overwrite=True, buffered=True, queue_size=16, flush_interval=0.05, fsync="flush" )
+    stamp = datetime.datetime(2020,1,2,3,4,5)
+    logger.log("buffered test", date=stamp)
+    for i in range(1000):
+        logger.log("%d : %f" % (i, i*0.5))
+    logger.close()
+    logger.close()
+
+    f = open(path)
+    lines = f.read().splitlines()
+    f.close()
+    assert lines[1] == "2020-01-02_03:04:05 -- buffered test", lines[1]
+    assert len(lines) == 1002, len(lines)
+    assert lines[-1].endswith("999 : 499.500000"), lines[-1]
+
+    # a batch is written in order, each line with its own date
+    for buffered in ( False, True ):
+        batch_path = tempfile.mkstemp()[1]
+        logger = IpmiLogger( path=batch_path, overwrite=True, buffered=buffered, flush_interval=0.05 )
+        dates = logger.log_batch( [ ( "phase = build", stamp ), ( "phase = search", None ), ( "phase = done", stamp ) ] )
+        assert dates[0] == to_ns(stamp) and dates[1] > to_ns(stamp)
+        logger.close()
+        with open(batch_path) as f:
+            lines = f.read().splitlines()
+        assert lines[1] == "2020-01-02_03:04:05 -- phase = build" and lines[2].endswith(" -- phase = search"), lines
+        assert len(lines) == 4
+        os.unlink(batch_path)
+
+    # no line is lost when logged while the logger is closed
+    for run in range(10):
+        race_path = tempfile.mkstemp()[1]
+        logger = IpmiLogger( path=race_path, overwrite=True, buffered=True, flush_interval=0.01 )
+        threads = [ threading.Thread(target=lambda: [ logger.log("line") for i in range(5000) ]) for t in range(4) ]
+        for t in threads: t.start()
+        time.sleep(0.002*run)
+        logger.close()
+        for t in threads: t.join()
+        with open(race_path) as f:
+            assert len(f.read().splitlines()) == 20001
+        os.unlink(race_path)
+    print("%s: buffered log test passed" % sys.argv[0])
+
+    os.unlink(path)
+
+    # rotation by size, with compressed segments and a manifest
+    path = os.path.join( tempfile.mkdtemp(), "capture" )
+    logger = IpmiLogger( path=path, buffered=True, flush_interval=0.05, rotate_size=4000, compress=True )
+    t0 = datetime.datetime(2020,1,2,3,0,0)
+    for i in range(600):
+        sensor = 18 if i%2 else "nvidia-0"
+        logger.log("%s : %f" % (sensor, i*0.5), date=t0 + datetime.timedelta(seconds=i), sensor=sensor)
+    logger.close()
+
+    with open(path + MANIFEST_SUFFIX) as f:
+        segments = json.load(f)['segments']
+    assert len(segments) > 3 and all( s['file'].endswith(".gz") for s in segments[:-1] ), segments
+    assert sum( s['lines'] for s in segments ) == 600 and not segments[-1]['open']
+    assert segments[0]['sensors'] == [ "18", "nvidia-0" ] and segments[0]['start'] == t0.isoformat()
+    assert len(log_segments(path)) == len(segments)
+    files = log_segments(path, t0 + datetime.timedelta(seconds=200), t0 + datetime.timedelta(seconds=250))
+    assert 1 <= len(files) <= 2, files
+    lines = list( read_log(path) )
+    assert lines[0].startswith("IpmiLogger:") and len(lines) == 601 and lines[-1].endswith("299.500000"), lines[-1]
+
+    # rotation by time, unbuffered
+    path = os.path.join( tempfile.mkdtemp(), "capture" )
+    logger = IpmiLogger( path=path, rotate_interval=60 )
+    for i in range(300):
+        logger.log("%d : 1.0" % i, date=datetime.datetime.now() + datetime.timedelta(seconds=i), sensor=i)
+    logger.close()
+    assert len(log_segments(path)) in (5, 6), log_segments(path)
+
+    # the open segment of a log still being written is read too
+    path = os.path.join( tempfile.mkdtemp(), "capture" )
+    logger = IpmiLogger( path=path, rotate_size=1000 )
+    for i in range(31):
+        logger.log("18 : %f" % (i*0.5), date=t0 + datetime.timedelta(seconds=i), sensor=18)
+    assert len( [ ln for ln in read_log(path) if " -- 18 : " in ln ] ) == 31
+    assert len(log_segments(path)) == len(os.listdir(os.path.dirname(path))) - 1
+    files = log_segments(path, t0 + datetime.timedelta(seconds=30), t0 + datetime.timedelta(seconds=40))
+    assert files == log_segments(path)[-1:], files
+    print("%s: rotation test passed" % sys.argv[0])
@@ -0,0 +1,229 @@
+import sys
+import time
+import bisect
+import threading
+
+#
+# configuration
+#
+LATENCY_BUCKETS = [ 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0 ]
+METRIC_HELP = { "ipmicap_samples_total"             : ( "counter",   "Samples taken, per source." ),
+                "ipmicap_errors_total"              : ( "counter",   "Failed reads, per source." ),
+                "ipmicap_sensor_value"              : ( "gauge",     "The latest reading of each sensor." ),
+                "ipmicap_sensor_timestamp_seconds"  : ( "gauge",     "The time of the latest reading of each sensor." ),
+                "ipmicap_ipmi_read_seconds"         : ( "histogram", "Time taken by one IPMI sensor read." ),
+                "ipmicap_nvidia_read_seconds"       : ( "histogram", "Time taken to collect the Nvidia GPU readings." ),
+                "ipmicap_g2_read_seconds"           : ( "histogram", "Time taken by one gsi_tool run." ),
+                "ipmicap_log_write_seconds"         : ( "histogram", "Time taken to write a group of lines to the log." ),
+                "ipmicap_sweep_seconds"             : ( "histogram", "Time taken to read a full set of IPMI records." ) }
+
+class IpmiHistogram:
+    """
+    This class counts observations into fixed buckets ( Prometheus style,
+    the upper bound of each bucket is inclusive. )
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+
+        self.buckets    = buckets
+        self.counts     = [ 0 ] * (len(buckets) + 1)
+        self.sum        = 0.0
+        self.count      = 0
+        self.lock       = threading.Lock()
+
+    def observe(self, value):
+
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+class IpmiMetrics:
+    """
+    This class collects the sampler's own instrumentation and renders it in
+    the Prometheus text format for the /metrics endpoint.
+
+    Recording is a dictionary update or a bucket increment under a short
+    lock, so it can be called on every sample.  The latest readings are
+    copy-on-write: a new sensor replaces the dictionary, so a render never
+    iterates one that is growing.  Gauges such as the number
+    of open sessions are registered as functions and only evaluated when
+    the metrics are rendered.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+
+        self.buckets    = buckets
+        self.counters   = {}
+        self.values     = {}
+        self.histograms = {}
+        self.gauges     = {}
+        self.lock       = threading.Lock()
+
+    def sample(self, source, sensor, value, ts=None, node=None):
+        """
+        This function counts one sample and keeps it as the sensor's latest reading.
+        """
+
+        reading = ( value, ts if ts is not None else time.time() )
+        if sensor in self.values:
+            self.values[sensor] = reading
+        else:
+            with self.lock:
+                values = dict(self.values)
+                values[sensor] = reading
+                self.values = values
+        self.inc( "ipmicap_samples_total", source, node )
+
+    def error(self, source, node=None):
+
+        self.inc( "ipmicap_errors_total", source, node )
+
+    def inc(self, name, source, node=None, amount=1):
+
+        key = ( name, source, node )
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, node=None):
+        """
+        This function adds one observation to a histogram ( e.g. ipmicap_ipmi_read_seconds. )
+        """
+
+        histogram = self.histograms.get( (name, node) )
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault( (name, node), IpmiHistogram(self.buckets) )
+        histogram.observe(seconds)
+
+    def gauge(self, name, help, fn):
+        """
+        This function registers a gauge whose value is fn() at render time.
+        """
+
+        self.gauges[name] = ( help, fn )
+
+    def render(self):
+        """
+        This function returns all the metrics in the Prometheus text format.
+        """
+
+        lines = []
+        def header(name, kind=None, help=None):
+            if help is None: kind, help = METRIC_HELP[name]
+            lines.append( "# HELP %s %s" % (name, help) )
+            lines.append( "# TYPE %s %s" % (name, kind) )
+
+        def labels(**kw):
+            items = [ '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in kw.items() if v is not None ]
+            return "{%s}" % ",".join(items) if items else ""
+
+        with self.lock:
+            counters = sorted( self.counters.items(), key=lambda kv: (kv[0][0], kv[0][1], kv[0][2] or "") )
+            histograms = sorted( self.histograms.items(), key=lambda kv: (kv[0][0], kv[0][1] or "") )
+        for name in ( "ipmicap_samples_total", "ipmicap_errors_total" ):
+            header(name)
+            for (n, source, node), value in counters:
+                if n == name: lines.append( "%s%s %d" % (name, labels(source=source, node=node), value) )
+
+        values = sorted( self.values.items(), key=lambda kv: str(kv[0]) )
+        header("ipmicap_sensor_value")
+        for sensor, (value, ts) in values:
+            lines.append( "ipmicap_sensor_value%s %r" % (labels(sensor=sensor), float(value)) )
+        header("ipmicap_sensor_timestamp_seconds")
+        for sensor, (value, ts) in values:
+            lines.append( "ipmicap_sensor_timestamp_seconds%s %.6f" % (labels(sensor=sensor), ts) )
+
+        for name in sorted( set( k[0] for k, h in histograms ) ):
+            header(name)
+            for (n, node), h in histograms:
+                if n != name: continue
+                with h.lock:
+                    counts, total, count = list(h.counts), h.sum, h.count
+                cumulative = 0
+                for bound, c in zip( h.buckets + [ "+Inf" ], counts ):
+                    cumulative += c
+                    lines.append( "%s_bucket%s %d" % (name, labels(node=node, le=bound), cumulative) )
+                lines.append( "%s_sum%s %r" % (name, labels(node=node), total) )
+                lines.append( "%s_count%s %d" % (name, labels(node=node), count) )
+
+        for name, (help, fn) in sorted( self.gauges.items() ):
+            try:
+                value = float(fn())
+            except:
+                continue
+            header(name, "gauge", help)
+            lines.append( "%s %r" % (name, value) )
+
+        return "\n".join(lines) + "\n"
+
+def metrics_handlers(metrics):
+    """
+    This function returns the tornado route for the /metrics endpoint.
+    """
+
+    import tornado.web
+
+    class MetricsHandler(tornado.web.RequestHandler):
+        """Serves the metrics in the Prometheus text format"""
+        def initialize(self, metrics):
+            self.metrics = metrics
+
+        def get(self):
+            self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.write( self.metrics.render() )
+
+    return [    (r"/metrics", MetricsHandler, {'metrics':metrics} ) ]
+
+#
+# To run the unit tests below, type "python ipmimetrics.py"
+#
+if __name__ == "__main__":
+
+    metrics = IpmiMetrics()
+    metrics.sample( "ipmi", "18", 250.0, ts=1600000000.0 )
+    metrics.sample( "ipmi", "18", 251.0, ts=1600000001.0 )
+    metrics.sample( "ipmi", "node01:18", 99.0, node="node01" )
+    metrics.sample( "nvidia", "nvidia-0", 70.5 )
+    metrics.error( "g2" )
+    for seconds in ( 0.0004, 0.003, 0.003, 20.0 ):
+        metrics.observe( "ipmicap_ipmi_read_seconds", seconds )
+    metrics.gauge( "ipmicap_open_sessions", "Capture sessions started and not yet stopped.", lambda: 2 )
+    metrics.gauge( "ipmicap_broken", "A gauge that fails is left out.", lambda: 1/0 )
+
+    text = metrics.render()
+    lines = text.splitlines()
+    assert 'ipmicap_samples_total{source="ipmi"} 2' in lines
+    assert 'ipmicap_samples_total{source="ipmi",node="node01"} 1' in lines
+    assert 'ipmicap_errors_total{source="g2"} 1' in lines
+    assert 'ipmicap_sensor_value{sensor="18"} 251.0' in lines
+    assert 'ipmicap_sensor_timestamp_seconds{sensor="18"} 1600000001.000000' in lines
+    assert 'ipmicap_ipmi_read_seconds_bucket{le="0.0005"} 1' in lines
+    assert 'ipmicap_ipmi_read_seconds_bucket{le="0.005"} 3' in lines
+    assert 'ipmicap_ipmi_read_seconds_bucket{le="10.0"} 3' in lines
+    assert 'ipmicap_ipmi_read_seconds_bucket{le="+Inf"} 4' in lines
+    assert 'ipmicap_ipmi_read_seconds_count 4' in lines
+    assert 'ipmicap_open_sessions 2.0' in lines and "ipmicap_broken " not in text
+
+    # rendering while new sensors appear
+    done = threading.Event()
+    def add_sensors():
+        for i in range(20000):
+            metrics.sample( "ipmi", "node%d:%d" % (i // 100, i), 1.0 )
+        done.set()
+    threading.Thread(target=add_sensors).start()
+    while not done.is_set():
+        metrics.render()
+    assert 'ipmicap_sensor_value{sensor="node199:19999"} 1.0' in metrics.render().splitlines()
+
+    # the cost of recording on the sampling path
+    start = time.perf_counter()
+    for i in range(100000):
+        metrics.sample( "ipmi", "18", 250.0, ts=1600000000.0 )
+        metrics.observe( "ipmicap_ipmi_read_seconds", 0.002 )
+    per_sample = (time.perf_counter() - start) / 100000
+    print("%s: %.2f us to record a sample and a latency" % (sys.argv[0], per_sample*1e6))
+    assert per_sample < 50e-6
+
+    print("%s: all tests passed" % sys.argv[0])
@@ -1,18 +1,28 @@
 import pyipmi
 import pyipmi.interfaces
 import time
+import math
 import os
 import sys
 import traceback
-import datetime
 import re
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ipmisched import IpmiScheduler
+from ipminvidia import NvidiaSmiReader, NvmlReader
+from ipmig2 import GsiToolReader
+from ipmisdr import IpmiSdrCache
+from ipmistore import now_ns, ns_to_datetime
 
 #
 # configuration
 #
-#Power (V)       : 27.429188
-GSI_TOOL_POWER_REGEX = re.compile(".*Power\s*\(V\)\s+\:\s+(.*)", re.MULTILINE)
-GSI_TOOL_POWER_REGEX = "Power\s*\(V\)\s+\:\s+(.*)"
+TRANSPORTS = [ "ipmitool", "rmcp" ]
+NVIDIA_SOURCES = [ "smi", "nvml" ]
+DCMI_MODES = { "system": 1, "enhanced": 2 }      # Get Power Reading modes
+DCMI_RECORD_ID = -1         # the record id the DCMI power is logged under
+DCMI_UNITS = [ 1, 60, 3600, 86400 ]             # seconds per rolling period unit
 
 class IpmiMon:
     """
@@ -23,7 +33,10 @@ class IpmiMon:
     """
 
     def __init__(self,  ip="127.0.0.1",
+                        port=623,
                         iface="lan",
+                        transport="ipmitool",
+                        keep_alive=1,
                         username="admin", 
                         password="admin", 
                         records=[],
@@ -32,13 +45,33 @@ class IpmiMon:
                         session_manager=None,
                         delay=0.1,
                         dcmi_power=False,
+                        dcmi_mode="system",
+                        dcmi_period=None,
                         nvidia=-1,
-                        g2 = -1,
+                        g2=[],
                         include_nvidia_in_tot_power = False,
+                        concurrency=1,
+                        sweep_report=0,
+                        ipmi_rate=None,
+                        nvidia_rate=None,
+                        g2_rate=None,
+                        record_rates={},
+                        nvidia_source="smi",
+                        nvidia_smi="nvidia-smi",
+                        gsi_tool="gsi_tool",
+                        name=None,
+                        capture=None,
+                        broadcaster=None,
+                        metrics=None,
+                        rollups=None,
+                        sdr_cache=None,
                         debug=False):
 
         self.ip         = ip
+        self.port       = port
         self.iface      = iface
+        self.transport  = transport
+        self.keep_alive = keep_alive
         self.username   = username
         self.password   = password
         self.records    = records
@@ -47,6 +80,10 @@ class IpmiMon:
         self.logger     = logger
         self.session_manager = session_manager
         self.dcmi_power = dcmi_power
+        self.dcmi_mode  = dcmi_mode
+        self.dcmi_period = dcmi_period  # seconds of the BMC's rolling average ( enhanced mode )
+        self.dcmi_last  = None          # ( bmc timestamp, average, ts ) of the last fresh reading
+        self.dcmi_energy = 0.0          # joules, derived from the rolling averages
         self.nvidia     = nvidia
         self.g2         = g2
         self.include_nvidia_in_tot_power = include_nvidia_in_tot_power
@@ -58,16 +95,46 @@ class IpmiMon:
         self.device_id  = None
         self.reservation_id = None
         self.sensors    = []
+        self.concurrency = max(1, concurrency)
+        self.sweep_report = sweep_report
+        self.connections = None
+        self.pool       = None
+        self.connection_lock = threading.Lock()
+        self.sweeps     = {}            # the sweep counters of each group of records
+        self.last_sweep_time = None
+        self.ipmi_rate  = ipmi_rate
+        self.nvidia_rate = nvidia_rate
+        self.g2_rate    = g2_rate
+        self.record_rates = record_rates
+        self.schedulers = {}
+        self.nvidia_source = nvidia_source
+        self.nvidia_smi = nvidia_smi
+        self.nvidia_reader = None
+        self.gsi_tool   = gsi_tool
+        self.g2_reader  = None
+        self.name       = name
+        self.capture    = capture
+        self.broadcaster = broadcaster
+        self.metrics    = metrics
+        self.rollups    = rollups
+        self.sdr_cache  = sdr_cache     # directory of the SDR cache, None to disable
+        self.sdr        = None
         self.debug      = debug
 
     def run_ipmi(self, event):
         """
-        This function will run a loop sampling the requested IPMI sensors with a 
-        delay between samples.
+        This function will run a loop sampling the requested IPMI sensors at a
+        fixed rate.  Records with their own rate in record_rates are sampled as
+        separate groups, each on its own thread of the scheduler so a slow
+        group does not delay a fast one.
         """
         if not self.connected:
             raise Exception("ERR: Not connected to the IPMI interface.")
   
+        if self.dcmi_power:
+            self.run_dcmi(event)
+            return
+
         if len(self.sensors)==0:
             self.get_sensors()
 
@@ -78,68 +145,122 @@ class IpmiMon:
                 if self.logger: self.logger.log(message)
 
         self.consec_ipmi_errors = 0
-   
-        # Sample the sensors continuously until 'stop' event
-        while not event.is_set():
 
-            if self.dcmi_power:
-                #GW: We need to revisit the dcmi impl
-                #GW: self._sample_dcmi_power() 
-                #GW: if self.nvidia>0:
-                #GW:    self._sample_nvidia()
-                raise Exception("Not implemented")
-            else:
-                self._sample_sensors()
+        # Group the records by sampling period
+        groups = {}
+        for s in self.sensors:
+            period = self._period( self.record_rates.get(s.id, self.ipmi_rate) )
+            groups.setdefault(period, []).append(s)
 
-            time.sleep( self.delay )    
+        # Sample the sensors continuously until 'stop' event
+        scheduler = IpmiScheduler( logger=self.logger, report=self.sweep_report, debug=self.debug )
+        for period, sensors in sorted(groups.items()):
+            name = "ipmi" if len(groups)==1 else "ipmi-%s" % ",".join( str(s.id) for s in sensors )
+            scheduler.add( name, period, lambda sensors=sensors, name=name: self._sample_sensors(sensors, name) )
+        self.schedulers['ipmi'] = scheduler
+        scheduler.run(event)
 
         if self.debug:
             print("%s: IPMI sensor monitor loop ended." % sys.argv[0])
 
+    def run_dcmi(self, event):
+        """
+        This function will run a loop reading the system power with the DCMI
+        Get Power Reading command at the IPMI rate.  In the enhanced mode the
+        BMC averages the power over a rolling window of dcmi_period seconds,
+        so a low polling rate still sees every change of the power, and the
+        energy is derived from those averages ( see _sample_dcmi_power. )
+        """
+
+        if self.logger:
+            self.logger.log( "SENSOR: DCMI %s Power %d 0" % (self.dcmi_mode.capitalize(), DCMI_RECORD_ID) )
+        period = self._period(self.ipmi_rate)
+        if self.dcmi_mode == "enhanced" and self.dcmi_period < period:
+            print("%s: Warning: The DCMI rolling average of %g s is shorter than the sampling period of %g s, "
+                  "the power in between is estimated" % (sys.argv[0], self.dcmi_period, period))
+
+        self.consec_ipmi_errors = 0
+        scheduler = IpmiScheduler( logger=self.logger, report=self.sweep_report, debug=self.debug )
+        scheduler.add( "dcmi", period, self._sample_dcmi_power )
+        self.schedulers['dcmi'] = scheduler
+        scheduler.run(event)
+
+        if self.debug:
+            print("%s: DCMI power monitor loop ended." % sys.argv[0])
+
     def run_nv(self, event):
         """
-        This function will run a loop sampling the requested NVidia devices with a
-        delay betweem samples.
+        This function will run a loop sampling the requested NVidia devices at a
+        fixed rate.  One reader ( a streaming nvidia-smi or NVML ) stays open
+        for the whole loop.
         """
 
-        # Sample the sensors continuously until 'stop' event
-        while not event.is_set():
+        if self.nvidia_source not in NVIDIA_SOURCES:
+            raise Exception("ERR: Unknown nvidia source '%s'." % self.nvidia_source)
 
-            self._sample_nvidia()
+        period = self._period(self.nvidia_rate)
+        if self.nvidia_source == "nvml":
+            self.nvidia_reader = NvmlReader( debug=self.debug )
+        else:
+            self.nvidia_reader = NvidiaSmiReader( cmd=self.nvidia_smi, loop_ms=1000*period, debug=self.debug )
+        self.nvidia_reader.start()
 
-            time.sleep( self.delay )
+        # Sample the sensors continuously until 'stop' event
+        try:
+            scheduler = IpmiScheduler( logger=self.logger, report=self.sweep_report, debug=self.debug )
+            scheduler.add( "nvidia", period, self._sample_nvidia )
+            self.schedulers['nvidia'] = scheduler
+            scheduler.run(event)
+        finally:
+            self.nvidia_reader.stop()
+            self.nvidia_reader = None
 
         if self.debug:
             print("%s: Nvidia sensor monitor loop ended." % sys.argv[0])
 
     def run_g2(self, event):
         """
-        This function will run a loop sampling the requested GSI G2 devices with a
-        delay betweem samples.
+        This function will run a loop sampling the requested GSI G2 devices at a
+        fixed rate.  All devices are read together on each sample.
         """
 
-        # Sample the sensors continuously until 'stop' event
-        while not event.is_set():
-
-            self._sample_g2()
+        self.g2_reader = GsiToolReader( self.g2, cmd=self.gsi_tool, debug=self.debug )
 
-            time.sleep( self.delay )
+        # Sample the sensors continuously until 'stop' event
+        try:
+            scheduler = IpmiScheduler( logger=self.logger, report=self.sweep_report, debug=self.debug )
+            scheduler.add( "g2", self._period(self.g2_rate), self._sample_g2 )
+            self.schedulers['g2'] = scheduler
+            scheduler.run(event)
+        finally:
+            self.g2_reader.stop()
+            self.g2_reader = None
 
         if self.debug:
             print("%s: G2 sensor monitor loop ended." % sys.argv[0])
 
+    def _period(self, rate):
+        """
+        This function returns the sampling period for a rate in Hz, falling back
+        to 'delay' seconds when no rate is given.
+        """
+        return 1.0/rate if rate else self.delay
+
     def connect(self):
         """
         This function will connect to the IPMI interface at its
         IP address and port with provided authentication credentials.
         """
         if self.debug: print("%s: using interface_type=" % type(self).__name__, self.iface)
-        self.interface = pyipmi.interfaces.create_interface('ipmitool', interface_type=self.iface)
-        self.connection = pyipmi.create_connection(self.interface)
-        self.connection.session.set_session_type_rmcp(self.ip, 623)
-        self.connection.session.set_auth_type_user(self.username, self.password)
-        self.connection.session.establish()
-        self.connection.target = pyipmi.Target(ipmb_address=0x20)
+        self.connection = self._create_connection()
+
+        # Reads run in parallel on a pool of sessions, at most 'concurrency' per BMC
+        if self.concurrency > 1:
+            self.connections = queue.Queue()
+            self.connections.put(self.connection)
+            for i in range(self.concurrency-1):
+                self.connections.put(self._create_connection())
+            self.pool = ThreadPoolExecutor(self.concurrency)
 
         if False:
             for selector in range(1, 6):
@@ -168,17 +289,102 @@ class IpmiMon:
             self.connection.session.establish()
 
         if self.dcmi_power:
-            pass #TODO: insert initialization activites here...
+            self._connect_dcmi()
         else:
             self.device_id = self.connection.get_device_id()
 
             if not self.device_id.supports_function('sdr_repository'):
                 raise Exception("ERR: IPMI does not support 'sdr_repository' function.")
 
-            self.reservation_id = self.connection.reserve_sdr_repository()
+            # the repository is only reserved when records have to be fetched
+            self.reservation_id = None
+            if self.sdr_cache:
+                self.sdr = IpmiSdrCache( self.ip, self.port, self.sdr_cache, self.debug )
+                self.sdr.validate( self.connection, self.device_id )
         self.connected = True
 
 
+    def _connect_dcmi(self):
+        """
+        This function checks the DCMI settings against the BMC: in the
+        enhanced mode the rolling period must be one the BMC supports.
+        """
+
+        if self.dcmi_mode not in DCMI_MODES:
+            raise Exception("ERR: Unknown DCMI mode '%s'." % self.dcmi_mode)
+        self.dcmi_last = None
+        if self.dcmi_mode != "enhanced":
+            return
+        if not self.dcmi_period:
+            self.dcmi_period = max( 1, int(math.ceil(self._period(self.ipmi_rate))) )
+        encode_dcmi_period(self.dcmi_period)
+
+        try:
+            caps = self.connection.get_dcmi_capabilities(pyipmi.dcmi.PARAM_ENHANCED_SYSTEM_POWER_STATISTICS_ATTRIBUTES)
+            data = list(caps.parameter_data)
+            periods = [ decode_dcmi_period(p) for p in data[1:1+data[0]] ] if data else []
+        except pyipmi.errors.CompletionCodeError:
+            print("%s: Warning: Could not read the DCMI rolling average periods the BMC supports" % sys.argv[0])
+            return
+        if self.debug: print("%s: DCMI rolling average periods" % sys.argv[0], periods)
+        if self.dcmi_period not in periods:
+            raise Exception("ERR: The BMC has no DCMI rolling average of %g s ( it has %s s. )" % \
+                            ( self.dcmi_period, ", ".join( "%g" % p for p in periods ) or "none" ))
+
+    def _create_connection(self):
+        """
+        This function creates and establishes one session with the IPMI interface.
+
+        The 'ipmitool' transport runs an ipmitool process, with its own LAN session,
+        for every request.  The 'rmcp' transport keeps one authenticated session open
+        over UDP (IPMI v1.5 for iface 'lan', RMCP+ for 'lanplus'), sending keepalive
+        requests whenever it has been idle for keep_alive seconds.
+        """
+        if self.transport == "ipmitool":
+            self.interface = pyipmi.interfaces.create_interface('ipmitool', interface_type=self.iface)
+        elif self.transport == "rmcp":
+            name = 'rmcpplus' if self.iface == 'lanplus' else 'rmcp'
+            self.interface = pyipmi.interfaces.create_interface(name, slave_address=0x81,
+                                    host_target_address=0x20, keep_alive_interval=self.keep_alive)
+        else:
+            raise Exception("ERR: Unknown transport '%s'." % self.transport)
+
+        connection = pyipmi.create_connection(self.interface)
+        connection.session.set_session_type_rmcp(self.ip, self.port)
+        connection.session.set_auth_type_user(self.username, self.password)
+        if self.transport == "rmcp":
+            connection.open()
+        else:
+            connection.session.establish()
+        connection.target = pyipmi.Target(ipmb_address=0x20)
+        return connection
+
+    def keep_alive_session(self):
+        """
+        This function sends a Get Device ID request to keep an idle session
+        open, for callers that send the keepalives themselves ( see IpmiEngine. )
+        """
+
+        self.connection.get_device_id()
+
+    def disconnect(self):
+        """
+        This function closes the sessions with the IPMI interface.
+        """
+        if self.pool:
+            self.pool.shutdown()
+        connections = [ self.connection ]
+        if self.connections:
+            connections = []
+            while not self.connections.empty():
+                connections.append( self.connections.get() )
+        for connection in connections:
+            try:
+                if connection: connection.close()
+            except:
+                if self.debug: traceback.print_exc()
+        self.connected = False
+
     def enumerate_sensors(self):
         """
         This function will enumerate all the sensors available at the IPMI
@@ -189,10 +395,13 @@ class IpmiMon:
         if not self.connected:
             raise Exception("ERR: Not connected to the IPMI interface.")
 
-        if self.device_id.supports_function('sdr_repository'):
+        if self.sdr and self.sdr.entries() is not None:
+            print("%s: Using the cached 'sdr_repository' records" % sys.argv[0])
+            iter_fct = self.sdr.entries
+        elif self.device_id.supports_function('sdr_repository'):
 
             print("%s: Using 'sdr_repository' interface" % sys.argv[0])
-            iter_fct = self.connection.sdr_repository_entries
+            iter_fct = self._walk_sdr_repository
         elif device_id.supports_function('sensor'):
             print("%s: Using 'sensor' interface" % sys.argv[0])
             iter_fct = self.connection.device_sdr_entries
@@ -240,24 +449,100 @@ class IpmiMon:
 
         self.sensors=[]
         for record_id in self.records:
-            s = self.connection.get_repository_sdr(record_id, self.reservation_id)
+            s = self.sdr.get(record_id) if self.sdr else None
+            if s is None:
+                if self.reservation_id is None:
+                    self.reservation_id = self.connection.reserve_sdr_repository()
+                s = self.connection.get_repository_sdr(record_id, self.reservation_id)
+                if self.sdr: self.sdr.put(s)
             self.sensors.append(s)
+        if self.sdr: self.sdr.save()
 
         return True
 
+    def _walk_sdr_repository(self):
+        """
+        This function reads every record of the SDR repository, caching them
+        all when the SDR cache is enabled.
+        """
+
+        records = list( self.connection.sdr_repository_entries() )
+        if self.sdr:
+            self.sdr.set_entries(records)
+            self.sdr.save()
+        return records
 
-    def _sample_sensors(self):
 
-        for s in self.sensors:
+    def _sample_sensors(self, sensors=None, group="ipmi"):
+
+        if sensors is None: sensors = self.sensors
+        start = time.monotonic()
+
+        if self.pool:
+            # keep up to 'concurrency' reads in flight and emit each as it completes
+            futures = [ self.pool.submit(self._pooled_read_sensor, s) for s in sensors ]
+            readings = ( f.result() for f in as_completed(futures) )
+        else:
+            readings = ( self._locked_read_sensor(s) for s in sensors )
+
+        for reading in readings:
 
-            if self._sample_sensor(s)==False:
+            if reading==False:
                 print("%s: Incrementing consec ipmi errors from" % sys.argv[0], self.consec_ipmi_errors)
                 self.consec_ipmi_errors += 1
+                if self.metrics: self.metrics.error("ipmi", self.name)
+            elif reading:
+                s, number, value, states, ts = reading
+                self.emit_sdr_list_entry(s.id, number, s.device_id_string, value, states, ts=ts)
 
             if self.consec_ipmi_errors >= self.max_consec_errors:
                 raise Exception("ERR: Maximum consecutive ipmi errors reached.")
 
-    def _sample_sensor(self,s):
+        self._record_sweep( time.monotonic() - start, sensors, group )
+
+    def _record_sweep(self, elapsed, sensors, group="ipmi"):
+        """
+        This function accumulates the time taken to read the full set of records
+        of a group and periodically reports it.
+        """
+
+        self.last_sweep_time = elapsed
+        if self.metrics: self.metrics.observe("ipmicap_sweep_seconds", elapsed, self.name)
+
+        now = time.monotonic()
+        sweep = self.sweeps.get(group)
+        if sweep is None:
+            sweep = self.sweeps[group] = { 'count': 0, 'total': 0.0, 'max': 0.0, 'last_report': now }
+        sweep['count'] += 1
+        sweep['total'] += elapsed
+        sweep['max'] = max(sweep['max'], elapsed)
+        if self.sweep_report and now - sweep['last_report'] >= self.sweep_report:
+            message = "SWEEP: group=%s records=%d concurrency=%d count=%d mean_ms=%.2f max_ms=%.2f" % \
+                ( group, len(sensors), self.concurrency, sweep['count'],
+                  1000*sweep['total']/sweep['count'], 1000*sweep['max'] )
+            if self.logger: self.logger.log(message, echo=self.debug)
+            elif self.debug: print("%s:" % sys.argv[0], message)
+            self.sweeps[group] = { 'count': 0, 'total': 0.0, 'max': 0.0, 'last_report': now }
+
+    def _locked_read_sensor(self, s):
+
+        # the groups of records share the one session, a read at a time
+        with self.connection_lock:
+            return self._read_sensor(s, self.connection)
+
+    def _pooled_read_sensor(self, s):
+
+        connection = self.connections.get()
+        try:
+            return self._read_sensor(s, connection)
+        finally:
+            self.connections.put(connection)
+
+    def _read_sensor(self, s, connection):
+        """
+        This function reads one sensor and returns the reading with the time it
+        was taken, None if the record type is not sampled, or False on error.
+        """
 
         try:
             number = None
@@ -265,22 +550,23 @@ class IpmiMon:
             states = None
     
             if s.type is pyipmi.sdr.SDR_TYPE_FULL_SENSOR_RECORD:
-                (value, states) = self.connection.get_sensor_reading(s.number)
+                start = time.perf_counter()
+                (value, states) = connection.get_sensor_reading(s.number)
+                if self.metrics: self.metrics.observe("ipmicap_ipmi_read_seconds", time.perf_counter() - start, self.name)
                 number = s.number
 
                 if value is not None:
                     value = s.convert_sensor_raw_to_value(value)
                 elif s.type is pyipmi.sdr.SDR_TYPE_COMPACT_SENSOR_RECORD:
-                    (value, states) = self.connection.get_sensor_reading(s.number)
+                    (value, states) = connection.get_sensor_reading(s.number)
                     number = s.number
 
-                self.emit_sdr_list_entry(s.id, number, s.device_id_string, value, states)
-                return True
+                return (s, number, value, states, now_ns())
 
         except pyipmi.errors.CompletionCodeError as e:
             print("%s: CompletionCodeError" % sys.argv[0])
             if s.type in (pyipmi.sdr.SDR_TYPE_COMPACT_SENSOR_RECORD, pyipmi.sdr.SDR_TYPE_FULL_SENSOR_RECORD):
-                print('%s: CompletionCodeError: 0x{:04x} | {:3d} | {:18s} | ERR: CC=0x{:02x}'.format( sys.argv[0], s.id, s.number, s.device_id_string, e.cc))
+                print('{}: CompletionCodeError: 0x{:04x} | {:3d} | {:18s} | ERR: CC=0x{:02x}'.format( sys.argv[0], s.id, s.number, s.device_id_string, e.cc))
             return False
 
         except:
@@ -291,122 +577,172 @@ class IpmiMon:
             pass
 
     def _sample_nvidia(self):
+        """
+        This function emits the GPU readings received by the reader since the
+        last call.  Each reading keeps the time it was taken.
+        """
         try:
-            if self.debug: print("About to call nvidia-smi for power...")
-
-            cmd = "nvidia-smi --query-gpu=index,power.draw --format=csv"
-            if self.debug: print("running nvidia-smi command", cmd)
-            stream = os.popen(cmd)
-            outp = stream.read()
-            if self.debug: print("result of cmd=", outp)
+            start = time.perf_counter()
+            readings = self.nvidia_reader.poll()
+            if self.metrics: self.metrics.observe("ipmicap_nvidia_read_seconds", time.perf_counter() - start)
+            if self.debug: print("nvidia readings", readings)
 
-            # parse csv shape response
-            lines = [ ln for ln in outp.split('\n') if ln.strip()!="" ]
-            if self.debug: print("nvidia lines", lines, len(lines), self.nvidia)
-            if len(lines)!= self.nvidia + 2:
-                errstr = "ERROR: Could not find %d Nvidia boards but found %d" % ( self.nvidia, len(lines)-1 )
-                raise Exception(errstr) 
+            # a poll can end part way through one round of boards, so only
+            # indexes beyond the requested boards are reported
+            unknown = set( r[0] for r in readings if r[0] > self.nvidia )
+            if unknown:
+                print("%s: ERROR: Found Nvidia boards %s beyond the %d requested" % ( sys.argv[0], sorted(unknown), self.nvidia + 1 ))
 
-            powers = [ (int(ln.strip().split(",")[0]), \
-                        float(ln.strip().split(",")[1].strip().split()[0] )) \
-                        for ln in lines[1:] ]
-            if self.debug: print("nvidia power(s)", powers)
-
-            self.emit_nvidia_power( powers )
+            self.emit_nvidia_power( readings )
 
         except:
+            if self.metrics: self.metrics.error("nvidia")
             print("Sample nvidia power error:", sys.exc_info()[0])
             traceback.print_exc()
 
     def emit_nvidia_power(self, powers):
         for power in powers:
-            nv_id, value = power
+            nv_id, value, energy, ts = power
             message = "%d : %s" % ( nv_id, value)
+            sensor = "nvidia-%d" % nv_id
             if self.logger:
-                dt = self.logger.log(message)
-            else:
-                dt = datetime.datetime.now()
+                ts = self.logger.log(message, date=ts, sensor=sensor)
+            self._publish(ts, sensor, float(value), "nvidia" )
             if self.session_manager:
-                self.session_manager.nvidia_sensor(dt, nv_id, float(value) )
+                self.session_manager.nvidia_sensor(ts, nv_id, float(value), energy )
             if self.debug:
                 message = "nvidia: %d : %s" % ( nv_id, value)
                 print(message)
 
-    def emit_g2_power(self, power):
-            message = "%d : %f" % ( self.g2, power)
+    def emit_g2_power(self, g2, power, ts=None):
+            message = "%d : %f" % ( g2, power)
+            sensor = "apu-%02d" % g2
             if self.logger:
-                dt = self.logger.log(message)
-            else:
-                dt = datetime.datetime.now()
+                ts = self.logger.log(message, date=ts, sensor=sensor)
+            elif ts is None:
+                ts = now_ns()
+            self._publish(ts, sensor, power, "g2" )
             if self.session_manager:
-                self.session_manager.g2_sensor(dt, self.g2, power )
+                self.session_manager.g2_sensor(ts, g2, power )
             if self.debug:
-                message = "g2: %d : %f" % ( self.g2, power)
+                message = "g2: %d : %f" % ( g2, power)
                 print(message)
 
     def _sample_g2(self):
         try:
             if self.debug: print("About to call gsi_tool for power...")
 
-            addr = "apu-%02d" % self.g2
-            cmd = "gsi_tool info %s" % addr
-            if self.debug: print("running gsi_tool command:", cmd)
-            stream = os.popen(cmd)
-            outp = stream.read()
-            if self.debug: print("result of cmd=", outp)
-
-            matches = re.findall(GSI_TOOL_POWER_REGEX,outp)
-            if self.debug: print("regex matches:", matches)
-       
-            power = float(matches[0])
-            self.emit_g2_power( power )
+            start = time.perf_counter()
+            readings = self.g2_reader.poll()
+            if self.metrics: self.metrics.observe("ipmicap_g2_read_seconds", time.perf_counter() - start)
+            for g2, power, ts in readings:
+                self.emit_g2_power( g2, power, ts )
 
         except:
+            if self.metrics: self.metrics.error("g2")
             print("Sample g2 power error:", sys.exc_info()[0])
             traceback.print_exc()
 
     def _sample_dcmi_power(self):
+        """
+        This function reads the system power.  In the system mode the
+        current power is the sample and the energy is integrated from the
+        samples.  In the enhanced mode the BMC's average over the rolling
+        window is the sample, and an energy counter advances by the energy
+        since the last fresh reading ( see _dcmi_energy ); a reading the BMC
+        has not updated ( same timestamp and average ) does not advance it.
+        """
         try:
-
             if self.debug: print("About to call dcmi get_power_readings...")
-            rsp = self.connection.get_power_reading(1)
-            if self.debug: 
-                print("get_power_readings called completed.")
-                print('Power Reading')
-                print('  current:   {}'.format(rsp.current_power))
-                print('  minimum:   {}'.format(rsp.minimum_power))
-                print('  maximum:   {}'.format(rsp.maximum_power))
-                print('  average:   {}'.format(rsp.average_power))
-                print('  timestamp: {}'.format(rsp.timestamp))
-                print('  period:    {}'.format(rsp.period))
-                print('  state:     {}'.format(rsp.reading_state))
-               
-            self.emit_dcmi_power(-1, "%d" % rsp.current_power)
+            start = time.perf_counter()
+            attributes = encode_dcmi_period(self.dcmi_period) if self.dcmi_mode == "enhanced" else 0
+            rsp = self.connection.get_power_reading( DCMI_MODES[self.dcmi_mode], attributes )
+            ts = now_ns()
+            if self.metrics: self.metrics.observe("ipmicap_ipmi_read_seconds", time.perf_counter() - start, self.name)
+            if self.debug:
+                print("%s: DCMI power current=%d min=%d max=%d average=%d timestamp=%d period=%d ms state=0x%02x" % \
+                        ( sys.argv[0], rsp.current_power, rsp.minimum_power, rsp.maximum_power, rsp.average_power,
+                          rsp.timestamp, rsp.period, rsp.reading_state ))
+            if not rsp.reading_state & 0x40:
+                raise Exception("ERR: The BMC's power measurement is not active.")
+            self.consec_ipmi_errors = 0
+
+            if self.dcmi_mode != "enhanced":
+                self.emit_dcmi_power( DCMI_RECORD_ID, rsp.current_power, ts )
+                return
+
+            last = self.dcmi_last
+            if last is not None and rsp.timestamp and ( rsp.timestamp, rsp.average_power ) == last[:2]:
+                return
+            if last is not None:
+                self.dcmi_energy += self._dcmi_energy( last, rsp, ts )
+            self.dcmi_last = ( rsp.timestamp, rsp.average_power, ts )
+            self.emit_dcmi_power( DCMI_RECORD_ID, rsp.average_power, ts, self.dcmi_energy )
 
         except:
-            print("Sample dcmi power error:", sys.exc_info()[0])
-            traceback.print_exc()
+            self.consec_ipmi_errors += 1
+            if self.metrics: self.metrics.error("dcmi", self.name)
+            print("Sample dcmi power error:", sys.exc_info()[1])
+            if self.debug: traceback.print_exc()
+            if self.consec_ipmi_errors >= self.max_consec_errors:
+                raise Exception("ERR: Maximum consecutive ipmi errors reached.")
 
-        finally:
-            pass 
+    def _dcmi_energy(self, last, rsp, ts):
+        """
+        This function returns the joules since the last fresh reading.  The
+        time is the difference of the BMC's timestamps ( one second
+        resolution, so the error does not add up over readings ), or of the
+        host's when the BMC gives none or steps back.  The part of it covered
+        by the rolling window is taken at the window's average; the rest, when
+        polling slower than the period, is estimated halfway between the last
+        two averages.
+        """
 
-    def emit_dcmi_power(self, record_id, value):
+        seconds = rsp.timestamp - last[0] if rsp.timestamp and last[0] else -1
+        if seconds < 0:
+            seconds = (ts - last[2]) / 1e9
+        window = min( seconds, rsp.period/1000.0 if rsp.period else self.dcmi_period )
+        return rsp.average_power*window + 0.5*(last[1] + rsp.average_power)*(seconds - window)
+
+    def _publish(self, ts, sensor, value, source="ipmi"):
+        """
+        This function hands a sample ( taken at ts, int64 nanoseconds since
+        the epoch ) to the binary capture, the live stream, the /metrics
+        counters and the rollups.
+        """
+        if self.metrics:
+            self.metrics.sample(source, sensor, value, ts/1e9, self.name)
+        if self.rollups:
+            self.rollups.sample(ts, sensor, value)
+        if self.capture:
+            self.capture.sample(ts, sensor, value)
+        if self.broadcaster:
+            self.broadcaster.publish(ts, sensor, value)
+
+    def emit_dcmi_power(self, record_id, value, ts=None, energy=None):
+        """
+        This function outputs a DCMI power reading, with the energy counter
+        derived from the rolling averages when there is one.
+        """
+        sensor = "%s:%d" % (self.name, record_id) if self.name else "%d" % record_id
         if self.logger:
             message = "%d : %s" % ( record_id, value)
-            dt = self.logger.log(message)
-        elif self.debug:
-            message = "0x%04x | %9s " % (record_id, number, id_string, value, states)
-            print(message)
-        else:
-            dt = datetime.datetime.now()
-
-        if self.session_manager:
-            self.session_manager.sensor(dt, record_id, float(value) )
+            ts = self.logger.log(message, date=ts, sensor=sensor)
+        elif ts is None:
+            ts = now_ns()
+        if self.debug:
+            print("%s: dcmi: %d : %s" % (sys.argv[0], record_id, value))
 
+        self._publish(ts, sensor, float(value), "dcmi" )
+        if self.session_manager and self.name:
+            self.session_manager.sensor(ts, record_id, float(value), node=self.name, energy=energy )
+        elif self.session_manager:
+            self.session_manager.sensor(ts, record_id, float(value), energy=energy )
 
-    def emit_sdr_list_entry(self, record_id, number, id_string, value, states):
+    def emit_sdr_list_entry(self, record_id, number, id_string, value, states, ts=None):
         """This function will output the data associated with a sensor
         either to a logger object or standard output, in a standard format.
+        The sample time ts ( int64 nanoseconds since the epoch ) defaults to now.
         """
 
         if number:
@@ -418,33 +754,143 @@ class IpmiMon:
         else:
             states = 'na'
 
+        sensor = "%s:%d" % (self.name, record_id) if self.name else "%d" % record_id
         if self.logger: 
-            message = "%d : %s" % ( record_id, value)
+            if self.name: message = "%s:%d : %s" % ( self.name, record_id, value)
+            else: message = "%d : %s" % ( record_id, value)
             if self.debug: print("%s: emitting sensor value to logger" % sys.argv[0], message)
-            dt = self.logger.log(message)
+            ts = self.logger.log(message, date=ts, sensor=sensor)
         elif self.debug:
             message = "0x%04x | %3s | %-18s | %9s | %s" % (record_id, number, id_string, value, states)
-            dt = datetime.datetime.now()
-            print(dt, message)
-        else:
-            dt = datetime.datetime.now()
+            if not ts: ts = now_ns()
+            print(ns_to_datetime(ts), message)
+        elif not ts:
+            ts = now_ns()
+
+        self._publish(ts, sensor, float(value) )
+        if self.session_manager and self.name:
+            self.session_manager.sensor(ts, record_id, float(value), node=self.name )
+        elif self.session_manager:
+            self.session_manager.sensor(ts, record_id, float(value) )
+
+def encode_dcmi_period(seconds):
+    """
+    This function encodes a rolling average period for Get Power Reading:
+    the unit ( seconds, minutes, hours, days ) in bits 7:6 and the count
+    in bits 5:0.
+    """
+
+    for unit, size in reversed( list(enumerate(DCMI_UNITS)) ):
+        if seconds % size == 0 and 0 < seconds // size < 64:
+            return (unit << 6) | int(seconds // size)
+    raise Exception("ERR: A DCMI rolling average period of %g s cannot be encoded." % seconds)
+
+def decode_dcmi_period(code):
 
-        if self.session_manager:
-            self.session_manager.sensor(dt, record_id, float(value) )
+    return DCMI_UNITS[code >> 6] * (code & 0x3f)
 
 #
 # To run the unit tests below for the IpmiMon class, type "python ipmimon.py"
+# ( they sample a local simulated BMC, see ipmisim.py )
 #
 if __name__ == "__main__":
 
-    ipmimon = IpmiMon(  ip="192.168.99.61", 
-                        iface="lan", # try also 'lanplus'
-                        username="ADMIN",
-                        password="ADMIN",
-                        records=[5029],
-                        delay=0.05, 
-                        debug=True)
+    from ipmisim import IpmiSimBmc
+    from ipmimetrics import IpmiMetrics
+
+    class Collector:
+        def __init__(self): self.samples = []
+        def sensor(self, ts, sensor_id, value, energy=None): self.samples.append( (ts, sensor_id, value) )
+
+    bmc = IpmiSimBmc( port=0, records=4, latency=0.005 )
+    port = bmc.start()
+
+    for transport, concurrency in [ ("rmcp", 1), ("rmcp", 4) ]:
+        collector = Collector()
+        metrics = IpmiMetrics()
+        ipmimon = IpmiMon(  ip="127.0.0.1",
+                            port=port,
+                            iface="lan",
+                            transport=transport,
+                            username="admin",
+                            password="admin",
+                            records=[1,2,3,4],
+                            session_manager=collector,
+                            concurrency=concurrency,
+                            delay=0.05,
+                            metrics=metrics,
+                            debug=False)
+        ipmimon.connect()
+        ipmimon.get_sensors()
+        for i in range(3):
+            ipmimon._sample_sensors()
+        ipmimon.disconnect()
+
+        assert len(collector.samples) == 12, collector.samples
+        assert sorted(set( s[1] for s in collector.samples )) == [1,2,3,4]
+        assert all( 50 < s[2] < 400 for s in collector.samples )
+        assert all( type(s[0]) is int for s in collector.samples ) and collector.samples[0][0] <= collector.samples[-1][0]
+        assert metrics.counters[ ("ipmicap_samples_total", "ipmi", None) ] == 12
+        assert metrics.histograms[ ("ipmicap_ipmi_read_seconds", None) ].count == 12
+        assert metrics.histograms[ ("ipmicap_sweep_seconds", None) ].count == 3
+        print("%s: %s concurrency=%d sweep %.1f ms" % (sys.argv[0], transport, concurrency, 1000*ipmimon.last_sweep_time))
+
+    # a group of records slower than the period of another does not delay it
+    import threading
+    slow_bmc = IpmiSimBmc( port=0, records=5, latency=0.03 )
+    ipmimon = IpmiMon( ip="127.0.0.1", port=slow_bmc.start(), transport="rmcp", records=[1,2,3,4,5], ipmi_rate=2,
+                       record_rates={ 1: 10 }, session_manager=Collector() )
     ipmimon.connect()
-    #ipmimon.enumerate_sensors()
-    ipmimon.run()
-
+    ipmimon.get_sensors()
+    event = threading.Event()
+    threading.Timer(2.0, event.set).start()
+    ipmimon.run_ipmi(event)
+    ipmimon.disconnect()
+    slow_bmc.stop()
+    stats = ipmimon.schedulers['ipmi'].stats()
+    assert stats["ipmi-1"]["fired"] >= 18 and stats["ipmi-1"]["missed"] <= 1, stats
+    assert stats["ipmi-2,3,4,5"]["overruns"] == 0 and sorted(ipmimon.sweeps.keys()) == [ "ipmi-1", "ipmi-2,3,4,5" ]
+    assert ipmimon.sweeps["ipmi-1"]['total']/ipmimon.sweeps["ipmi-1"]['count'] < 0.075, ipmimon.sweeps
+
+    # DCMI: the energy follows the BMC's rolling averages, read once a second
+    from ipmisession import IpmiSessionManager
+    manager = IpmiSessionManager()
+    ipmimon = IpmiMon( ip="127.0.0.1", port=port, transport="rmcp", dcmi_power=True, dcmi_mode="enhanced",
+                       dcmi_period=1, ipmi_rate=1, session_manager=manager )
+    ipmimon.connect()
+    event = threading.Event()
+    # read half way through the BMC's seconds, so its timestamps step by one
+    time.sleep( (0.5 - time.time()) % 1.0 )
+    threading.Timer(4.5, event.set).start()
+    ipmimon.run_ipmi(event)
+    ipmimon.disconnect()
+    store = manager.stores[DCMI_RECORD_ID]
+    ts, val = store.slice(0, len(store))
+    exact = bmc.energy( ts[0]/1e9, ts[-1]/1e9 )
+    derived = store.energy_at(ts[-1]) - store.energy_at(ts[0])
+    assert len(ts) == 5 and store.counter and abs(derived - exact) < 0.005*exact, (len(ts), derived, exact)
+    print("%s: dcmi energy from rolling averages %.1f J, exact %.1f J" % (sys.argv[0], derived, exact))
+
+    # the energy follows the BMC's timestamps, the host's without them, with gaps between windows estimated
+    class Reading:
+        def __init__(self, timestamp, average, period): self.timestamp, self.average_power, self.period = timestamp, average, period
+    assert ipmimon._dcmi_energy( (100, 500, 0), Reading(102, 600, 2000), 1.7e9 ) == 1200.0
+    assert ipmimon._dcmi_energy( (100, 500, 0), Reading(105, 600, 2000), 1.7e9 ) == 1200.0 + 3*550.0
+    assert ipmimon._dcmi_energy( (0, 500, 0), Reading(0, 600, 2000), 1.5e9 ) == 900.0
+    assert ipmimon._dcmi_energy( (100, 500, 0), Reading(99, 600, 2000), 0.5e9 ) == 300.0
+
+    # the system statistics give the current power, a rolling period must be one the BMC has
+    ipmimon = IpmiMon( ip="127.0.0.1", port=port, transport="rmcp", dcmi_power=True, session_manager=collector )
+    ipmimon.connect()
+    ipmimon._sample_dcmi_power()
+    ipmimon.disconnect()
+    assert collector.samples[-1][1] == DCMI_RECORD_ID and 500 < collector.samples[-1][2] < 1500
+    try:
+        IpmiMon( ip="127.0.0.1", port=port, transport="rmcp", dcmi_power=True, dcmi_mode="enhanced", dcmi_period=3 ).connect()
+        assert False
+    except Exception as e:
+        assert "no DCMI rolling average of 3 s" in str(e), e
+    assert [ decode_dcmi_period(encode_dcmi_period(p)) for p in ( 1, 63, 120, 7200 ) ] == [ 1, 63, 120, 7200 ]
+
+    bmc.stop()
+    print("%s: all tests passed" % sys.argv[0])
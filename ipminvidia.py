@@ -0,0 +1,185 @@
+import sys
+import os
+import time
+import queue
+import threading
+import subprocess
+from ipmistore import now_ns
+
+#
+# configuration
+#
+NVIDIA_SMI_QUERY = "index,power.draw"
+
+class NvidiaSmiReader:
+    """
+    This class keeps one 'nvidia-smi --loop-ms' process open for the whole
+    capture, instead of starting nvidia-smi for every sample.  A reader thread
+    parses the CSV lines as they are printed and queues them with the time each
+    line was read.  poll() returns the readings received since the last call.
+    """
+
+    def __init__(self, cmd="nvidia-smi", loop_ms=100, debug=False):
+
+        self.cmd        = cmd
+        self.loop_ms    = max(1, int(loop_ms))
+        self.debug      = debug
+        self.process    = None
+        self.thread     = None
+        self.readings   = queue.Queue()
+        self.errors     = 0
+
+    def start(self):
+
+        args = [ self.cmd, "--query-gpu=%s" % NVIDIA_SMI_QUERY,
+                 "--format=csv,noheader,nounits", "--loop-ms=%d" % self.loop_ms ]
+        if self.debug: print("running nvidia-smi command", " ".join(args))
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE, text=True, bufsize=1)
+        self.thread = threading.Thread(target=self._reader_loop, args=(self.process,), name="NvidiaSmiReader", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+
+        if self.process:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def poll(self):
+        """
+        This function returns a list of (gpu index, watts, joules, ts) readings
+        received since the last call.  nvidia-smi does not report an energy
+        counter, so joules is always None.  A reader that has exited is restarted.
+        """
+
+        if self.process is None or self.process.poll() is not None:
+            if self.process is not None:
+                print("%s: nvidia-smi exited with %s, restarting" % (sys.argv[0], self.process.returncode))
+                self.stop()
+            self.start()
+
+        readings = []
+        while True:
+            try:
+                readings.append( self.readings.get_nowait() )
+            except queue.Empty:
+                break
+        return readings
+
+    def _reader_loop(self, process):
+
+        for line in process.stdout:
+            ts = now_ns()
+            try:
+                fields = [ f.strip() for f in line.split(",") ]
+                if len(fields) < 2 or not fields[0]:
+                    continue
+                self.readings.put( (int(fields[0]), float(fields[1].split()[0]), None, ts) )
+            except:
+                # e.g. "[N/A]" or "[Not Supported]" for power.draw
+                self.errors += 1
+                if self.debug: print("nvidia-smi: could not parse", repr(line))
+
+class NvmlReader:
+    """
+    This class reads GPU power through an NVML binding ( the 'pynvml' module,
+    imported only when this reader is used ).  NVML is initialized once, so a
+    read is a couple of driver calls.  When the GPU has a cumulative energy
+    counter ( Volta and later ) it is returned with each reading, so that
+    energy can be taken from hardware deltas instead of integrating power.
+    """
+
+    def __init__(self, debug=False):
+
+        self.debug      = debug
+        self.nvml       = None
+        self.handles    = []
+        self.has_energy = []
+
+    def start(self):
+
+        import pynvml
+        self.nvml = pynvml
+        self.nvml.nvmlInit()
+        count = self.nvml.nvmlDeviceGetCount()
+        self.handles = [ self.nvml.nvmlDeviceGetHandleByIndex(i) for i in range(count) ]
+        self.has_energy = []
+        for handle in self.handles:
+            try:
+                self.nvml.nvmlDeviceGetTotalEnergyConsumption(handle)
+                self.has_energy.append(True)
+            except self.nvml.NVMLError:
+                self.has_energy.append(False)
+        if self.debug: print("nvml: %d GPU(s), energy counters" % count, self.has_energy)
+
+    def stop(self):
+
+        if self.nvml:
+            self.nvml.nvmlShutdown()
+            self.nvml = None
+
+    def poll(self):
+        """
+        This function returns a list of (gpu index, watts, joules, ts) readings,
+        with joules None when the GPU has no energy counter.
+        """
+
+        if self.nvml is None:
+            self.start()
+
+        readings = []
+        for index, handle in enumerate(self.handles):
+            power = self.nvml.nvmlDeviceGetPowerUsage(handle) / 1000.0
+            energy = None
+            if self.has_energy[index]:
+                energy = self.nvml.nvmlDeviceGetTotalEnergyConsumption(handle) / 1000.0
+            readings.append( (index, power, energy, now_ns()) )
+        return readings
+
+#
+# To run the unit tests below, type "python ipminvidia.py"
+# ( they use tests/fake_nvidia_smi.py and a stubbed pynvml module )
+#
+if __name__ == "__main__":
+
+    import types
+
+    fake = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "fake_nvidia_smi.py")
+    os.environ["FAKE_NVIDIA_SMI_GPUS"] = "2"
+    reader = NvidiaSmiReader(cmd=fake, loop_ms=20)
+    assert reader.poll() == []
+    time.sleep(0.5)
+    readings = reader.poll()
+    reader.stop()
+    assert len(readings) >= 10, readings
+    assert set( r[0] for r in readings ) == {0, 1}
+    assert all( r[1] > 0 and r[2] is None for r in readings )
+    assert readings[-1][3] >= readings[0][3]
+
+    class NVMLError(Exception): pass
+    stub = types.ModuleType("pynvml")
+    stub.NVMLError = NVMLError
+    stub.energy = [ 1000000, None ]
+    stub.nvmlInit = lambda: None
+    stub.nvmlShutdown = lambda: None
+    stub.nvmlDeviceGetCount = lambda: 2
+    stub.nvmlDeviceGetHandleByIndex = lambda i: i
+    stub.nvmlDeviceGetPowerUsage = lambda h: 250000 + h
+    def energy(h):
+        if stub.energy[h] is None: raise NVMLError()
+        stub.energy[h] += 25000
+        return stub.energy[h]
+    stub.nvmlDeviceGetTotalEnergyConsumption = energy
+    sys.modules["pynvml"] = stub
+
+    reader = NvmlReader()
+    first = reader.poll()
+    second = reader.poll()
+    reader.stop()
+    assert first[0][1] == 250.0 and first[1][1] == 250.001
+    assert second[0][2] - first[0][2] == 25.0 and second[1][2] is None
+
+    print("%s: all tests passed" % sys.argv[0])
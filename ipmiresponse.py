@@ -0,0 +1,256 @@
+import sys
+import json
+import struct
+import numpy as np
+
+#
+# configuration
+#
+FORMATS = {     "json"      : "application/json",
+                "msgpack"   : "application/msgpack",
+                "binary"    : "application/octet-stream" }
+ACCEPT_TYPES = {    "application/json"          : "json",
+                    "application/msgpack"       : "msgpack",
+                    "application/x-msgpack"     : "msgpack",
+                    "application/octet-stream"  : "binary" }
+DOWNSAMPLE_METHODS = [ "lttb", "minmax" ]
+BINARY_MAGIC = b"IPMISTAT"
+CHUNK_SIZE = 64*1024
+JSON_BLOCK = 1024         # values encoded per json.dumps call
+
+def negotiate(accept=None, fmt=None):
+    """
+    This function picks the response format from a 'format' request argument
+    or else from the Accept header, defaulting to json.  The media types of
+    the header are tried by decreasing q value ( in header order when equal ),
+    and those with q=0 are refused.  It returns None when nothing acceptable
+    is available ( msgpack needs the 'msgpack' module. )
+    """
+
+    if fmt:
+        choices = [ fmt ] if fmt in FORMATS else []
+    else:
+        weighted = []
+        for item in (accept or "").split(","):
+            params = item.split(";")
+            media = params[0].strip().lower()
+            q = 1.0
+            for param in params[1:]:
+                key, _, value = param.partition("=")
+                if key.strip().lower() == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            if q <= 0: continue
+            if media in ACCEPT_TYPES: weighted.append( ( q, ACCEPT_TYPES[media] ) )
+            elif media in ( "*/*", "application/*", "" ): weighted.append( ( q, "json" ) )
+        choices = [ choice for q, choice in sorted( weighted, key=lambda w: -w[0] ) ]
+        if not choices: choices = [ "json" ] if not accept else []
+
+    for choice in choices:
+        if choice == "msgpack":
+            try:
+                import msgpack
+            except ImportError:
+                continue
+        return choice
+    return None
+
+def lttb(ts, val, n):
+    """
+    This function downsamples a series to n points with the Largest Triangle
+    Three Buckets algorithm, which keeps the points that shape a plot.  The
+    first and last points are always kept.
+    """
+
+    if n >= len(ts) or n < 3:
+        return ts, val
+
+    edges = np.linspace(1, len(ts)-1, n-1).astype(np.int64)
+    keep = np.empty(n, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = len(ts)-1
+    a = 0
+    for i in range(n-2):
+        lo, hi = edges[i], edges[i+1]
+        # the average of the next bucket is the third corner of the triangle
+        nlo, nhi = edges[i+1], ( edges[i+2] if i+2 < len(edges) else len(ts) )
+        cx, cy = ts[nlo:nhi].mean(), val[nlo:nhi].mean()
+        area = np.abs( (ts[a] - cx)*(val[lo:hi] - val[a]) - (ts[a] - ts[lo:hi])*(cy - val[a]) )
+        a = lo + int(np.argmax(area))
+        keep[i+1] = a
+    return ts[keep], val[keep]
+
+def minmax(ts, val, n):
+    """
+    This function downsamples a series to at most n equal time buckets and
+    returns the bucket start times with the min, mean and max of each bucket.
+    Empty buckets are dropped.
+    """
+
+    if len(ts) == 0:
+        return ts, val, val, val
+    edges = np.linspace(ts[0], ts[-1], n+1)
+    bucket = np.clip( np.searchsorted(edges, ts, side='right') - 1, 0, n-1 )
+    counts = np.bincount(bucket, minlength=n)
+    used = counts > 0
+    mins = np.full(n, np.inf)
+    maxs = np.full(n, -np.inf)
+    np.minimum.at(mins, bucket, val)
+    np.maximum.at(maxs, bucket, val)
+    means = np.bincount(bucket, weights=val, minlength=n)[used] / counts[used]
+    return edges[:-1][used], mins[used], means, maxs[used]
+
+def downsample(per_sensor, n, method="lttb"):
+    """
+    This function downsamples every sensor of a session's per_sensor arrays
+    ( [seconds, values] ) to about n points.  'minmax' gives [seconds, min,
+    mean, max] columns instead.
+    """
+
+    if method not in DOWNSAMPLE_METHODS:
+        raise Exception("ERR: Unknown downsampling method '%s'." % method)
+
+    result = {}
+    for sensor_id, (cdt, val) in per_sensor.items():
+        cdt, val = np.asarray(cdt, dtype=np.float64), np.asarray(val, dtype=np.float64)
+        if method == "lttb": result[sensor_id] = list( lttb(cdt, val, n) )
+        else: result[sensor_id] = list( minmax(cdt, val, n) )
+    return result
+
+def encode(stats, fmt="json"):
+    """
+    This function encodes the stats of a stopped session and returns the
+    body and its content type.
+
+        json        per_sensor columns as lists of numbers ( as before )
+        msgpack     the same map, with each per_sensor column packed as
+                    little-endian float64 bytes
+        binary      BINARY_MAGIC, a uint32 length and a JSON header ( the
+                    stats without per_sensor, plus the id and length of each
+                    sensor's columns ), then every column as little-endian
+                    float64, sensor by sensor, in header order
+    """
+
+    if not isinstance(stats, dict):
+        return json.dumps(stats).encode(), FORMATS["json"]
+
+    summary = dict( (k, v) for k, v in stats.items() if k != "per_sensor" )
+    summary = json.loads( json.dumps(summary) )    # sensor ids become strings in every format
+    columns = dict( (str(k), [ np.asarray(c, dtype='<f8') for c in v ]) for k, v in stats.get("per_sensor", {}).items() )
+
+    if fmt == "json":
+        # the same text as json.dumps of the whole map, built a block of values
+        # at a time so other threads ( the IOLoop ) get the GIL in between
+        body = bytearray( json.dumps(summary)[:-1].encode() )
+        body += b', "per_sensor": {' if summary else b'"per_sensor": {'
+        for i, (k, v) in enumerate(columns.items()):
+            body += ( (", " if i else "") + json.dumps(k) + ": [" ).encode()
+            for j, c in enumerate(v):
+                if j: body += b", "
+                _json_column(body, c)
+            body += b"]"
+        body += b"}}"
+        return bytes(body), FORMATS["json"]
+
+    if fmt == "msgpack":
+        import msgpack
+        summary["per_sensor"] = dict( (k, [ c.tobytes() for c in v ]) for k, v in columns.items() )
+        return msgpack.packb(summary, use_bin_type=True), FORMATS["msgpack"]
+
+    if fmt == "binary":
+        summary["sensors"] = [ { "id": k, "columns": len(v), "length": len(v[0]) if v else 0 } for k, v in columns.items() ]
+        header = json.dumps(summary).encode()
+        parts = [ BINARY_MAGIC, struct.pack("<I", len(header)), header ]
+        for v in columns.values():
+            parts.extend( c.tobytes() for c in v )
+        return b"".join(parts), FORMATS["binary"]
+
+    raise Exception("ERR: Unknown response format '%s'." % fmt)
+
+def _json_column(body, column):
+
+    body += b"["
+    for i in range(0, len(column), JSON_BLOCK):
+        if i: body += b", "
+        body += json.dumps( column[i:i+JSON_BLOCK].tolist() )[1:-1].encode()
+    body += b"]"
+
+def decode_binary(body):
+    """
+    This function decodes a 'binary' response into the stats dict, with the
+    per_sensor columns as NumPy arrays.
+    """
+
+    if body[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise Exception("ERR: Not a binary session response.")
+    offset = len(BINARY_MAGIC)
+    size = struct.unpack("<I", body[offset:offset+4])[0]
+    offset += 4
+    stats = json.loads( body[offset:offset+size] )
+    offset += size
+    stats["per_sensor"] = {}
+    for sensor in stats.pop("sensors"):
+        columns = []
+        for i in range(sensor["columns"]):
+            columns.append( np.frombuffer(body, dtype='<f8', count=sensor["length"], offset=offset) )
+            offset += 8*sensor["length"]
+        stats["per_sensor"][sensor["id"]] = columns
+    return stats
+
+#
+# To run the unit tests below, type "python ipmiresponse.py"
+#
+if __name__ == "__main__":
+
+    assert negotiate() == "json" and negotiate("*/*") == "json"
+    assert negotiate("application/octet-stream, application/json;q=0.5") == "binary"
+    assert negotiate("text/html", "binary") == "binary" and negotiate("text/html") is None
+    assert negotiate(fmt="xml") is None
+    assert negotiate("application/json;q=0.1, application/octet-stream") == "binary"
+    assert negotiate("application/octet-stream;q=0, */*;q=0.2") == "json"
+    assert negotiate("application/octet-stream;q=0") is None
+
+    ts = np.linspace(0, 100, 10001)
+    val = np.sin(ts) * 100 + 200
+    val[5000] = 1000.0
+    lts, lval = lttb(ts, val, 200)
+    assert len(lts) == 200 and lts[0] == 0 and lts[-1] == 100 and 1000.0 in lval
+    assert np.all( np.diff(lts) > 0 )
+
+    bts, bmin, bmean, bmax = minmax(ts, val, 50)
+    assert len(bts) == 50 and bmax.max() == 1000.0 and abs(bmin.min() - val.min()) < 1e-9
+    assert np.all( (bmin <= bmean) & (bmean <= bmax) )
+
+    stats = { "per_sensor": { 18: [ ts, val ], "nvidia-0": [ ts[:3], val[:3] ] },
+              "tot_power": 1.5, "powers": { 18: 1.0, "nvidia-0": 0.5 }, "nodes": {},
+              "start_time": "2021-06-02 22:00:00", "end_time": "2021-06-02 22:01:40" }
+    body, ctype = encode(stats, "json")
+    decoded = json.loads(body)
+    assert ctype == "application/json" and decoded["per_sensor"]["18"][1][5000] == 1000.0
+    assert decoded["powers"] == { "18": 1.0, "nvidia-0": 0.5 }
+    plain = dict( (k, v) for k, v in stats.items() if k != "per_sensor" )
+    plain["per_sensor"] = dict( (str(k), [ c.tolist() for c in v ]) for k, v in stats["per_sensor"].items() )
+    assert body == json.dumps(plain).encode()
+    JSON_BLOCK = 1000
+    assert encode(stats, "json")[0] == json.dumps(plain).encode()
+    assert encode( { "per_sensor": {} } )[0] == b'{"per_sensor": {}}'
+
+    body, ctype = encode(stats, "binary")
+    assert len(body) < len( encode(stats, "json")[0] )
+    decoded = decode_binary(body)
+    assert np.array_equal( decoded["per_sensor"]["18"][1], val ) and decoded["tot_power"] == 1.5
+
+    small = downsample( stats["per_sensor"], 100, "minmax" )
+    assert len(small[18]) == 4 and len(small[18][0]) == 100 and len(small["nvidia-0"][0]) == 3
+
+    try:
+        import msgpack
+        body, ctype = encode(stats, "msgpack")
+        decoded = msgpack.unpackb(body)
+        assert np.array_equal( np.frombuffer(decoded["per_sensor"]["18"][1], dtype='<f8'), val )
+    except ImportError:
+        print("%s: msgpack not installed, skipping its test" % sys.argv[0])
+
+    print("%s: all tests passed" % sys.argv[0])
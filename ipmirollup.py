@@ -0,0 +1,404 @@
+import sys
+import math
+import threading
+import numpy as np
+from ipmistore import now_ns, to_ns, ns_to_datetime
+
+#
+# configuration
+#
+ROLLUP_TIERS = [ (1, 3600), (10, 86400), (60, 30*86400) ]    # ( bucket seconds, seconds kept )
+ROLLUP_POINTS = 1000        # the most buckets per sensor a query returns by default
+MAX_GAP = 60.0              # seconds without samples not integrated over
+FIELDS = [ "ts", "count", "sum", "min", "max", "energy" ]
+
+class IpmiRollupTier:
+    """
+    This class holds the closed buckets of one resolution in a ring buffer:
+    one row of FIELDS per bucket, 'ts' being the start of the bucket in
+    seconds since the epoch.  The buffer grows by doubling up to 'capacity'
+    rows and then overwrites the oldest, so a tier never holds more than
+    its retention.
+    """
+
+    def __init__(self, seconds, retention):
+
+        self.seconds    = seconds
+        self.retention  = retention
+        self.capacity   = max(1, int(math.ceil(retention / seconds)))
+        self.data       = np.empty( (min(self.capacity, 64), len(FIELDS)) )
+        self.head       = 0         # the row the next bucket goes to
+        self.size       = 0
+
+    def push(self, row):
+
+        if self.size == len(self.data) and self.size < self.capacity:
+            grown = np.empty( (min(2*len(self.data), self.capacity), len(FIELDS)) )
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+            self.head = self.size
+        self.data[self.head] = row
+        self.head = (self.head + 1) % len(self.data)
+        self.size = min(self.size + 1, len(self.data))
+
+    def rows(self, t0=None, t1=None):
+        """
+        This function returns a copy of the buckets overlapping [t0, t1],
+        oldest first.
+        """
+
+        if self.size < len(self.data):
+            rows = self.data[:self.size]
+        else:
+            rows = np.concatenate( (self.data[self.head:], self.data[:self.head]) )
+        ts = rows[:,0]
+        lo = 0 if t0 is None else int(np.searchsorted(ts, t0 - self.seconds, side='right'))
+        hi = len(rows) if t1 is None else int(np.searchsorted(ts, t1, side='right'))
+        return rows[lo:hi].copy()
+
+class IpmiSensorRollup:
+    """
+    This class rolls up the samples of one sensor into the tiers.
+
+    Each tier has one open bucket ( a list of FIELDS ).  A sample updates
+    the open bucket of the finest tier only; when a bucket closes it is
+    pushed to its tier and added into the open bucket of the next coarser
+    one, so the cost per sample does not grow with the number of tiers.
+    The energy of the trapezoid between two samples is split between the
+    buckets at their boundaries.
+    """
+
+    def __init__(self, tiers=ROLLUP_TIERS, max_gap=MAX_GAP):
+
+        self.tiers      = [ IpmiRollupTier(seconds, retention) for seconds, retention in tiers ]
+        self.open       = [ None ] * len(self.tiers)
+        self.max_gap    = max_gap
+        self.last_t     = None
+        self.last_v     = None
+        self.lock       = threading.Lock()
+
+    def add(self, t, v):
+        """
+        This function adds a sample taken at t seconds since the epoch.
+        Samples older than the last one are ignored.
+        """
+
+        last_t, last_v = self.last_t, self.last_v
+        if last_t is not None and t < last_t:
+            return
+        seconds = self.tiers[0].seconds
+        start = math.floor(t / seconds) * seconds
+        bucket = self.open[0]
+
+        if bucket is not None and last_t is not None and t - last_t <= self.max_gap:
+            # the trapezoid from the last sample, split at the bucket boundaries
+            while bucket[0] < start:
+                end = bucket[0] + seconds
+                v_end = last_v + (v - last_v) * (end - last_t) / (t - last_t)
+                bucket[5] += (last_v + v_end) * 0.5 * (end - last_t)
+                last_t, last_v = end, v_end
+                self._close(0)
+                bucket = self.open[0] = [ end, 0, 0.0, math.nan, math.nan, 0.0 ]
+            bucket[5] += (last_v + v) * 0.5 * (t - last_t)
+        elif bucket is not None and bucket[0] < start:
+            self._close(0)
+            bucket = None
+
+        if bucket is None:
+            bucket = self.open[0] = [ start, 0, 0.0, v, v, 0.0 ]
+        bucket[1] += 1
+        bucket[2] += v
+        if not v >= bucket[3]: bucket[3] = v       # also replaces the NaN of an empty bucket
+        if not v <= bucket[4]: bucket[4] = v
+        self.last_t, self.last_v = t, v
+
+    def _close(self, level):
+
+        bucket = self.open[level]
+        self.tiers[level].push(bucket)
+        self.open[level] = None
+        if level + 1 == len(self.tiers):
+            return
+        seconds = self.tiers[level+1].seconds
+        start = math.floor(bucket[0] / seconds) * seconds
+        coarse = self.open[level+1]
+        if coarse is not None and coarse[0] < start:
+            self._close(level+1)
+            coarse = None
+        if coarse is None:
+            self.open[level+1] = [ start ] + bucket[1:]
+            return
+        self._merge(coarse, bucket)
+
+    def _merge(self, into, bucket):
+
+        into[1] += bucket[1]
+        into[2] += bucket[2]
+        into[5] += bucket[5]
+        if bucket[1]:
+            into[3] = bucket[3] if not into[1] - bucket[1] else min(into[3], bucket[3])
+            into[4] = bucket[4] if not into[1] - bucket[1] else max(into[4], bucket[4])
+
+    def rows(self, level, t0=None, t1=None):
+        """
+        This function returns the buckets of a tier overlapping [t0, t1],
+        followed by the partial buckets of the open buckets of the tier and
+        the finer ones ( which may already belong to a newer bucket of the
+        tier ), so recent samples are always included.
+        """
+
+        rows = self.tiers[level].rows(t0, t1)
+        seconds = self.tiers[level].seconds
+        partials = {}
+        for finer in range(level, -1, -1):
+            bucket = self.open[finer]
+            if bucket is None:
+                continue
+            start = math.floor(bucket[0] / seconds) * seconds
+            partial = partials.get(start)
+            if partial is None:
+                partial = partials[start] = [ start, 0, 0.0, math.nan, math.nan, 0.0 ]
+            self._merge(partial, bucket)
+        partials = [ partial for start, partial in sorted(partials.items()) if partial[1]
+                     and ( t0 is None or start > t0 - seconds ) and ( t1 is None or start <= t1 ) ]
+        if partials:
+            rows = np.concatenate( (rows, partials) )
+        return rows
+
+class IpmiRollups:
+    """
+    This class keeps the tiered rollups of every sensor ( e.g. 1 s buckets
+    for an hour, 10 s buckets for a day and 1 min buckets for a month ), so
+    long range queries and dashboards read a bounded number of buckets
+    instead of raw samples.  Each bucket holds the count, sum, min, max and
+    trapezoid energy of the samples in it.  Memory is bounded by the
+    retention of the tiers: about 50 bytes per bucket kept, per sensor.
+
+    sample() is called by the sampling threads, query() by the http
+    handlers.  The registry of sensors is copy-on-write, and each sensor has
+    its own lock.
+    """
+
+    def __init__(self, tiers=ROLLUP_TIERS, max_gap=MAX_GAP):
+
+        self.tiers      = sorted(tiers)
+        self.max_gap    = max_gap
+        self.sensors    = {}
+        self.lock       = threading.Lock()
+        for (finer, _), (coarser, _) in zip(self.tiers[:-1], self.tiers[1:]):
+            if coarser % finer:
+                raise Exception("ERR: Rollup tier of %g s is not a multiple of %g s." % (coarser, finer))
+
+    def sample(self, ts, sensor, value):
+
+        rollup = self.sensors.get(sensor)
+        if rollup is None:
+            with self.lock:
+                rollup = self.sensors.get(sensor)
+                if rollup is None:
+                    rollup = IpmiSensorRollup(self.tiers, self.max_gap)
+                    sensors = dict(self.sensors)
+                    sensors[sensor] = rollup
+                    self.sensors = sensors
+        t = to_ns(ts) / 1e9
+        with rollup.lock:
+            rollup.add(t, value)
+
+    def buckets(self):
+        """
+        This function returns the number of closed buckets held in memory.
+        """
+
+        return sum( tier.size for rollup in self.sensors.values() for tier in rollup.tiers )
+
+    def level(self, start, end, resolution=None, points=ROLLUP_POINTS, now=None):
+        """
+        This function picks the tier for a query: the one of the given
+        resolution, else the finest that still holds start and returns at
+        most 'points' buckets, else the coarsest.
+        """
+
+        if resolution is not None:
+            for i, (seconds, retention) in enumerate(self.tiers):
+                if seconds == resolution:
+                    return i
+            raise Exception("ERR: No rollup tier of %g s." % resolution)
+        for i, (seconds, retention) in enumerate(self.tiers):
+            if ( now is None or now - retention <= start ) and (end - start) / seconds <= points:
+                return i
+        return len(self.tiers) - 1
+
+    def query(self, start, end, sensors=None, resolution=None, points=ROLLUP_POINTS, now=None):
+        """
+        This function returns the buckets of each sensor ( of the given
+        sensors, all if None ) between two times, with totals:
+
+            { "resolution": 10, "start": ..., "end": ...,
+              "sensors": { "18": { "ts": [ ... ], "count": [ ... ], "mean": [ ... ],
+                                   "min": [ ... ], "max": [ ... ], "energy": [ ... ],
+                                   "total": { "count": n, "energy": j, "mean": w, "min": w, "max": w } } } }
+
+        The totals are over whole buckets, so the window is rounded out to
+        the resolution.
+        """
+
+        t0, t1 = to_ns(start) / 1e9, to_ns(end) / 1e9
+        level = self.level( t0, t1, resolution, points, None if now is None else to_ns(now) / 1e9 )
+        result = { "resolution": self.tiers[level][0], "start": str(ns_to_datetime(to_ns(start))),
+                   "end": str(ns_to_datetime(to_ns(end))), "sensors": {} }
+        for sensor, rollup in self.sensors.items():
+            if sensors is not None and str(sensor) not in sensors:
+                continue
+            with rollup.lock:
+                rows = rollup.rows(level, t0, t1)
+            if not len(rows):
+                continue
+            ts, count, total, low, high, energy = rows.T
+            filled = count > 0
+            result["sensors"][str(sensor)] = {
+                "ts"        : ts.tolist(),
+                "count"     : count.astype(np.int64).tolist(),
+                "mean"      : _nulls( np.where(filled, total / np.where(filled, count, 1), np.nan) ),
+                "min"       : _nulls(low),
+                "max"       : _nulls(high),
+                "energy"    : energy.tolist(),
+                "total"     : { "count"     : int(count.sum()),
+                                "energy"    : float(energy.sum()),
+                                "mean"      : float(total.sum() / count.sum()) if filled.any() else None,
+                                "min"       : float(low[filled].min()) if filled.any() else None,
+                                "max"       : float(high[filled].max()) if filled.any() else None } }
+        return result
+
+def _nulls(values):
+    """
+    This function returns a list of the values with None for NaN ( JSON has no NaN. )
+    """
+
+    return [ None if v != v else v for v in values.tolist() ]
+
+def rollup_handlers(rollups, parse_time):
+    """
+    This function returns the tornado route for the /rollup endpoint.
+    parse_time reads the 'start' and 'end' arguments.
+    """
+
+    import json
+    import tornado.web
+
+    class RollupHandler(tornado.web.RequestHandler):
+        """Serves the rollups of the sensors"""
+        def initialize(self, rollups):
+            self.rollups = rollups
+
+        def get(self):
+            try:
+                now = now_ns()
+                end = self.get_argument("end", None)
+                end = to_ns(parse_time(end)) if end else now
+                seconds = self.get_argument("seconds", None)
+                start = end - int(float(seconds)*1e9) if seconds else to_ns(parse_time(self.get_argument("start")))
+                sensors = self.get_argument("sensors", None)
+                resolution = self.get_argument("resolution", None)
+                result = self.rollups.query( start, end, sensors=sensors.split(",") if sensors else None,
+                                             resolution=float(resolution) if resolution else None,
+                                             points=int(self.get_argument("points", ROLLUP_POINTS)), now=now )
+            except:
+                self.set_status(400)
+                self.write(json.dumps({ "error": str(sys.exc_info()[1]) }))
+                return
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps(result))
+
+    return [    (r"/rollup", RollupHandler, {'rollups':rollups} ) ]
+
+#
+# To run the unit tests below, type "python ipmirollup.py"
+#
+if __name__ == "__main__":
+
+    import time
+    import datetime
+    from ipmistore import IpmiSampleStore, datetime_to_ns
+
+    # the open buckets of the finer tiers that belong to a newer coarse bucket are included
+    rollup = IpmiSensorRollup( tiers=[ (1, 100), (10, 1000) ] )
+    for t in ( 0.5, 5.5, 9.5, 10.2, 10.7 ):
+        rollup.add(t, 100.0)
+    rows = rollup.rows(1)
+    assert [ (r[0], r[1]) for r in rows ] == [ (0, 3), (10, 2) ], rows
+    assert abs(rows[:,5].sum() - 100.0*10.2) < 1e-9 and abs(rollup.rows(0)[:,5].sum() - 100.0*10.2) < 1e-9
+    assert [ r[0] for r in rollup.rows(1, 10.5, 20) ] == [ 10 ] and [ r[0] for r in rollup.rows(1, 0, 5) ] == [ 0 ]
+
+    # two hours at 20 Hz, with a 5 minute outage
+    rollups = IpmiRollups( tiers=[ (1, 600), (10, 3600), (60, 86400) ] )
+    store = IpmiSampleStore()
+    t0 = datetime.datetime(2021,6,2,22,0,0)
+    rng = np.random.default_rng(0)
+    n = 2*3600*20
+    values = 200.0 + 50.0*np.sin(np.arange(n)/500.0) + rng.normal(0, 5, n)
+    start = time.perf_counter()
+    for i in range(n):
+        if 60*60*20 <= i < 65*60*20:
+            continue
+        dt = t0 + datetime.timedelta(microseconds=i*50000)
+        rollups.sample( dt, "18", values[i] )
+        store.append( datetime_to_ns(dt), values[i] )
+    per_sample = (time.perf_counter() - start) / n
+    last_ns = datetime_to_ns(dt)
+    gap = [ datetime_to_ns( t0 + datetime.timedelta(microseconds=i*50000) ) for i in ( 60*60*20-1, 65*60*20 ) ]
+    rollup = rollups.sensors["18"]
+
+    # memory is bounded by the retention of each tier
+    assert [ t.size for t in rollup.tiers ] == [ 600, 360, 114 ], [ t.size for t in rollup.tiers ]
+
+    # each tier adds up to the same totals, and to the trapezoid over the samples
+    epoch = datetime_to_ns(t0) / 1e9
+    for level, (seconds, retention) in enumerate(rollups.tiers):
+        rows = rollup.rows(level)
+        ts, count, total, low, high, energy = rows.T
+        since = ts[0]
+        exact = store.energy_at( last_ns ) - store.energy_at( int(since*1e9) )
+        if since < epoch + 3600:
+            exact -= store.energy_at( gap[1] ) - store.energy_at( gap[0] )
+        assert abs( energy.sum() - exact ) < 1e-6*exact, (level, energy.sum(), exact)
+        first = int(round((since - epoch)*20))
+        kept = np.r_[ values[first:60*60*20], values[65*60*20:] ] if first < 60*60*20 else values[first:]
+        assert count.sum() == len(kept) and abs( total.sum() - kept.sum() ) < 1e-6*kept.sum()
+        assert np.nanmax(high) == kept.max() and np.nanmin(low) == kept.min()
+        assert (np.diff(ts) > 0).all()
+
+    # a coarse bucket is the sum of the fine buckets in it
+    fine, coarse = rollup.rows(0), rollup.rows(1)
+    for row in coarse[-5:]:
+        inside = fine[ (fine[:,0] >= row[0]) & (fine[:,0] < row[0] + 10) ]
+        if len(inside) == 10:
+            assert inside[:,1].sum() == row[1] and abs(inside[:,5].sum() - row[5]) < 1e-6
+            assert inside[:,3].min() == row[3] and inside[:,4].max() == row[4]
+
+    # the outage is not integrated over, and its buckets are absent
+    outage = coarse[ (coarse[:,0] >= epoch + 3610) & (coarse[:,0] < epoch + 3890) ]
+    assert len(outage) == 0 and (coarse[:,1] > 0).all()
+
+    # queries pick a tier by range and retention
+    end = t0 + datetime.timedelta(hours=2)
+    now = end
+    result = rollups.query( end - datetime.timedelta(minutes=5), end, now=now )
+    assert result["resolution"] == 1 and len(result["sensors"]["18"]["ts"]) in ( 300, 301 ), len(result["sensors"]["18"]["ts"])
+    result = rollups.query( end - datetime.timedelta(minutes=30), end, now=now )
+    assert result["resolution"] == 10
+    result = rollups.query( t0, end, now=now, points=100 )
+    assert result["resolution"] == 60 and len(result["sensors"]["18"]["ts"]) == 115
+    totals = result["sensors"]["18"]["total"]
+    exact = store.energy_at(last_ns) - store.energy_at(gap[1]) + store.energy_at(gap[0]) - store.energy_at(datetime_to_ns(t0))
+    assert totals["count"] == n - 5*60*20 and abs(totals["energy"] - exact) < 1e-6*exact
+    assert totals["max"] == np.r_[ values[:72000], values[78000:] ].max()
+    assert rollups.query( t0, end, sensors=["19"] )["sensors"] == {}
+    try:
+        rollups.query( t0, end, resolution=5 )
+        assert False
+    except Exception as e:
+        assert "No rollup tier" in str(e)
+
+    print("%s: %.2f us per sample, %d buckets held" % (sys.argv[0], per_sample*1e6, rollups.buckets()))
+    assert per_sample < 50e-6
+    print("%s: all tests passed" % sys.argv[0])
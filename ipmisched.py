@@ -0,0 +1,184 @@
+import sys
+import time
+import math
+import threading
+
+class IpmiScheduler:
+    """
+    This class runs sampling tasks at fixed rates, each task on its own
+    thread so a slow task does not delay the others ( a lone task runs on the
+    calling thread. )  Each task fires on absolute deadlines ( start + k *
+    period ), so the time a sample takes does not add to the period and the
+    schedule never drifts.
+
+    When a task falls behind, the deadlines that have already passed are
+    skipped rather than fired back to back.  For each task the scheduler
+    counts the deadlines fired, the deadlines missed and the overruns
+    ( samples that took longer than the period. )
+    """
+
+    def __init__(self, logger=None, report=0, debug=False):
+
+        self.tasks      = []
+        self.logger     = logger
+        self.report     = report
+        self.debug      = debug
+        self.last_report = None
+        self.lock       = threading.Lock()
+        self.error      = None
+
+    def add(self, name, period, fn):
+        """
+        This function adds a task which calls fn every period seconds.
+        """
+
+        if period <= 0:
+            raise Exception("ERR: Invalid period %s for task '%s'." % (period, name))
+
+        self.tasks.append( {    'name'      : name,
+                                'period'    : period,
+                                'fn'        : fn,
+                                'start'     : None,
+                                'k'         : 0,
+                                'next'      : None,
+                                'fired'     : 0,
+                                'missed'    : 0,
+                                'overruns'  : 0,
+                                'max_late'  : 0.0 } )
+
+    def stats(self):
+        """
+        This function returns the counters of each task.
+        """
+
+        return dict( (t['name'], {  'period'    : t['period'],
+                                    'fired'     : t['fired'],
+                                    'missed'    : t['missed'],
+                                    'overruns'  : t['overruns'],
+                                    'max_late'  : t['max_late'] }) for t in self.tasks )
+
+    def run(self, event):
+        """
+        This function fires the tasks until the 'stop' event is set.
+        """
+
+        now = time.monotonic()
+        self.last_report = now
+        for task in self.tasks:
+            task['start'] = now
+            task['k'] = 0
+            task['next'] = now
+
+        self.error = None
+        threads = [ threading.Thread(target=self._run_task, args=(task, event), name="IpmiScheduler-%s" % task['name'], daemon=True)
+                    for task in self.tasks[1:] ]
+        for thread in threads:
+            thread.start()
+        if self.tasks: self._run_task(self.tasks[0], event)
+        for thread in threads:
+            thread.join()
+
+        self.log_stats()
+        if self.error is not None:
+            raise self.error
+
+    def _run_task(self, task, event):
+        """
+        This function fires one task until the 'stop' event is set, or any
+        task fails ( the first error is raised by run. )
+        """
+
+        try:
+            self._fire(task, event)
+        except BaseException as e:
+            with self.lock:
+                if self.error is None: self.error = e
+
+    def _fire(self, task, event):
+
+        while not event.is_set() and self.error is None:
+
+            wait = task['next'] - time.monotonic()
+            if wait > 0 and event.wait(wait):
+                break
+
+            started = time.monotonic()
+            task['max_late'] = max(task['max_late'], started - task['next'])
+            task['fn']()
+            finished = time.monotonic()
+            task['fired'] += 1
+            if finished - started > task['period']:
+                task['overruns'] += 1
+
+            # the next deadline still in the future, skipping any already passed
+            task['k'] += 1
+            deadline = task['start'] + task['k']*task['period']
+            if deadline <= finished:
+                missed = int(math.floor((finished - deadline)/task['period'])) + 1
+                task['missed'] += missed
+                task['k'] += missed
+            task['next'] = task['start'] + task['k']*task['period']
+
+            if self.report and finished - self.last_report >= self.report:
+                with self.lock:
+                    if finished - self.last_report < self.report: continue
+                    self.last_report = finished
+                self.log_stats()
+
+    def log_stats(self):
+
+        for name, s in self.stats().items():
+            message = "SCHEDULE: task=%s period=%g fired=%d missed=%d overruns=%d max_late_ms=%.2f" % \
+                ( name, s['period'], s['fired'], s['missed'], s['overruns'], 1000*s['max_late'] )
+            if self.logger: self.logger.log(message, echo=self.debug)
+            elif self.debug: print("%s:" % sys.argv[0], message)
+
+#
+# To run the unit tests below for IpmiScheduler, type "python ipmisched.py"
+#
+if __name__ == "__main__":
+
+    event = threading.Event()
+    fast = []
+    slow = []
+    sched = IpmiScheduler()
+    sched.add( "fast", 0.01, lambda: fast.append(time.monotonic()) )
+    sched.add( "slow", 0.05, lambda: (slow.append(time.monotonic()), time.sleep(0.08)) )
+    timer = threading.Timer(1.0, event.set)
+    timer.start()
+    sched.run(event)
+
+    stats = sched.stats()
+    assert stats["slow"]["overruns"] == stats["slow"]["fired"], stats
+    assert stats["slow"]["missed"] > 0, stats
+    # deadlines stay on the grid: start + k*period
+    start = sched.tasks[1]['start']
+    for t in slow[1:]:
+        k = (t - start)/0.05
+        assert abs(k - round(k)) < 0.2, k
+    # the fast task keeps its rate next to the slow one
+    assert len(fast) > 90 and stats["fast"]["missed"] <= 2, stats
+
+    # a task that fails stops the others and its error is raised
+    def fail():
+        raise Exception("ERR: failed")
+    sched = IpmiScheduler()
+    sched.add( "fast", 0.01, lambda: None )
+    sched.add( "failing", 0.05, fail )
+    try:
+        sched.run(threading.Event())
+        assert False
+    except Exception as e:
+        assert str(e) == "ERR: failed", e
+
+    # a lone task keeps its rate regardless of the sample time
+    event = threading.Event()
+    ticks = []
+    sched = IpmiScheduler()
+    sched.add( "steady", 0.02, lambda: (ticks.append(time.monotonic()), time.sleep(0.01)) )
+    threading.Timer(0.5, event.set).start()
+    sched.run(event)
+    assert abs((ticks[-1] - ticks[0])/(len(ticks)-1) - 0.02) < 0.002, ticks
+    assert sched.stats()["steady"]["missed"] == 0
+
+    print("%s: all tests passed" % sys.argv[0])
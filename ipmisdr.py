@@ -0,0 +1,156 @@
+import sys
+import os
+import json
+import pyipmi.sdr
+
+#
+# configuration
+#
+SDR_CACHE_DIR = os.path.join( os.path.expanduser("~"), ".cache", "ipmicap", "sdr" )
+SDR_CACHE_VERSION = 1
+
+class IpmiSdrCache:
+    """
+    This class keeps the sensor data records ( SDRs ) of one BMC on disk, so
+    that a restart does not fetch them again.
+
+    The records are kept as the raw bytes the BMC returned, in a JSON file
+    per BMC address.  The file is keyed by the BMC's device ID ( id,
+    revisions, manufacturer and product ) and by the SDR repository's record
+    count and most recent addition and erase timestamps.  validate() reads
+    these from the BMC and drops the cached records when any has changed.
+    """
+
+    def __init__(self, ip, port=623, path=SDR_CACHE_DIR, debug=False):
+
+        self.path       = path
+        self.file       = os.path.join( path, "%s_%d.json" % (ip.replace(":", "_"), port) )
+        self.debug      = debug
+        self.key        = None
+        self.records    = {}
+        self.order      = None      # the ids of a complete walk of the repository
+        self.dirty      = False
+
+    def validate(self, connection, device_id):
+        """
+        This function reads the repository info of the BMC and loads the
+        cached records if they are still current.  It returns True when they are.
+        """
+
+        info = connection.send_message_by_name('GetSdrRepositoryInfo')
+        self.key = {    "version"           : SDR_CACHE_VERSION,
+                        "device_id"         : device_id.device_id,
+                        "revision"          : device_id.revision,
+                        "fw_revision"       : str(device_id.fw_revision),
+                        "ipmi_version"      : str(device_id.ipmi_version),
+                        "manufacturer_id"   : device_id.manufacturer_id,
+                        "product_id"        : device_id.product_id,
+                        "aux"               : list(device_id.aux or []),
+                        "record_count"      : info.record_count,
+                        "most_recent_addition" : info.most_recent_addition,
+                        "most_recent_erase" : info.most_recent_erase }
+
+        self.records = {}
+        self.order = None
+        try:
+            with open(self.file) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if cached.get("key") != self.key:
+            if self.debug: print("%s: SDR cache '%s' is stale" % (sys.argv[0], self.file))
+            self.dirty = True
+            return False
+        self.records = dict( (int(k), bytes.fromhex(v)) for k, v in cached.get("records", {}).items() )
+        self.order = cached.get("order")
+        return True
+
+    def get(self, record_id):
+        """
+        This function returns the decoded record, or None if it is not cached.
+        """
+
+        data = self.records.get(record_id)
+        return None if data is None else pyipmi.sdr.SdrCommon.from_data(data)
+
+    def put(self, record):
+
+        self.records[record.id] = bytes(record.data)
+        self.dirty = True
+
+    def entries(self):
+        """
+        This function returns all the records of the repository in order, or
+        None if no complete walk of it has been cached.
+        """
+
+        if self.order is None:
+            return None
+        return [ self.get(record_id) for record_id in self.order ]
+
+    def set_entries(self, records):
+
+        for record in records:
+            self.put(record)
+        self.order = [ record.id for record in records ]
+
+    def save(self):
+        """
+        This function writes the cache file if anything was added.
+        """
+
+        if not self.dirty or self.key is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump( { "key": self.key, "order": self.order,
+                         "records": dict( (str(k), v.hex()) for k, v in self.records.items() ) }, f )
+        os.replace(tmp, self.file)
+        self.dirty = False
+
+#
+# To run the unit tests below, type "python ipmisdr.py"
+# ( they use a local simulated BMC, see ipmisim.py )
+#
+if __name__ == "__main__":
+
+    import time
+    import tempfile
+    from ipmisim import IpmiSimBmc
+    from ipmimon import IpmiMon
+
+    bmc = IpmiSimBmc( port=0, records=20, latency=0.01 )
+    port = bmc.start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        timings = []
+        for run in range(2):
+            start = time.perf_counter()
+            mon = IpmiMon( ip="127.0.0.1", port=port, transport="rmcp", records=list(range(1,21)), sdr_cache=tmp )
+            mon.connect()
+            mon.get_sensors()
+            timings.append( time.perf_counter() - start )
+            descriptions = mon.get_sensor_descriptions()
+            mon._sample_sensors()
+            mon.disconnect()
+            assert [ d['record_id'] for d in descriptions ] == list(range(1,21))
+            if run == 0: first = descriptions
+        assert descriptions == first
+        print("%s: connected and read 20 records in %.0f ms, then %.0f ms from the cache" % (sys.argv[0], 1000*timings[0], 1000*timings[1]))
+        assert timings[1] < timings[0]/2
+
+        # a changed repository invalidates the cache
+        bmc.started += 1
+        mon = IpmiMon( ip="127.0.0.1", port=port, transport="rmcp", records=[1], sdr_cache=tmp )
+        mon.connect()
+        assert not mon.sdr.records
+        mon.get_sensors()
+        mon.disconnect()
+        cache = IpmiSdrCache( "127.0.0.1", port, tmp )
+        with open(cache.file) as f:
+            assert list(json.load(f)["records"].keys()) == [ "1" ]
+
+    bmc.stop()
+    print("%s: all tests passed" % sys.argv[0])
@@ -7,27 +7,77 @@ def main():
         import  argparse
         import traceback
         parser  = argparse.ArgumentParser(description='IPMI Monitoring Tool.')
-        parser.add_argument('--ip',         dest='ip', required=True, help='The IP address of the IPMI interface')
+        parser.add_argument('--ip',         dest='ip', required=False, default=None, help='The IP address of the IPMI interface')
+        parser.add_argument('--config',     dest='config', default=None, help='A JSON file listing several BMCs to monitor from this process (instead of --ip)')
+        parser.add_argument('--workers',    dest='workers', type=int, default=16, help='The number of threads reading the BMCs listed in --config')
         parser.add_argument('--port',       dest='port', type=int, default=623, help='The port of the IPMI interface')
         parser.add_argument('--username',   dest='username', default="admin", help='The authentication username for the IPMI interface')
         parser.add_argument('--password',   dest='password', default="admin", help='The authentication password for the IPMI interface')
         parser.add_argument('--iface',      dest='iface', required=False, default="lan", help='The ipmi interface to use (try "lanplus" or "lan"')
+        parser.add_argument('--transport',  dest='transport', default="ipmitool", choices=["ipmitool","rmcp"], help='Spawn ipmitool per request, or keep a native RMCP/RMCP+ session open')
+        parser.add_argument('--keep-alive', dest='keep_alive', type=float, default=1, help='Seconds of idle time before a keepalive request is sent (with --transport rmcp)')
+        parser.add_argument('--sdr-cache',  dest='sdr_cache', default=None, help='The directory caching the sensor data records of each BMC (default ~/.cache/ipmicap/sdr)')
+        parser.add_argument('--no-sdr-cache', dest='no_sdr_cache', action='store_true', help='Always read the sensor data records from the BMC')
         parser.add_argument('--enumerate',  dest='enumerate', default=False, action="store_true", help='Enumerate all available sensors showing sensor name and record id')
         parser.add_argument('--records',    dest='records', required=False, default=None, metavar='RECORD_ID', type=int, nargs='+', help='The sensor(s) to retrieve via the record id')
         parser.add_argument('--listen',     dest='listen', type=int, default=None, required=False, help='The listen port for HTTP commands')
-        parser.add_argument('--delay',      dest='delay', type=float, default=0.25, help='The delay/sleep time between queries to the IPMI interface for a set of sensors')
+        parser.add_argument('--delay',      dest='delay', type=float, default=0.25, help='The sampling period in seconds for sources without their own rate')
+        parser.add_argument('--ipmi-rate',  dest='ipmi_rate', type=float, default=None, help='The sampling rate in Hz of the IPMI records (default 1/delay)')
+        parser.add_argument('--nvidia-rate',dest='nvidia_rate', type=float, default=None, help='The sampling rate in Hz of the Nvidia GPUs (default 1/delay)')
+        parser.add_argument('--g2-rate',    dest='g2_rate', type=float, default=None, help='The sampling rate in Hz of the GSI G2 devices (default 1/delay)')
+        parser.add_argument('--record-rate',dest='record_rate', default=[], metavar='RECORD_ID:HZ', nargs='+', help='A sampling rate in Hz for individual IPMI records, e.g. 5029:1')
+        parser.add_argument('--concurrency', dest='concurrency', type=int, default=1, help='The maximum number of IPMI sensor reads kept in flight at once')
+        parser.add_argument('--sweep-report', dest='sweep_report', type=float, default=0, help='Log the mean/max time to read the full set of records and the scheduler counters every N seconds (0 disables)')
         parser.add_argument('--path',       dest='path', default="/tmp/ipmi", help='Supply a directory where timestamped log files will be written.')
         parser.add_argument('--dcmi-power', dest='dcmi_power', action='store_true', help='Sample power via dcmi interface.')
+        parser.add_argument('--dcmi-mode',  dest='dcmi_mode', default="system", choices=["system","enhanced"], help='Read the DCMI system power statistics, or the enhanced statistics averaged over --dcmi-period')
+        parser.add_argument('--dcmi-period', dest='dcmi_period', type=int, default=None, help='The rolling average period in seconds of --dcmi-mode enhanced (default the polling period)')
         parser.add_argument('--nvidia',     dest='nvidia', type=int, default=-1, help='Sample power for Nvidia GPU')
-        parser.add_argument('--g2',         dest='g2', type=int, default=-1, help='Sample power for GSI G2')
+        parser.add_argument('--nvidia-source', dest='nvidia_source', default="smi", choices=["smi","nvml"], help='Read GPU power from a streaming nvidia-smi process or through NVML (pynvml)')
+        parser.add_argument('--nvidia-smi', dest='nvidia_smi', default="nvidia-smi", help='The nvidia-smi program to run (with --nvidia-source smi)')
+        parser.add_argument('--g2',         dest='g2', type=int, default=[], metavar='APU', nargs='+', help='Sample power for the GSI G2 APU(s) with these indexes')
+        parser.add_argument('--gsi-tool',   dest='gsi_tool', default="gsi_tool", help='The gsi_tool program to run (with --g2)')
         parser.add_argument('--sessions',   dest='sessions', action='store_true', help='Will return power consumption via web requests.')
         parser.add_argument('--debug',      dest='debug', action='store_true', help='Verbose debug mode')
         parser.add_argument('--nologger',   dest='nologger', action='store_true', help='Bypass file logger')
+        parser.add_argument('--buffered-log', dest='buffered_log', action='store_true', help='Write the log file from a background thread with a persistent file handle')
+        parser.add_argument('--log-queue-size', dest='log_queue_size', type=int, default=10000, help='Maximum number of log lines buffered in memory (with --buffered-log)')
+        parser.add_argument('--log-flush-interval', dest='log_flush_interval', type=float, default=1.0, help='Seconds between flushes of the log file (with --buffered-log)')
+        parser.add_argument('--log-fsync', dest='log_fsync', default="never", choices=["never","flush","always"], help='When to fsync the log file (with --buffered-log)')
+        parser.add_argument('--log-rotate-size', dest='log_rotate_size', type=float, default=0, help='Start a new log segment when the current one reaches this many MB (0 disables)')
+        parser.add_argument('--log-rotate-interval', dest='log_rotate_interval', type=float, default=0, help='Start a new log segment every N seconds (0 disables)')
+        parser.add_argument('--log-compress', dest='log_compress', action='store_true', help='Gzip closed log segments in the background (with --log-rotate-size/--log-rotate-interval)')
+        parser.add_argument('--capture',    dest='capture', action='store_true', help='Also write the samples and markers to a binary, time indexed capture directory next to the log file')
+        parser.add_argument('--stream-queue', dest='stream_queue', type=int, default=1000, help='The most samples queued for one /stream or /events client before samples are dropped')
+        parser.add_argument('--session-workers', dest='session_workers', type=int, default=2, help='The number of threads computing the stats of stopped sessions')
+        parser.add_argument('--history',    dest='history', type=float, default=3600, help='Seconds of samples kept for /energy queries, whether or not a session was started (with --sessions)')
+        parser.add_argument('--spill-mb',   dest='spill_mb', type=float, default=256, help='MB of samples held in memory for sessions and /energy before full chunks are moved to memory-mapped files (0 never, with --sessions)')
+        parser.add_argument('--spill-dir',  dest='spill_dir', default=None, help='The directory of the spill files (default --path)')
+        parser.add_argument('--rollups',    dest='rollups', default=['1:3600','10:86400','60:2592000'], metavar='SECONDS:KEEP', nargs='*', help='Bucket sizes and the seconds each is kept for /rollup queries (with --listen), e.g. 1:3600 10:86400 (none disables)')
         parser.add_argument('--include-nvidia-in-tot-power',   dest='include_nvidia_in_tot_power', action='store_true', help='Add nvidia power to total power calculation')
 
         args    = parser.parse_args()
 
-        if args.dcmi_power:
+        try:
+            rollup_tiers = [ (float(r.split(":")[0]), float(r.split(":")[1])) for r in args.rollups ]
+        except:
+            print("%s: ERROR: --rollups expects SECONDS:KEEP values." % sys.argv[0])
+            sys.exit(1)
+
+        try:
+            record_rates = dict( (int(r.split(":")[0]), float(r.split(":")[1])) for r in args.record_rate )
+        except:
+            print("%s: ERROR: --record-rate expects RECORD_ID:HZ values." % sys.argv[0])
+            sys.exit(1)
+
+        if not args.ip and not args.config:
+            print("%s: ERROR: --ip or --config argument needs to be supplied." % sys.argv[0])
+            parser.print_help()
+            sys.exit(1)
+
+        if args.config:
+            if args.debug: print("%s: Monitoring the BMCs in '%s'." % (sys.argv[0], args.config))
+        elif args.dcmi_power:
             if args.debug: print("%s: Sampling power using dcmi interface." % sys.argv[0])
         elif not args.enumerate and not args.records:
             print("%s: ERROR: --enumerate or --records argument needs to be supplied." % sys.argv[0])
@@ -41,6 +91,11 @@ def main():
         #    parser.exit()
         #    sys.exit(1)
     
+        sdr_cache = None
+        if not args.no_sdr_cache:
+            from ipmisdr import SDR_CACHE_DIR
+            sdr_cache = args.sdr_cache or SDR_CACHE_DIR
+
         #
         # Create the output directory as needed
         #
@@ -49,6 +104,26 @@ def main():
             if args.debug: print("%s: Warning: Making directory %s" % (sys.argv[1], args.path))
             os.makedirs(args.path, exist_ok=True)   
     
+        #
+        # Collect the sampler's own counters and latencies for /metrics
+        #
+        metrics = None
+        if args.listen:
+            from ipmimetrics import IpmiMetrics
+            metrics = IpmiMetrics()
+
+        #
+        # Keep tiered rollups of the samples for /rollup
+        #
+        rollups = None
+        if args.listen and rollup_tiers:
+            from ipmirollup import IpmiRollups
+            try:
+                rollups = IpmiRollups( rollup_tiers )
+            except Exception as e:
+                print("%s: ERROR: --rollups:" % sys.argv[0], e)
+                sys.exit(1)
+
         #
         # Create a file logger
         #
@@ -58,23 +133,93 @@ def main():
             logger = None
         else:
             from    ipmilogger import IpmiLogger
-            logger  = IpmiLogger(path, False)
+            logger  = IpmiLogger(path, False,
+                                    buffered        = args.buffered_log,
+                                    queue_size      = args.log_queue_size,
+                                    flush_interval  = args.log_flush_interval,
+                                    fsync           = args.log_fsync,
+                                    rotate_size     = int(args.log_rotate_size*1024*1024),
+                                    rotate_interval = args.log_rotate_interval,
+                                    compress        = args.log_compress,
+                                    metrics         = metrics )
         if args.debug: print("%s: Created a logger at '%s'" % (sys.argv[0], path))
 
+        #
+        # Create a binary capture alongside the text log
+        #
+        capture = None
+        if args.capture:
+            from ipmicapture import IpmiCaptureWriter
+            capture = IpmiCaptureWriter(path + ".cap")
+            if args.debug: print("%s: Created a capture at '%s.cap'" % (sys.argv[0], path))
+
         #
         # Create a session manager
         #
-        from ipmisession import IpmiSessionManager
         session_manager=None
         if args.sessions:
-            session_manager = IpmiSessionManager( args.include_nvidia_in_tot_power, args.debug )
+            from ipmisession import IpmiSessionManager
+            session_manager = IpmiSessionManager( args.include_nvidia_in_tot_power, args.debug, history=args.history,
+                                                  spill=int(args.spill_mb*1024*1024), spill_dir=args.spill_dir or args.path )
+
+        #
+        # Push samples to /stream and /events subscribers
+        #
+        broadcaster = None
+        if args.listen:
+            from ipmistream import IpmiBroadcaster
+            broadcaster = IpmiBroadcaster( queue_size=args.stream_queue, debug=args.debug )
+
+        # gauges are only evaluated when /metrics is read
+        if metrics:
+            metrics.gauge( "ipmicap_stream_clients", "Connected /stream and /events clients.", lambda: len(broadcaster.clients) )
+            if session_manager:
+                metrics.gauge( "ipmicap_open_sessions", "Capture sessions started and not yet stopped.", lambda: len(session_manager.capture_sessions) )
+                metrics.gauge( "ipmicap_buffered_samples", "Samples held by the session manager.", session_manager.buffered )
+                metrics.gauge( "ipmicap_spilled_samples", "Samples held by the session manager in spill files.", session_manager.spilled )
+            if rollups:
+                metrics.gauge( "ipmicap_rollup_buckets", "Rollup buckets held in memory.", rollups.buckets )
+            if logger and logger.buffered:
+                metrics.gauge( "ipmicap_log_queue_lines", "Log lines waiting for the writer thread.", logger.queue.qsize )
+
+        #
+        # Monitor the BMCs listed in the config file on one event loop
+        #
+        if args.config:
+            from ipmiengine import IpmiEngine, load_config
+            engine  = IpmiEngine(   load_config(args.config),
+                                    logger          = logger,
+                                    session_manager = session_manager,
+                                    delay           = args.delay,
+                                    workers         = args.workers,
+                                    sweep_report    = args.sweep_report,
+                                    capture         = capture,
+                                    broadcaster     = broadcaster,
+                                    metrics         = metrics,
+                                    rollups         = rollups,
+                                    sdr_cache       = sdr_cache,
+                                    debug           = args.debug )
+            if args.enumerate:
+                sys.exit( 1 if engine.enumerate() else 0 )
+            engine.connect()
+            if not args.listen:
+                try:
+                    engine.run() # main thread stops here
+                finally:
+                    engine.disconnect()
+                    if logger: logger.close()
+                    if capture: capture.close()
+                sys.exit(0)
 
         #
         # Connect to the IPMI interface
         #
         from    ipmimon import IpmiMon
         mon     = IpmiMon(  ip              = args.ip, 
+                            port            = args.port,
                             iface           = args.iface,
+                            transport       = args.transport,
+                            keep_alive      = args.keep_alive,
                             username        = args.username,
                             password        = args.password,
                             records         = args.records,
@@ -82,19 +227,38 @@ def main():
                             session_manager = session_manager,
                             delay           = args.delay,
                             dcmi_power      = args.dcmi_power,
+                            dcmi_mode       = args.dcmi_mode,
+                            dcmi_period     = args.dcmi_period,
                             nvidia          = args.nvidia,
                             g2              = args.g2,
                             include_nvidia_in_tot_power  = args.include_nvidia_in_tot_power,
+                            concurrency     = args.concurrency,
+                            sweep_report    = args.sweep_report,
+                            ipmi_rate       = args.ipmi_rate,
+                            nvidia_rate     = args.nvidia_rate,
+                            g2_rate         = args.g2_rate,
+                            record_rates    = record_rates,
+                            nvidia_source   = args.nvidia_source,
+                            nvidia_smi      = args.nvidia_smi,
+                            gsi_tool        = args.gsi_tool,
+                            capture         = capture,
+                            broadcaster     = broadcaster,
+                            metrics         = metrics,
+                            rollups         = rollups,
+                            sdr_cache       = sdr_cache,
                             debug           = args.debug )
-        if args.debug: print("%s: Connecting to the IPMI interface at %s..." % ( sys.argv[0], args.ip))
-        mon.connect()
-        if args.debug: print("%s: Connected to the IPMI interface at %s." % (sys.argv[0],args.ip))
+        # with --config this monitor only samples the local GPU/APU sources
+        if not args.config:
+            if args.debug: print("%s: Connecting to the IPMI interface at %s..." % ( sys.argv[0], args.ip))
+            mon.connect()
+            if args.debug: print("%s: Connected to the IPMI interface at %s." % (sys.argv[0],args.ip))
 
         #
         # Enumerate sensors if requested
         #
         if  args.enumerate:
             mon.enumerate_sensors()
+            mon.disconnect()
             sys.exit(0)
 
         #
@@ -102,7 +266,13 @@ def main():
         #
         if not args.listen:
             if args.debug: print("%s: Monitoring the following records: " % sys.argv[0],args.records )
-            mon.run_ipmi() # main thread stops here
+            from threading import Event
+            try:
+                mon.run_ipmi(Event()) # main thread stops here
+            finally:
+                mon.disconnect()
+                if logger: logger.close()
+                if capture: capture.close()
 
         #
         # Listen and respond to http messages
@@ -114,6 +284,11 @@ def main():
         import  urllib.parse
         import  json
         import  traceback
+        import  ipmiresponse
+        from    ipmistream import stream_handlers
+        from    ipmimetrics import metrics_handlers
+        from    ipmirollup import rollup_handlers
+        from    ipmistore import now_ns, to_ns
         from    threading import Event
 
         # The actual ipmi sensor monitoring happens in a thread pool
@@ -125,7 +300,11 @@ def main():
             except:
                 print("%s: Critical error in threadpool ipmimon executor loop" % sys.argv[0])
                 traceback.print_exc()
-        executor.submit(ipmi_task, mon)
+        if args.config:
+            # the BMCs are sampled by coroutines on the IOLoop serving http
+            IOLoop.current().add_callback(engine.start)
+        else:
+            executor.submit(ipmi_task, mon)
 
         # The actual nvidia sensor monitoring happens in a thread pool
         if args.nvidia>=0:
@@ -139,7 +318,7 @@ def main():
             executor.submit(nv_task, mon)
 
         # The actual G2 sensor monitoring happens in a thread pool
-        if args.g2>=0:
+        if args.g2:
             g2_stop_event = Event()
             def g2_task(mon):
                 try:
@@ -149,11 +328,21 @@ def main():
                     traceback.print_exc()
             executor.submit(g2_task, mon)
 
+        def parse_time(ts):
+            """Reads a client's time: seconds since the epoch or ISO 8601"""
+            if isinstance(ts, str):
+                try:
+                    ts = float(ts)
+                except ValueError:
+                    return datetime.datetime.fromisoformat(ts)
+            return datetime.datetime.fromtimestamp(ts)
+
         class LogHandler(tornado.web.RequestHandler):
             """Handles http log requests"""
-            def initialize(self, logger, verbose):
+            def initialize(self, logger, verbose, capture=None):
                 self.logger = logger
                 self.verbose = verbose
+                self.capture = capture
                 
             @gen.coroutine
             def get(self):
@@ -164,16 +353,70 @@ def main():
                         parm = self.get_argument(arg,None)
                         if arg.endswith("_enc"): parm = parm = urllib.parse.unquote(parm)
                         log_item += "%s = %s" % (arg,parm)
-                    if self.logger: self.logger.log( log_item, echo=self.verbose)
+                    dt = None
+                    if self.logger: dt = self.logger.log( log_item, echo=self.verbose)
+                    if self.capture: self.capture.event( dt or now_ns(), log_item )
                     self.write(json.dumps(1))
                 except:
                     print("%s: ERROR:" % sys.argv[0], sys.exc_info()[0], sys.exc_info()[1])
 
+            @gen.coroutine
+            def post(self):
+                """
+                Logs a batch of events with one logger write.  The body is a JSON
+                list of events ( or { "events": [ ... ] } ) or NDJSON, one event
+                per line.  An event's fields are logged like the arguments of a
+                GET, except "ts", the client's time ( seconds since the epoch or
+                ISO 8601 ), used as the event's time instead of now.
+                """
+                try:
+                    entries = [ self.parse_event(event) for event in self.parse_events(self.request.body) ]
+                except:
+                    self.set_status(400)
+                    self.write(json.dumps({ "error": str(sys.exc_info()[1]) }))
+                    return
+                try:
+                    if self.logger: dates = self.logger.log_batch( entries, echo=self.verbose )
+                    else: dates = [ now_ns() if date is None else to_ns(date) for item, date in entries ]
+                    if self.capture: self.capture.event_batch( [ ( dt, log_item ) for (log_item, date), dt in zip(entries, dates) ] )
+                    self.write(json.dumps(len(entries)))
+                except:
+                    print("%s: ERROR:" % sys.argv[0], sys.exc_info()[0], sys.exc_info()[1])
+
+            def parse_events(self, body):
+                body = body.decode().strip()
+                if not body: return []
+                try:
+                    events = json.loads(body)
+                except ValueError:
+                    events = json.loads( "[%s]" % ",".join( line for line in body.splitlines() if line.strip() ) )
+                if isinstance(events, dict): events = events.get("events", [ events ])
+                if not isinstance(events, list) or not all( isinstance(e, dict) for e in events ):
+                    raise Exception("ERR: Expected a list of event objects.")
+                return events
+
+            def parse_event(self, event):
+                ts = event.get("ts")
+                date = None if ts is None else parse_time(ts)
+                log_item = ",".join( "%s = %s" % (k, v) for k, v in event.items() if k != "ts" )
+                return log_item, date
+
+        # Stopped sessions are computed and encoded on their own threads, so
+        # the IOLoop keeps answering /log and session starts meanwhile
+        session_executor = concurrent.futures.ThreadPoolExecutor(args.session_workers)
+        def stop_session(session_manager, dt, session_id, all_stats, points, method, fmt):
+            power_cons = session_manager.stop( dt, session_id, all_stats=all_stats )
+            if points and isinstance(power_cons, dict):
+                power_cons["per_sensor"] = ipmiresponse.downsample( power_cons["per_sensor"], points, method )
+            return ipmiresponse.encode( power_cons, fmt )
+
         class SessionHandler(tornado.web.RequestHandler):
             """Handles http session requests"""
-            def initialize(self, session_manager, logger):
+            def initialize(self, session_manager, logger, capture=None, executor=None):
                 self.session_manager = session_manager
                 self.logger = logger
+                self.capture = capture
+                self.executor = executor
             
             @gen.coroutine
             def get(self):
@@ -182,6 +425,10 @@ def main():
                     stop=False
                     session_id=None
                     all_stats=False
+                    nodes=None
+                    fmt=None
+                    points=None
+                    method="lttb"
 
                     for arg in self.request.arguments:
                         parm = self.get_argument(arg,None)
@@ -191,37 +438,97 @@ def main():
                             if parm=="all_stats":
                                 all_stats=True
                         elif arg=="id": session_id = parm
+                        elif arg=="nodes": nodes = parm.split(",")
+                        elif arg=="format": fmt = parm
+                        elif arg=="downsample": points = parm
+                        elif arg=="method": method = parm
 
-                    dt = datetime.datetime.now()
+                    dt = now_ns()
                     if start:
-                        self.session_manager.start( dt, session_id )
+                        self.session_manager.start( dt, session_id, nodes=nodes )
                         if self.logger: self.logger.log( "start_session = %s" % session_id, echo=True, date=dt )
+                        if self.capture: self.capture.event( dt, "start_session = %s" % session_id )
                         self.write(json.dumps(1))
                     elif stop:
-                        power_cons = self.session_manager.stop( dt, session_id, all_stats=all_stats )
+                        # only the stats of a stopped session come in other formats, json when the Accept header has none of them
+                        explicit = fmt
+                        fmt = ipmiresponse.negotiate( self.request.headers.get("Accept"), fmt )
+                        if fmt is None and explicit:
+                            self.set_status(406)
+                            self.write(json.dumps({ "error": "unknown format '%s'" % explicit }))
+                            return
+                        fmt = fmt or "json"
+                        if method not in ipmiresponse.DOWNSAMPLE_METHODS:
+                            self.set_status(400)
+                            self.write(json.dumps({ "error": "unknown downsample method '%s'" % method }))
+                            return
+                        if points is not None:
+                            if not points.isdigit():
+                                self.set_status(400)
+                                self.write(json.dumps({ "error": "downsample must be a number of points, not '%s'" % points }))
+                                return
+                            points = int(points)
                         if self.logger: self.logger.log( "stop_session = %s" % session_id, echo=True, date=dt )
-                        self.write(json.dumps(power_cons))
+                        if self.capture: self.capture.event( dt, "stop_session = %s" % session_id )
+                        body, content_type = yield self.executor.submit( stop_session, self.session_manager,
+                                                                         dt, session_id, all_stats, points, method, fmt )
+                        self.set_header("Content-Type", content_type)
+                        # large bodies go out in chunks ( chunked transfer encoding )
+                        for offset in range(0, len(body), ipmiresponse.CHUNK_SIZE):
+                            self.write( body[offset:offset+ipmiresponse.CHUNK_SIZE] )
+                            yield self.flush()
 
                 except:
                     print("%s: ERROR:" % sys.argv[0], sys.exc_info()[0], sys.exc_info()[1])
                     traceback.print_exc()
                     
+        class EnergyHandler(tornado.web.RequestHandler):
+            """Handles http energy requests over past time windows"""
+            def initialize(self, session_manager):
+                self.session_manager = session_manager
+
+            def get(self):
+                """
+                Returns the energy, mean and max of each sensor between 'start'
+                and 'end' ( seconds since the epoch or ISO 8601, end defaults to
+                now ), or over the last 'seconds'.  'sensors' and 'nodes' ( comma
+                separated ) limit the sensors reported.
+                """
+                try:
+                    end = self.get_argument("end", None)
+                    end = to_ns(parse_time(end)) if end else now_ns()
+                    seconds = self.get_argument("seconds", None)
+                    start = end - int(float(seconds)*1e9) if seconds else to_ns(parse_time(self.get_argument("start")))
+                    sensors = self.get_argument("sensors", None)
+                    nodes = self.get_argument("nodes", None)
+                except:
+                    self.set_status(400)
+                    self.write(json.dumps({ "error": str(sys.exc_info()[1]) }))
+                    return
+                result = self.session_manager.query( start, end, sensors=sensors.split(",") if sensors else None,
+                                                      nodes=nodes.split(",") if nodes else None )
+                self.set_header("Content-Type", "application/json")
+                self.write(json.dumps(result))
+
+        routes = rollup_handlers(rollups, parse_time) if rollups else []
         if args.sessions:
             # Run an http server which handles session and log requests
             app = tornado.web.Application(
                 [       
-                    (r"/log", LogHandler, {'logger':logger, 'verbose':args.debug} ),
+                    (r"/log", LogHandler, {'logger':logger, 'verbose':args.debug, 'capture':capture} ),
                     (r"/session", SessionHandler, {'session_manager':session_manager, 
-                                                    'logger':logger } )
-                ])
+                                                    'logger':logger, 'capture':capture,
+                                                    'executor':session_executor } ),
+                    (r"/energy", EnergyHandler, {'session_manager':session_manager} )
+                ] + stream_handlers(broadcaster) + metrics_handlers(metrics) + routes )
             app.logger = logger
             app.session_manager = session_manager
         else:
             # Run an http server which handles log requests
             app = tornado.web.Application(
                 [       
-                    (r"/log", LogHandler, {'logger':logger} ),
-                ])
+                    (r"/log", LogHandler, {'logger':logger, 'verbose':args.debug, 'capture':capture} ),
+                ] + stream_handlers(broadcaster) + metrics_handlers(metrics) + routes )
             app.logger = logger
 
 
@@ -234,3 +541,8 @@ def main():
             print(err)
             stop_event.set()
             print("%s: Main thread is done" % sys.argv[0])
+        finally:
+            if args.config: engine.disconnect()
+            else: mon.disconnect()
+            if logger: logger.close()
+            if capture: capture.close()
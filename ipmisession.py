@@ -2,118 +2,387 @@ import os
 import datetime
 import tempfile
 import sys
-from scipy.integrate import simps
-from numpy import trapz
-import pandas as pd
+import threading
+import numpy as np
+from ipmistore import IpmiSampleStore, SAMPLE_BYTES, to_ns, ns_to_datetime
 
 class IpmiSessionManager:
     """This class provides capture sessions and computatations on the 
     collected session sensor data.
+
+    It is called from the sampler threads and the http handlers at once.
+    The registries ( stores, sensors, sensor_nodes, started, capture_sessions
+    and session_nodes ) are copy-on-write: they are only replaced, never
+    changed in place, under self.lock, so readers use whichever version
+    they picked up without locking.  Ingesting a sample takes no lock but
+    the lock of its own sensor's store, and self.lock only when a sensor is
+    seen for the first time.  A session stays registered until its stats
+    are computed, so no trim can release the samples it still needs.
+
+    Besides what open sessions need, each sensor keeps the last 'history'
+    seconds of samples, so query() can report on any recent window whether
+    or not a session covered it.  Older chunks are released as new ones
+    fill.
+
+    Times are int64 nanoseconds since the epoch, as taken by the samplers
+    ( see ipmistore.now_ns ); datetimes are accepted and converted.
+
+    Once the samples held in memory take more than 'spill' bytes, the full
+    chunks of each sensor are moved to memory-mapped spill files in
+    'spill_dir' as they fill, so a long session at a high rate does not
+    grow the sampler's memory.  Stops read them back a chunk at a time.
     """
 
-    def __init__(self, include_nvidia_in_tot_power=False, debug=False):
+    def __init__(self, include_nvidia_in_tot_power=False, debug=False, history=0, spill=0, spill_dir=None):
 
         self.session_started    = False
         self.started            = {}
         self.sensors            = {}
         self.capture_sessions   = {}
+        self.stores             = {}
+        self.sensor_nodes       = {}
+        self.session_nodes      = {}
+        self.stopping           = set()
+        self.lock               = threading.Lock()
         self.include_nvidia_in_tot_power = include_nvidia_in_tot_power
         self.debug              = debug
+        self.history            = history
+        self.spill              = spill
+        self.spill_dir          = spill_dir
 
-    def start(self, dt, session_id):
+    def start(self, dt, session_id, nodes=None):
 
-        self.started[session_id]  = dt
-        self.capture_sessions[session_id] = []
+        with self.lock:
+            # a session is just the index each sensor store had reached at start
+            # ( append() counts a sample only once it is stored, so no store lock )
+            start_indexes = { sensor_id: len(store) for sensor_id, store in self.stores.items() }
+            self.started = self._with( self.started, session_id, dt )
+            # the nodes the session covers, None for all
+            self.session_nodes = self._with( self.session_nodes, session_id, set(nodes) if nodes else None )
+            self.capture_sessions = self._with( self.capture_sessions, session_id, start_indexes )
 
     def stop(self, dt, session_id, all_stats=False):
-        if not session_id in self.capture_sessions:
-            print("ERR: invalid session_id for stop", session_id )
-            return -1
 
-        if not self.started[session_id]:
-            print("Warning: No session was started for", session_id) 
+        with self.lock:
+            if not session_id in self.capture_sessions or session_id in self.stopping:
+                print("ERR: invalid session_id for stop", session_id )
+                return -1
+            if not self.started[session_id]:
+                print("Warning: No session was started for", session_id) 
+                return -1
+            # claim the session so a concurrent stop of the same id fails
+            self.stopping.add(session_id)
+            started = self.started[session_id]
+            start_indexes = self.capture_sessions[session_id]
+            nodes = self.session_nodes.get(session_id)
+
+        try:
+            power_stats = self._compute_session( started, dt, start_indexes, nodes, all_stats )
+        finally:
+            with self.lock:
+                self.started = self._without( self.started, session_id )
+                self.capture_sessions = self._without( self.capture_sessions, session_id )
+                self.session_nodes = self._without( self.session_nodes, session_id )
+                self.stopping.discard(session_id)
+                self._trim()
+
+        if power_stats==-1:
             return -1
+        elif all_stats:
+            return power_stats
         else:
-            power_stats = self._compute_session( self.started[session_id], dt, session_id )
-            self.started.pop(session_id, None)
-            self.capture_sessions.pop(session_id, None)
-            if all_stats:
-                return power_stats
-            else:
-                return power_stats["tot_power"]
-
-    def sensor(self, dt, sensor_id, value):
-
-        self.sensors[sensor_id] = True
-        for session_id in self.capture_sessions.keys():
-            if self.started[session_id]:
-                self.capture_sessions[session_id].append( [dt, sensor_id, value] )
-        else:
-            pass
+            return power_stats["tot_power"]
+
+    def query(self, start_time, end_time, sensors=None, nodes=None):
+        """
+        This function returns the energy, mean and max of each sensor ( of
+        the given sensors and nodes, all if None ) between two datetimes,
+        from the samples still held.  'truncated' is set for the sensors
+        whose oldest sample held is after start_time.
+        """
 
-    def nvidia_sensor(self, dt, nv_id, value):
+        start_ns = to_ns(start_time)
+        end_ns = to_ns(end_time)
+        stores = self.stores
+        sensor_nodes = self.sensor_nodes
+
+        stats = {}
+        powers = {}
+        node_powers = {}
+        for sensor_id, store in stores.items():
+            node = sensor_nodes.get(sensor_id)
+            if nodes is not None and node not in nodes:
+                continue
+            if sensors is not None and str(sensor_id) not in sensors:
+                continue
+            with store.lock:
+                if len(store) == store.base:
+                    continue
+                s = store.stats( start_ns, end_ns )
+                s["truncated"] = store.oldest() > start_ns
+            stats[sensor_id] = s
+            powers[sensor_id] = s["energy"]
+            if node:
+                node_powers[node] = node_powers.get(node, 0) + s["energy"]
+
+        return {"stats":stats, "tot_power":self._total(powers, warn=False), "powers":powers, "nodes":node_powers,
+                "start_time":str(ns_to_datetime(start_ns)), "end_time":str(ns_to_datetime(end_ns))}
+
+    def buffered(self):
+        """
+        This function returns the number of samples held in memory.
+        """
+
+        return sum( len(store) - store.base for store in self.stores.values() )
+
+    def spilled(self):
+        """
+        This function returns the number of samples held in spill files.
+        """
+
+        return sum( store.spilled*store.chunk_size for store in self.stores.values() )
+
+    def sensor(self, ts, sensor_id, value, node=None, energy=None):
+
+        if node:
+            sensor_id = "%s:%s" % (node, sensor_id)
+        self._ingest(ts, sensor_id, value, energy, node=node)
+
+    def nvidia_sensor(self, ts, nv_id, value, energy=None):
 
         sname = "nvidia-%d" % nv_id
-        self.sensors[sname] = True
-        for session_id in self.capture_sessions.keys():
-            if self.started[session_id]:
-                self.capture_sessions[session_id].append( [dt, sname, value] )
-        else:
-            pass
+        self._ingest(ts, sname, value, energy)
 
-    def g2_sensor(self, dt, g2, value):
+    def g2_sensor(self, ts, g2, value):
 
         sname = "apu-%02d" % g2
-        self.sensors[sname] = True
-        for session_id in self.capture_sessions.keys():
-            if self.started[session_id]:
-                self.capture_sessions[session_id].append( [dt, sname, value] )
-        else:
-            pass
+        self._ingest(ts, sname, value)
 
-    def _compute_session(self, start_time, end_time, session_id):
+    def _ingest(self, ts, sensor_id, value, energy=None, node=None):
 
-        ready_for_df = []
-        for item in self.capture_sessions[session_id]:
-            ready_for_df.append( item )
+        store = self.stores.get(sensor_id)
+        if store is None:
+            store = self._add_sensor(sensor_id, node)
+        # the store keeps the running energy integral of the sensor up to date
+        with store.lock:
+            store.append( to_ns(ts), value, energy )
+            # each time a chunk fills, release the ones no longer needed
+            if len(store) % store.chunk_size == 0:
+                store.trim( self._keep(sensor_id, store, self.capture_sessions.values()) )
+                # and move the rest to disk past the memory allowed
+                if self.spill and self._resident() > self.spill:
+                    store.spill(self.spill_dir)
 
-        df = pd.DataFrame(ready_for_df, columns =['dt','sensor_id','value'])
+    def _resident(self):
+        """
+        This function returns the bytes taken by the samples in memory ( read
+        without the store locks, so approximate. )
+        """
 
-        per_sensor = {}
-        for sensor_id in self.sensors.keys():
-            per_sensor[sensor_id] = []
-            new_df = df.loc[ df['sensor_id'] == sensor_id  ]
-            dt_val = new_df[['dt','value']].values.tolist()
-            if len(dt_val)==0: 
-                print("ERR: No sensor samples found")
-                return -1
-            dt, val = zip(*dt_val)
-            # prepend the start and end endpoints and (TODO) interpolate their values
-            dt = [start_time] + list(dt) + [end_time]
-            val = [ val[0] ] + list(val) + [ val[-1] ]
-            cdt = [ (t-dt[0]).total_seconds() for t in dt ]
-            per_sensor[sensor_id] = [cdt, val]
+        return sum( store.resident() for store in self.stores.values() ) * SAMPLE_BYTES
+
+    def _add_sensor(self, sensor_id, node=None):
+
+        with self.lock:
+            store = self.stores.get(sensor_id)
+            if store is None:
+                store = IpmiSampleStore()
+                if node: self.sensor_nodes = self._with( self.sensor_nodes, sensor_id, node )
+                self.sensors = self._with( self.sensors, sensor_id, True )
+                self.stores = self._with( self.stores, sensor_id, store )
+            return store
+
+    def _with(self, registry, key, value):
+
+        registry = dict(registry)
+        registry[key] = value
+        return registry
+
+    def _without(self, registry, key):
+
+        registry = dict(registry)
+        registry.pop(key, None)
+        return registry
 
+    def _trim(self):
+        """
+        This function releases stored samples that neither an open session
+        nor the history refers to.  It is called with self.lock held.
+        """
+
+        sessions = list(self.capture_sessions.values())
+        for sensor_id, store in self.stores.items():
+            index = len(store)
+            for start_indexes in sessions:
+                index = min(index, start_indexes.get(sensor_id, 0))
+            # only take the store lock when a whole chunk can be released
+            if index-1 - store.base >= store.chunk_size:
+                with store.lock:
+                    store.trim( self._keep(sensor_id, store, sessions) )
+
+    def _keep(self, sensor_id, store, sessions):
+        """
+        This function returns the global index of the oldest sample of the
+        store still needed.  The sample just before a session start or the
+        start of the history is kept for interpolation, and so is the last
+        full chunk, in case a session is being started.  It is called with
+        the store's lock held.
+        """
+
+        index = len(store)
+        for start_indexes in sessions:
+            index = min(index, start_indexes.get(sensor_id, 0))
+        index -= 1
+        if self.history:
+            index = min( index, store._locate( store.last_ts - int(self.history*1e9) ) )
+        return min( index, len(store) - store.chunk_size )
+
+    def _compute_session(self, start_time, end_time, start_indexes, nodes=None, all_stats=False):
+        """
+        This function reads each sensor's energy for the session off its
+        running integral.  The per-sample arrays are only built for all_stats.
+        """
+
+        start_ns = to_ns(start_time)
+        end_ns = to_ns(end_time)
+        # a sensor's node is registered before its store
+        stores = self.stores
+        sensor_nodes = self.sensor_nodes
+
+        per_sensor = {}
         powers = {}
-        for idx,sensor_id in enumerate(self.sensors.keys()):
-            cdt = per_sensor[sensor_id][0]
-            val = per_sensor[sensor_id][1]
-            tarea = trapz(val,cdt)
-            sarea = simps(val,cdt)
-            powers[sensor_id] = tarea
+        node_powers = {}
+        for sensor_id, store in stores.items():
+            node = sensor_nodes.get(sensor_id)
+            if nodes is not None and node not in nodes:
+                continue
+            with store.lock:
+                if len(store) <= start_indexes.get(sensor_id, 0):
+                    print("ERR: No sensor samples found")
+                    return -1
+                powers[sensor_id] = store.energy_at(end_ns) - store.energy_at(start_ns)
+                if all_stats:
+                    # left as arrays for the response encoder (ipmiresponse.encode)
+                    per_sensor[sensor_id] = list( store.window_seconds( start_ns, end_ns ) )
+            if node:
+                node_powers[node] = node_powers.get(node, 0) + powers[sensor_id]
+
+        tot_power = self._total(powers)
+
+        return {"per_sensor":per_sensor, "tot_power":tot_power, "powers":powers, "nodes":node_powers, "start_time":str(ns_to_datetime(start_ns)), "end_time":str(ns_to_datetime(end_ns))}
+
+    def _total(self, powers, warn=True):
+        """
+        This function adds up the energy of the sensors that count towards the
+        total ( not the apus, nor the nvidia GPUs unless asked to. )
+        """
 
         tot_power = 0
-        for sensor_id in self.sensors.keys():
+        for sensor_id in powers.keys():
             if type(sensor_id)==type("") and sensor_id.startswith("nvidia"):
                 if self.include_nvidia_in_tot_power:
-                    print("Warning: Including nvidia sensor in session total power compute")
+                    if warn: print("Warning: Including nvidia sensor in session total power compute")
                 else:
-                    print("Warning: Skipping nvidia sensor in session total power compute")
+                    if warn: print("Warning: Skipping nvidia sensor in session total power compute")
                     continue
             if type(sensor_id)==type("") and sensor_id.startswith("apu"):
-                print("Warning: Skipping apu sensor in session total power compute")
+                if warn: print("Warning: Skipping apu sensor in session total power compute")
                 continue
             tot_power += powers[sensor_id]
+        return tot_power
+
+#
+# To run the unit tests below for IpmiSessionManager, type "python ipmisession.py"
+#
+if __name__ == "__main__":
+
+    manager = IpmiSessionManager()
+    t0 = datetime.datetime(2021,6,2,22,0,0)
+    sec = lambda s: t0 + datetime.timedelta(seconds=s)
+
+    manager.sensor( sec(0), 18, 100.0 )
+    manager.nvidia_sensor( sec(0), 0, 50.0 )
+    manager.start( sec(0.5), "a" )
+    for s in range(1,11):
+        manager.sensor( sec(s), 18, 100.0 + s )
+        manager.nvidia_sensor( sec(s), 0, 50.0 )
+        if s==5: manager.start( sec(5.5), "b" )
+
+    stats = manager.stop( sec(10.5), "a", all_stats=True )
+    assert abs(stats["powers"][18] - (9*105.5 + 0.5*100.75 + 0.5*110)) < 1e-6, stats["powers"]
+    assert abs(stats["tot_power"] - stats["powers"][18]) < 1e-6
+    assert stats["per_sensor"][18][0][0] == 0.0 and stats["per_sensor"][18][0][-1] == 10.0
+    assert stats["per_sensor"][18][1][0] == 100.5 and stats["per_sensor"][18][1][-1] == 110.0
+    assert manager.stop( sec(10.5), "a" ) == -1
+
+    # session "b" integrates from its own, interpolated, start
+    tot = manager.stop( sec(10.5), "b" )
+    assert abs(tot - (4*108 + 0.5*105.75 + 0.5*110)) < 1e-6, tot
+
+    # sessions over a subset of nodes, with per-node energy
+    manager = IpmiSessionManager()
+    for s in range(0,11):
+        manager.sensor( sec(s), 18, 100.0, node="n1" )
+        manager.sensor( sec(s), 18, 200.0, node="n2" )
+        manager.sensor( sec(s), 19, 50.0, node="n2" )
+        if s==0:
+            manager.start( sec(0), "all" )
+            manager.start( sec(0), "n2", nodes=["n2"] )
+    stats = manager.stop( sec(10), "all", all_stats=True )
+    assert stats["nodes"] == { "n1": 1000.0, "n2": 2500.0 } and stats["tot_power"] == 3500.0, stats
+    stats = manager.stop( sec(10), "n2", all_stats=True )
+    assert list(stats["powers"].keys()) == [ "n2:18", "n2:19" ] and stats["tot_power"] == 2500.0, stats
+
+    # with no session open and no history, only the last chunks are kept
+    manager = IpmiSessionManager()
+    for s in range(0, 20000):
+        manager.sensor( sec(s*0.01), 18, 100.0 )
+    store = manager.stores[18]
+    assert len(store) == 20000 and len(store) - store.base <= 2*store.chunk_size, len(store) - store.base
+    assert len(store.ts_chunks) <= 3, len(store.ts_chunks)
+
+    # windows no session covered, from the history kept
+    manager = IpmiSessionManager( history=60 )
+    for s in range(0, 20000):
+        manager.sensor( sec(s*0.01), 18, 100.0 + (s % 100), node="n1" )
+        manager.nvidia_sensor( sec(s*0.01), 0, 50.0 )
+    store = manager.stores["n1:18"]
+    assert 6000 <= len(store) - store.base <= 6000 + 2*store.chunk_size, len(store) - store.base
+    result = manager.query( sec(150), sec(160) )
+    assert abs(result["powers"]["n1:18"] - 10*149.5) < 0.01 and result["stats"]["n1:18"]["max"] == 199.0, result
+    assert result["stats"]["n1:18"]["samples"] == 1001 and not result["stats"]["n1:18"]["truncated"]
+    assert result["nodes"] == { "n1": result["powers"]["n1:18"] } and result["tot_power"] == result["powers"]["n1:18"]
+    assert result["stats"]["nvidia-0"]["mean"] == 50.0
+    assert manager.query( sec(0), sec(10) )["stats"]["n1:18"]["truncated"]
+    assert list(manager.query( sec(150), sec(160), sensors=["nvidia-0"] )["stats"].keys()) == [ "nvidia-0" ]
+
+    # an open session keeps its samples beyond the history
+    manager = IpmiSessionManager( history=1 )
+    manager.sensor( sec(0), 18, 100.0 )
+    manager.start( sec(0), "long" )
+    for s in range(1, 20000):
+        manager.sensor( sec(s*0.01), 18, 100.0 )
+    assert manager.stores[18].base == 0
+    assert abs(manager.stop( sec(199.99), "long" ) - 19999.0) < 1e-6
+    assert len(manager.stores[18]) - manager.stores[18].base <= 2*manager.stores[18].chunk_size
 
-        return {"per_sensor":per_sensor, "tot_power":tot_power, "powers":powers, "start_time":str(start_time), "end_time":str(end_time)}
+    # a session past the memory allowed spills to disk, with the same results
+    with tempfile.TemporaryDirectory() as tmp:
+        results = []
+        for spill in ( 0, 100*1024 ):
+            manager = IpmiSessionManager( history=1, spill=spill, spill_dir=tmp )
+            manager.sensor( sec(0), 18, 100.0 )
+            manager.start( sec(0), "long" )
+            for s in range(1, 50000):
+                manager.sensor( sec(s*0.01), 18, 100.0 + (s % 7) )
+                manager.nvidia_sensor( sec(s*0.01), 0, 50.0 + (s % 3) )
+            if spill:
+                assert manager._resident() <= spill + 2*manager.stores[18].chunk_size*SAMPLE_BYTES, manager._resident()
+                assert manager.spilled() > 80000 and manager.buffered() == 99999 and not os.listdir(tmp)
+            results.append( manager.stop( sec(499.995), "long", all_stats=True ) )
+        assert results[0]["powers"] == results[1]["powers"], results[1]["powers"]
+        for sensor_id in ( 18, "nvidia-0" ):
+            assert all( np.array_equal(a, b) for a, b in zip( results[0]["per_sensor"][sensor_id], results[1]["per_sensor"][sensor_id] ) )
+        assert manager.spilled() <= 2*2*manager.stores[18].chunk_size, manager.spilled()
 
+    print("%s: all tests passed" % sys.argv[0])
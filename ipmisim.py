@@ -0,0 +1,434 @@
+import sys
+import time
+import math
+import random
+import socket
+import string
+import struct
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from pyipmi.msgs import create_message, create_response_message, encode_message, decode_message
+from pyipmi.interfaces.ipmb import IpmbHeaderReq, IpmbHeaderRsp, encode_ipmb_msg
+from pyipmi.interfaces.rmcp import RmcpMsg, AsfMsg, AsfPong, RMCP_CLASS_ASF, RMCP_CLASS_IPMI
+
+#
+# configuration
+#
+AUTH_TYPE_NONE      = 0
+AUTH_TYPE_STRAIGHT  = 4
+CC_OK               = 0x00
+CC_NODE_BUSY        = 0xc0
+CC_INVALID_COMMAND  = 0xc1
+CC_INVALID_DATA     = 0xcc
+CC_NOT_PRESENT      = 0xcb
+CC_INSUFFICIENT_PRIV = 0xd4
+SENSOR_M            = 8     # raw reading to watts, y = M*x
+DCMI_PERIODS        = [ 1, 2, 5, 15, 30, 0x41, 0x45 ]   # rolling averages: 1, 2, 5, 15, 30 s, 1 and 5 min
+
+class IpmiSimBmc:
+    """
+    This class is a stand-in BMC listening on a local UDP port.  It speaks
+    IPMI v1.5 over LAN ( RMCP ) with straight password authentication and
+    answers the requests used by IpmiMon:
+        * Get Device ID, Get SDR Repository Info, Reserve SDR Repository, Get SDR
+        * Get Sensor Reading for a set of simulated power sensors
+        * DCMI Get Power Reading for the total of those sensors, with the
+          averages over the rolling periods of DCMI_PERIODS, and the DCMI
+          capabilities listing those periods
+    Each request is answered after a configurable latency ( plus jitter ) and
+    sensor reads fail with a completion code at a configurable error rate.
+    """
+
+    def __init__(self,  ip="127.0.0.1",
+                        port=6230,
+                        username="admin",
+                        password="admin",
+                        records=8,
+                        latency=0.0,
+                        jitter=0.0,
+                        error_rate=0.0,
+                        parallel=4,
+                        seed=None,
+                        debug=False):
+
+        self.ip         = ip
+        self.port       = port
+        self.username   = username
+        self.password   = password
+        self.latency    = latency
+        self.jitter     = jitter
+        self.error_rate = error_rate
+        self.parallel   = parallel
+        self.debug      = debug
+        self.random     = random.Random(seed)
+        self.sock       = None
+        self.pool       = None
+        self.thread     = None
+        self.stop_event = threading.Event()
+        self.lock       = threading.Lock()
+        self.challenges = {}
+        self.sessions   = {}
+        self.reservation_id = 0
+        self.started    = time.time()
+        self.requests   = 0
+
+        # Simulated power sensors, record ids and sensor numbers start at 1
+        self.sensors    = []
+        for n in range(1, records+1):
+            self.sensors.append( {  'record_id' : n,
+                                    'number'    : n,
+                                    'name'      : "PSU%d Input Power" % n,
+                                    'base'      : 150.0 + 40*(n % 5),
+                                    'amplitude' : 30.0,
+                                    'period'    : 20.0 + n } )
+        self.sdr = dict( (s['record_id'], self._full_sensor_record(s)) for s in self.sensors )
+
+    def start(self):
+        """
+        This function binds the UDP port and answers requests from a background thread.
+        """
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind( (self.ip, self.port) )
+        self.sock.settimeout(0.2)
+        self.port = self.sock.getsockname()[1]
+        self.pool = ThreadPoolExecutor(self.parallel)
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._serve, name="IpmiSimBmc", daemon=True)
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+
+        self.stop_event.set()
+        if self.thread: self.thread.join()
+        if self.pool: self.pool.shutdown()
+        if self.sock: self.sock.close()
+
+    def value(self, sensor, t=None):
+        """
+        This function returns the simulated reading of a sensor in watts.
+        """
+
+        if t is None: t = time.time()
+        phase = 2*math.pi*(t - self.started)/sensor['period']
+        return sensor['base'] + sensor['amplitude']*math.sin(phase) + self.random.uniform(-2,2)
+
+    def _serve(self):
+
+        while not self.stop_event.is_set():
+            try:
+                pdu, addr = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.pool.submit(self._handle, pdu, addr)
+
+    def _handle(self, pdu, addr):
+
+        try:
+            rmcp = RmcpMsg()
+            sdu = rmcp.unpack(pdu)
+
+            if rmcp.class_of_msg == RMCP_CLASS_ASF:
+                ping = AsfMsg.from_data(sdu)
+                pong = AsfPong()
+                pong.tag = ping.tag
+                pong.supported_entities = 0x81
+                self.sock.sendto( RmcpMsg(RMCP_CLASS_ASF).pack(pong.pack(), 0xff), addr )
+                return
+
+            if rmcp.class_of_msg != RMCP_CLASS_IPMI:
+                return
+
+            # session header: auth type, sequence number, session id, [auth code], length
+            auth_type = sdu[0]
+            (sequence, session_id) = struct.unpack('<II', sdu[1:9])
+            if auth_type != AUTH_TYPE_NONE:
+                auth_code = sdu[9:25]
+                msg = sdu[26:26+sdu[25]]
+            else:
+                auth_code = None
+                msg = sdu[10:10+sdu[9]]
+
+            header = IpmbHeaderReq()
+            header.decode(msg)
+            payload = msg[6:-1]
+
+            delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+            if delay > 0: time.sleep(delay)
+
+            data = self._dispatch(header.netfn, header.cmdid, payload, session_id, auth_code)
+
+            rsp_header = IpmbHeaderRsp()
+            rsp_header.from_req_header(header)
+            rsp = encode_ipmb_msg(rsp_header, data)
+
+            with self.lock:
+                session = self.sessions.get(session_id)
+                if session:
+                    session['outbound'] = (session['outbound'] + 1) & 0xffffffff
+                    outbound = session['outbound']
+                else:
+                    outbound = 0
+                self.requests += 1
+
+            reply = struct.pack('<BII', auth_type, outbound, session_id)
+            if auth_type != AUTH_TYPE_NONE:
+                reply = reply[:1] + struct.pack('<II', outbound, session_id) + self._password_bytes()
+            reply += bytes([len(rsp)]) + rsp
+            self.sock.sendto( RmcpMsg(RMCP_CLASS_IPMI).pack(reply, 0xff), addr )
+
+        except:
+            if self.debug: traceback.print_exc()
+
+    def _password_bytes(self):
+        return self.password.encode().ljust(16, b'\x00')
+
+    def _dispatch(self, netfn, cmdid, payload, session_id, auth_code):
+        """
+        This function decodes a request and returns the encoded response,
+        starting with the completion code.
+        """
+
+        try:
+            req = create_message(netfn, cmdid, None)
+        except KeyError:
+            try:
+                req = create_message(netfn, cmdid, payload[0] if payload else None)
+            except KeyError:
+                return bytes([CC_INVALID_COMMAND])
+        decode_message(req, payload)
+
+        handler = getattr(self, "_" + type(req).__name__[:-3], None)
+        if handler is None:
+            return bytes([CC_INVALID_COMMAND])
+
+        # only the session setup is allowed outside of an activated session
+        if handler not in (self._GetChannelAuthenticationCapabilities, self._GetSessionChallenge, self._ActivateSession):
+            if session_id not in self.sessions:
+                return bytes([CC_INSUFFICIENT_PRIV])
+
+        rsp = create_response_message(req)
+        cc = handler(req, rsp, session_id, auth_code)
+        if cc: return bytes([cc])
+        rsp.completion_code = CC_OK
+        return encode_message(rsp)
+
+    #
+    # Session setup
+    #
+    def _GetChannelAuthenticationCapabilities(self, req, rsp, session_id, auth_code):
+        rsp.channel_number = 1
+        rsp.support.straight = 1
+        setattr(rsp.extended_capabilities, '1_5', 1)
+        rsp.oem_id = 0
+        rsp.oem_auxiliary_data = 0
+
+    def _GetSessionChallenge(self, req, rsp, session_id, auth_code):
+        user = req.user_name
+        if isinstance(user, bytes): user = user.decode()
+        if user.rstrip('\x00') != self.username:
+            return CC_INVALID_DATA
+        temporary = self.random.randrange(1, 0xffffffff)
+        challenge = "".join( self.random.choice(string.ascii_letters) for i in range(16) )
+        with self.lock:
+            self.challenges[temporary] = challenge
+        rsp.temporary_session_id = temporary
+        rsp.challenge_string = challenge
+
+    def _ActivateSession(self, req, rsp, session_id, auth_code):
+        with self.lock:
+            challenge = self.challenges.pop(session_id, None)
+        if challenge is None or auth_code != self._password_bytes():
+            return CC_INVALID_DATA
+        new_id = self.random.randrange(1, 0xffffffff)
+        with self.lock:
+            self.sessions[new_id] = { 'outbound': req.initial_outbound_sequence_number }
+        rsp.authentication.type = req.authentication.type
+        rsp.session_id = new_id
+        rsp.initial_inbound_sequence_number = self.random.randrange(1, 0xffffffff)
+        rsp.privilege_level.maximum_allowed = req.privilege_level.maximum_requested
+
+    def _SetSessionPrivilegeLevel(self, req, rsp, session_id, auth_code):
+        rsp.privilege_level.new = req.privilege_level.requested or 2
+
+    def _CloseSession(self, req, rsp, session_id, auth_code):
+        with self.lock:
+            self.sessions.pop(req.session_id, None)
+
+    #
+    # Device and SDR repository
+    #
+    def _GetDeviceId(self, req, rsp, session_id, auth_code):
+        rsp.device_id = 0x20
+        rsp.device_revision.device_revision = 1
+        rsp.device_revision.provides_device_sdrs = 0
+        rsp.firmware_revision.major = 1
+        rsp.firmware_revision.device_available = 0
+        rsp.firmware_revision.minor = 0
+        rsp.ipmi_version = 0x51
+        rsp.additional_support.sensor = 1
+        rsp.additional_support.sdr_repository = 1
+        rsp.additional_support.sel = 0
+        rsp.additional_support.fru_inventory = 0
+        rsp.additional_support.ipmb_event_receiver = 0
+        rsp.additional_support.ipmb_event_generator = 0
+        rsp.additional_support.bridge = 0
+        rsp.additional_support.chassis = 1
+        rsp.manufacturer_id = 0
+        rsp.product_id = 0x1234
+        rsp.auxiliary = None
+
+    def _GetSdrRepositoryInfo(self, req, rsp, session_id, auth_code):
+        rsp.sdr_version = 0x51
+        rsp.record_count = len(self.sdr)
+        rsp.free_space = 0x1000
+        rsp.most_recent_addition = int(self.started)
+        rsp.most_recent_erase = int(self.started)
+        rsp.support.get_allocation_info = 0
+        rsp.support.reserve = 1
+        rsp.support.partial_add = 0
+        rsp.support.delete = 0
+        rsp.support.update_type = 1
+        rsp.support.overflow_flag = 0
+
+    def _ReserveSdrRepository(self, req, rsp, session_id, auth_code):
+        with self.lock:
+            self.reservation_id = (self.reservation_id % 0xffff) + 1
+            rsp.reservation_id = self.reservation_id
+
+    def _GetSdr(self, req, rsp, session_id, auth_code):
+        ids = sorted(self.sdr.keys())
+        record_id = ids[0] if req.record_id == 0 else req.record_id
+        if record_id not in self.sdr:
+            return CC_NOT_PRESENT
+        data = self.sdr[record_id]
+        length = len(data) if req.bytes_to_read == 0xff else req.bytes_to_read
+        idx = ids.index(record_id)
+        rsp.next_record_id = ids[idx+1] if idx+1 < len(ids) else 0xffff
+        rsp.record_data = data[req.offset:req.offset+length]
+
+    def _full_sensor_record(self, sensor):
+        """
+        This function encodes a Full Sensor Record for a threshold power sensor
+        reading watts, y = SENSOR_M * raw.
+        """
+
+        name = sensor['name'].encode()
+        body = bytes([  0x20, 0x00, sensor['number'],       # owner id, owner lun, sensor number
+                        0x0a, 0x01,                         # entity: power supply, instance
+                        0x7f, 0x68,                         # initialization, capabilities
+                        0x0b, 0x01,                         # sensor type, threshold reading type
+                        0, 0, 0, 0, 0, 0,                   # assertion, deassertion, reading masks
+                        0x00, 0x06, 0x00,                   # unsigned, watts, no modifier
+                        0x00,                               # linear
+                        SENSOR_M, 0x00, 0x00, 0x00, 0x00,   # M, tolerance, B, accuracy
+                        0x00,                               # R and B exponents
+                        0x00, 0, 0, 0, 0xff, 0x00,          # analog flags, nominal, normal max/min, sensor max/min
+                        0, 0, 0, 0, 0, 0,                   # thresholds
+                        0, 0,                               # hysteresis
+                        0, 0, 0 ])                          # reserved, oem
+        body += bytes([0xc0 | len(name)]) + name
+        header = struct.pack('<HBBB', sensor['record_id'], 0x51, 0x01, len(body))
+        return header + body
+
+    #
+    # Sensors
+    #
+    def _GetSensorReading(self, req, rsp, session_id, auth_code):
+        sensor = [ s for s in self.sensors if s['number'] == req.sensor_number ]
+        if not sensor:
+            return CC_NOT_PRESENT
+        if self.random.random() < self.error_rate:
+            return CC_NODE_BUSY
+        raw = int(round(self.value(sensor[0]) / SENSOR_M))
+        rsp.sensor_reading = max(0, min(255, raw))
+        rsp.config.initial_update_in_progress = 0
+        rsp.config.sensor_scanning_disabled = 0
+        rsp.config.event_message_disabled = 0
+        rsp.states1 = 0
+        rsp.states2 = 0x80
+
+    def _GetPowerReading(self, req, rsp, session_id, auth_code):
+        if self.random.random() < self.error_rate:
+            return CC_NODE_BUSY
+        if req.mode not in (1, 2):
+            return CC_INVALID_DATA
+        now = time.time()
+        # the enhanced statistics average over the rolling period asked for,
+        # the system statistics over the time since the BMC started
+        if req.mode == 2:
+            if req.attributes not in DCMI_PERIODS:
+                return CC_INVALID_DATA
+            period = [ 1, 60, 3600, 86400 ][req.attributes >> 6] * (req.attributes & 0x3f)
+        else:
+            period = now - self.started
+        current = sum( self.value(s, now) for s in self.sensors )
+        window = [ sum( self.value(s, now - k*period/8) for s in self.sensors ) for k in range(8) ]
+        rsp.current_power = int(current)
+        rsp.minimum_power = int(min(window))
+        rsp.maximum_power = int(max(window))
+        rsp.average_power = int(round( self.energy(now - period, now) / period ))
+        rsp.timestamp = int(now)
+        rsp.period = int(1000*period)
+        rsp.reading_state = 0x40
+
+    def _GetDcmiCapabilities(self, req, rsp, session_id, auth_code):
+        if req.parameter_selector != 5:
+            return CC_INVALID_DATA
+        rsp.specification_conformance.major = 1
+        rsp.specification_conformance.minor = 5
+        rsp.parameter_revision = 2
+        rsp.parameter_data = [ len(DCMI_PERIODS) ] + DCMI_PERIODS
+
+    def energy(self, t0, t1):
+        """
+        This function returns the energy in joules of all the simulated sensors
+        between two times, without the noise of the readings.
+        """
+
+        joules = 0.0
+        for s in self.sensors:
+            w = 2*math.pi/s['period']
+            joules += s['base']*(t1 - t0) - s['amplitude']/w*( math.cos(w*(t1 - self.started)) - math.cos(w*(t0 - self.started)) )
+        return joules
+
+#
+# To run a simulated BMC, type "python ipmisim.py --port 6230 --records 16"
+#
+if __name__ == "__main__":
+
+    import argparse
+    parser  = argparse.ArgumentParser(description='Simulated IPMI BMC.')
+    parser.add_argument('--ip',         dest='ip', default="127.0.0.1", help='The address to listen on')
+    parser.add_argument('--port',       dest='port', type=int, default=6230, help='The UDP port to listen on (0 picks a free port)')
+    parser.add_argument('--username',   dest='username', default="admin", help='The accepted username')
+    parser.add_argument('--password',   dest='password', default="admin", help='The accepted password')
+    parser.add_argument('--records',    dest='records', type=int, default=8, help='The number of simulated power sensor records')
+    parser.add_argument('--latency',    dest='latency', type=float, default=0.0, help='Seconds before each request is answered')
+    parser.add_argument('--jitter',     dest='jitter', type=float, default=0.0, help='Uniform +/- jitter in seconds added to the latency')
+    parser.add_argument('--error-rate', dest='error_rate', type=float, default=0.0, help='Fraction of sensor reads answered with an error completion code')
+    parser.add_argument('--parallel',   dest='parallel', type=int, default=4, help='The number of requests the BMC works on at once')
+    parser.add_argument('--debug',      dest='debug', action='store_true', help='Verbose debug mode')
+    args    = parser.parse_args()
+
+    bmc = IpmiSimBmc(   ip          = args.ip,
+                        port        = args.port,
+                        username    = args.username,
+                        password    = args.password,
+                        records     = args.records,
+                        latency     = args.latency,
+                        jitter      = args.jitter,
+                        error_rate  = args.error_rate,
+                        parallel    = args.parallel,
+                        debug       = args.debug )
+    port = bmc.start()
+    print("%s: simulated BMC listening on %s:%d" % (sys.argv[0], args.ip, port), flush=True)
+    try:
+        while True: time.sleep(1)
+    except KeyboardInterrupt:
+        bmc.stop()
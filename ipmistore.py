@@ -0,0 +1,455 @@
+import sys
+import os
+import time
+import datetime
+import tempfile
+import threading
+import numpy as np
+
+#
+# configuration
+#
+CHUNK_SIZE = 4096
+SAMPLE_BYTES = 24           # a timestamp, a value and the running energy
+SPILL_SEGMENT = 64          # chunks per spill file
+
+# the one wall clock reading of the run: sample times are this anchor plus
+# the monotonic time elapsed since, so a step of the system clock ( NTP )
+# neither moves nor reorders them
+WALL_ANCHOR_NS = time.time_ns()
+MONOTONIC_ANCHOR_NS = time.monotonic_ns()
+
+def now_ns():
+    """Return the time as int64 nanoseconds since the epoch, off the monotonic clock."""
+    return WALL_ANCHOR_NS + time.monotonic_ns() - MONOTONIC_ANCHOR_NS
+
+def datetime_to_ns(dt):
+    """Convert a datetime into int64 nanoseconds since the epoch."""
+    return round(dt.timestamp()*1e6)*1000
+
+def to_ns(t):
+    """Return a time given as nanoseconds since the epoch or as a datetime in nanoseconds."""
+    return datetime_to_ns(t) if isinstance(t, datetime.datetime) else int(t)
+
+def ns_to_datetime(ns):
+    """Convert nanoseconds since the epoch into a local datetime, for display."""
+    return datetime.datetime.fromtimestamp(ns // 1000 / 1e6)
+
+class IpmiSampleStore:
+    """This class holds the samples of one sensor in an append-only columnar
+    store.  Timestamps (int64 nanoseconds) and values (float64) are kept in
+    fixed size chunks, so appending never copies previously stored samples.
+
+    A third column holds the running trapezoid integral of the values (the
+    energy in joules for a power sensor) from the first sample ever appended,
+    so the energy between any two times is the difference of two lookups.
+
+    When the sensor has a cumulative hardware energy counter (e.g. a GPU),
+    append() can be given its reading and the energy column then follows the
+    counter deltas instead of the integral, falling back to the trapezoid
+    across a counter reset.
+
+    Samples are addressed by a global index that stays valid for the life of
+    the store, even after old chunks have been released with trim().
+
+    The largest value of each full chunk is kept too, with a sparse table
+    over those ( rebuilt when chunks are added or released ), so stats()
+    finds the energy, mean and peak of any time window with a few binary
+    searches and lookups, however long the window.
+
+    Full chunks can be moved out of memory with spill(): they are copied to
+    append-only files, which are memory-mapped, and the chunk lists then
+    refer to the mapped copies, so every reader works unchanged and the
+    kernel pages them in and out as needed.
+
+    The store does no locking itself: threads sharing a store hold its lock
+    around every call.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+
+        self.chunk_size = chunk_size
+        self.ts_chunks  = []
+        self.val_chunks = []
+        self.energy_chunks = []
+        self.peaks      = []        # the largest value of each full chunk
+        self.peak_table = None
+        self.last_ts    = None
+        self.last_val   = None
+        self.last_energy = 0.0
+        self.last_counter = None
+        self.counter    = False     # energy column follows a hardware counter
+        self.base       = 0     # global index of the first retained sample
+        self.length     = 0     # global index one past the last sample
+        self.spilled    = 0     # the chunks at the front kept in spill files
+        self.segment    = None  # the spill file being filled, and its descriptor
+        self.segment_fd = None
+        self.segment_used = 0
+        self.lock       = threading.Lock()
+
+    def __len__(self):
+        return self.length
+
+    def append(self, ts, value, energy=None):
+        """
+        This function appends one sample to the store, with the reading of
+        the sensor's cumulative energy counter in joules if it has one.
+        """
+
+        if self.last_ts is not None:
+            if energy is not None and self.last_counter is not None and energy >= self.last_counter:
+                self.last_energy += energy - self.last_counter
+            else:
+                self.last_energy += (self.last_val + value) * 0.5 * (ts - self.last_ts) / 1e9
+        if energy is not None:
+            self.counter = True
+        self.last_counter = energy
+
+        chunk, pos = divmod(self.length - self.base, self.chunk_size)
+        if chunk == len(self.ts_chunks):
+            self.ts_chunks.append( np.empty(self.chunk_size, dtype=np.int64) )
+            self.val_chunks.append( np.empty(self.chunk_size, dtype=np.float64) )
+            self.energy_chunks.append( np.empty(self.chunk_size, dtype=np.float64) )
+        self.ts_chunks[chunk][pos] = ts
+        self.val_chunks[chunk][pos] = value
+        self.energy_chunks[chunk][pos] = self.last_energy
+        if pos == self.chunk_size-1:
+            self.peaks.append( float(self.val_chunks[chunk].max()) )
+        self.last_ts = ts
+        self.last_val = value
+        self.length += 1
+
+    def slice(self, start, end):
+        """
+        This function returns copies of the timestamps and values of the
+        samples with global index in [start, end).
+        """
+
+        start = max(start, self.base)
+        end = min(end, self.length)
+        if end <= start:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+        first = (start - self.base) // self.chunk_size
+        last = (end - 1 - self.base) // self.chunk_size
+        offset = self.base + first*self.chunk_size
+        ts = np.concatenate( self.ts_chunks[first:last+1] )[start-offset:end-offset]
+        val = np.concatenate( self.val_chunks[first:last+1] )[start-offset:end-offset]
+        return ts, val
+
+    def chunks(self, start, end):
+        """
+        This function yields the timestamps and values of the samples with
+        global index in [start, end), a chunk at a time, as views of the
+        store, so spilled chunks are read from their files one by one.
+        """
+
+        index = max(start, self.base)
+        end = min(end, self.length)
+        while index < end:
+            chunk, pos = divmod(index - self.base, self.chunk_size)
+            stop = min(self.chunk_size, pos + end - index)
+            yield self.ts_chunks[chunk][pos:stop], self.val_chunks[chunk][pos:stop]
+            index += stop - pos
+
+    def resident(self):
+        """
+        This function returns the number of samples held in memory, not
+        counting the spilled ones.
+        """
+
+        return self.length - self.base - self.spilled*self.chunk_size
+
+    def spill(self, directory=None):
+        """
+        This function moves the full chunks still in memory to spill files
+        in the directory ( the system's temporary directory if None ), and
+        returns the number of chunks moved.
+        """
+
+        full = (self.length - self.base) // self.chunk_size
+        for chunk in range(self.spilled, full):
+            if self.segment is None or self.segment_used == SPILL_SEGMENT:
+                if self.segment_fd is not None: os.close(self.segment_fd)
+                self.segment_fd, self.segment = _spill_segment(directory, self.chunk_size)
+                self.segment_used = 0
+            # written through the descriptor, so the pages are only mapped
+            # into the process when the chunk is read
+            columns = ( self.ts_chunks[chunk], self.val_chunks[chunk], self.energy_chunks[chunk] )
+            os.pwrite( self.segment_fd, b"".join( c.tobytes() for c in columns ), self.segment_used*3*self.chunk_size*8 )
+            rows = self.segment[self.segment_used]
+            self.ts_chunks[chunk] = rows[0]
+            self.val_chunks[chunk] = rows[1].view(np.float64)
+            self.energy_chunks[chunk] = rows[2].view(np.float64)
+            self.segment_used += 1
+        moved = max(0, full - self.spilled)
+        self.spilled += moved
+        return moved
+
+    def trim(self, index):
+        """
+        This function releases all chunks whose samples are entirely before
+        the global index.
+        """
+
+        drop = (min(index, self.length) - self.base) // self.chunk_size
+        if drop > 0:
+            del self.ts_chunks[:drop]
+            del self.val_chunks[:drop]
+            del self.energy_chunks[:drop]
+            del self.peaks[:drop]
+            self.base += drop*self.chunk_size
+            self.spilled = max(0, self.spilled - drop)
+
+    def energy_at(self, t):
+        """
+        This function returns the running integral at time t, interpolating
+        linearly between the samples around t.  Before the first and after
+        the last retained sample the nearest value is held constant.
+        """
+
+        return self._interpolate(t)[1]
+
+    def value_at(self, t):
+        """
+        This function returns the linearly interpolated value at time t.
+        """
+
+        return self._interpolate(t)[0]
+
+    def window(self, t0, t1):
+        """
+        This function returns the timestamps and values of the samples taken
+        in [t0, t1], with interpolated values at t0 and t1 added as endpoints.
+        """
+
+        ts, val = self.slice( self._locate(t0)+1, self._locate(t1)+1 )
+        ts = np.concatenate( ([t0], ts, [t1]) )
+        val = np.concatenate( ([self.value_at(t0)], val, [self.value_at(t1)]) )
+        return ts, val
+
+    def window_seconds(self, t0, t1):
+        """
+        This function returns the same window as window(), with the times in
+        seconds since t0, filled in a chunk at a time.
+        """
+
+        start, end = self._locate(t0)+1, self._locate(t1)+1
+        ts = np.empty( end - start + 2 )
+        val = np.empty( end - start + 2 )
+        ts[0], val[0] = 0.0, self.value_at(t0)
+        i = 1
+        for chunk_ts, chunk_val in self.chunks(start, end):
+            np.subtract( chunk_ts, t0, out=ts[i:i+len(chunk_ts)], casting='unsafe' )
+            val[i:i+len(chunk_val)] = chunk_val
+            i += len(chunk_ts)
+        ts[1:-1] /= 1e9
+        ts[-1], val[-1] = (t1 - t0)/1e9, self.value_at(t1)
+        return ts, val
+
+    def stats(self, t0, t1):
+        """
+        This function returns the energy, mean power ( energy / duration ),
+        largest value and number of samples of the window [t0, t1], with
+        the values interpolated at t0 and t1 counted as samples for the peak.
+        """
+
+        # the samples taken in [t0, t1] ( the timestamps are integer ns )
+        start, end = self._locate(t0-1)+1, self._locate(t1)+1
+        v0, e0 = self._interpolate(t0)
+        v1, e1 = self._interpolate(t1)
+        peak = max(v0, v1)
+        if end > start:
+            peak = max( peak, self._max_range(start, end) )
+        return {    "energy"    : e1 - e0,
+                    "mean"      : (e1 - e0)/((t1 - t0)/1e9) if t1 > t0 else v0,
+                    "max"       : peak,
+                    "samples"   : end - start }
+
+    def oldest(self):
+        """
+        This function returns the time of the oldest retained sample.
+        """
+
+        return self._get(self.base)[0]
+
+    def _max_range(self, start, end):
+        """
+        This function returns the largest value of the samples with global
+        index in [start, end): the partial chunks at either end are scanned,
+        the full chunks in between are looked up in the sparse table.
+        """
+
+        c0, p0 = divmod(start - self.base, self.chunk_size)
+        c1, p1 = divmod(end - self.base, self.chunk_size)
+        if c0 == c1:
+            return float(self.val_chunks[c0][p0:p1].max())
+        peak = float(self.val_chunks[c0][p0:].max())
+        if p1:
+            peak = max( peak, float(self.val_chunks[c1][:p1].max()) )
+        if c1 > c0+1:
+            table = self._peak_table()
+            k = (c1 - c0 - 1).bit_length() - 1
+            peak = max( peak, float(table[k][c0+1]), float(table[k][c1 - (1<<k)]) )
+        return peak
+
+    def _peak_table(self):
+
+        key = ( self.base, len(self.peaks) )
+        if self.peak_table is None or self.peak_table[0] != key:
+            levels = [ np.array(self.peaks) ]
+            while 2**len(levels) <= len(self.peaks):
+                half = 2**(len(levels)-1)
+                levels.append( np.maximum( levels[-1][:-half], levels[-1][half:] ) )
+            self.peak_table = ( key, levels )
+        return self.peak_table[1]
+
+    def _get(self, index):
+
+        chunk, pos = divmod(index - self.base, self.chunk_size)
+        return int(self.ts_chunks[chunk][pos]), float(self.val_chunks[chunk][pos]), float(self.energy_chunks[chunk][pos])
+
+    def _locate(self, t):
+        """
+        This function returns the global index of the last sample taken at
+        or before time t, or base-1 if there is none.
+        """
+
+        lo, hi = 0, len(self.ts_chunks)
+        while lo < hi:
+            mid = (lo+hi)//2
+            if self.ts_chunks[mid][0] <= t: lo = mid+1
+            else: hi = mid
+        chunk = lo-1
+        if chunk < 0:
+            return self.base-1
+        count = min(self.chunk_size, self.length - self.base - chunk*self.chunk_size)
+        pos = int(np.searchsorted(self.ts_chunks[chunk][:count], t, side='right')) - 1
+        return self.base + chunk*self.chunk_size + pos
+
+    def _interpolate(self, t):
+
+        if self.length == self.base:
+            raise Exception("ERR: No samples in store.")
+
+        index = self._locate(t)
+        if index < self.base:
+            ts0, v0, e0 = self._get(self.base)
+            return v0, e0 - v0*(ts0 - t)/1e9
+
+        ts0, v0, e0 = self._get(index)
+        if index+1 >= self.length:
+            return v0, e0 + v0*(t - ts0)/1e9
+
+        ts1, v1, e1 = self._get(index+1)
+        vt = v0 + (v1 - v0)*(t - ts0)/(ts1 - ts0)
+        if self.counter:
+            return vt, e0 + (e1 - e0)*(t - ts0)/(ts1 - ts0)
+        return vt, e0 + (v0 + vt)*0.5*(t - ts0)/1e9
+
+def _spill_segment(directory, chunk_size):
+    """
+    This function creates a spill file of SPILL_SEGMENT chunks and returns
+    its descriptor and a read-only mapping of it.  The file is unlinked at
+    once: its space is freed when the last chunk mapped from it is released,
+    or when the process exits.
+    """
+
+    fd, path = tempfile.mkstemp( prefix="ipmicap-spill-", dir=directory )
+    try:
+        os.ftruncate( fd, SPILL_SEGMENT*3*chunk_size*8 )
+        segment = np.memmap( path, dtype=np.int64, mode='r', shape=(SPILL_SEGMENT, 3, chunk_size) )
+    except:
+        os.close(fd)
+        raise
+    finally:
+        os.unlink(path)
+    return fd, segment
+
+#
+# To run the unit tests below for IpmiSampleStore, type "python ipmistore.py"
+#
+if __name__ == "__main__":
+
+    store = IpmiSampleStore(chunk_size=4)
+    for i in range(10):
+        store.append( i*1000, i*0.5 )
+
+    ts, val = store.slice(2, 9)
+    assert ts.tolist() == [ i*1000 for i in range(2,9) ], ts
+    assert val.tolist() == [ i*0.5 for i in range(2,9) ], val
+
+    store.trim(6)
+    assert store.base == 4 and len(store.ts_chunks) == 2
+    ts, val = store.slice(0, 10)
+    assert ts.tolist() == [ i*1000 for i in range(4,10) ], ts
+
+    store.append( 10000, 5.0 )
+    assert len(store) == 11
+    assert store.slice(10, 11)[1].tolist() == [5.0]
+
+    dt = datetime.datetime(2021,6,2,22,8,52,123456)
+    assert datetime_to_ns(dt) % 1000 == 0
+    assert datetime.datetime.fromtimestamp(datetime_to_ns(dt)/1e9) == dt
+    assert ns_to_datetime(datetime_to_ns(dt) + 999) == dt and to_ns(dt) == to_ns(datetime_to_ns(dt))
+    assert abs( now_ns() - time.time_ns() ) < 10**9 and now_ns() <= now_ns()
+
+    # a step of the wall clock does not move the sample times
+    wall = time.time_ns
+    time.time_ns = lambda: wall() - 3600*10**9
+    assert abs( now_ns() - wall() ) < 10**9
+    time.time_ns = wall
+
+    # the running integral matches trapz over the interpolated window
+    store = IpmiSampleStore(chunk_size=3)
+    for i in range(20):
+        store.append( i*10**9, 100.0 + (i%4)*10 )
+    ts, val = store.window( int(2.5e9), int(17.25e9) )
+    assert ts[0] == 2.5e9 and ts[-1] == 17.25e9 and len(ts) == 17
+    assert val[0] == 125.0 and abs(val[-1] - 112.5) < 1e-9, val
+    energy = store.energy_at(int(17.25e9)) - store.energy_at(int(2.5e9))
+    assert abs(energy - np.trapezoid(val, ts/1e9)) < 1e-9, energy
+    assert store.energy_at(-10**9) == -100.0 and store.value_at(25*10**9) == 130.0
+
+    # a hardware energy counter is used in place of the integral, except across a reset
+    store = IpmiSampleStore(chunk_size=3)
+    for i, counter in enumerate([ 1000.0, 1150.0, 1300.0, 10.0, 160.0 ]):
+        store.append( i*10**9, 100.0, counter )
+    assert store.last_energy == 150.0 + 150.0 + 100.0 + 150.0, store.last_energy
+    assert store.energy_at(int(0.5e9)) == 75.0 and store.energy_at(int(2.5e9)) == 350.0
+
+    # window stats against the samples themselves, before and after a trim
+    rng = np.random.default_rng(1)
+    store = IpmiSampleStore(chunk_size=8)
+    values = rng.uniform(0, 100, 500)
+    for i, v in enumerate(values):
+        store.append( i*10**9, v )
+    for trimmed in ( False, True ):
+        if trimmed: store.trim(100)
+        for t0, t1 in rng.integers( store.oldest()//10**9, 520, size=(200, 2) ):
+            t0, t1 = min(t0, t1), max(t0, t1)
+            s = store.stats( int(t0*10**9), int(t1*10**9) + 5*10**8 )
+            inside = values[ t0:min(t1+1, 500) ]
+            assert s["samples"] == len(inside), (t0, t1, s)
+            assert s["max"] == max( list(inside) + [ store.value_at(int(t0*10**9)), store.value_at(int(t1*10**9) + 5*10**8) ] ), (t0, t1, s)
+            assert abs( s["mean"]*(t1 - t0 + 0.5) - s["energy"] ) < 1e-6
+    assert store.oldest() == 96*10**9 and len(store.peaks) == len(store.ts_chunks) - 1
+
+    # spilled chunks read back the same, and their files are already unlinked
+    with tempfile.TemporaryDirectory() as tmp:
+        before = [ store.stats( t*10**9, (t+37)*10**9 ) for t in range(90, 480, 13) ]
+        window = store.window_seconds( 123*10**9 + 5, 456*10**9 )
+        ts, val = store.window( 123*10**9 + 5, 456*10**9 )
+        assert np.allclose( window[0], (ts - ts[0])/1e9 ) and np.array_equal( window[1], val )
+        assert store.spill(tmp) == 50 and store.spilled == 50 and store.resident() == 4
+        assert isinstance( store.val_chunks[0].base, np.memmap ) and not os.listdir(tmp)
+        assert before == [ store.stats( t*10**9, (t+37)*10**9 ) for t in range(90, 480, 13) ]
+        assert all( np.array_equal(a, b) for a, b in zip( window, store.window_seconds( 123*10**9 + 5, 456*10**9 ) ) )
+        for i in range(500, 530):
+            store.append( i*10**9, 1.0 )
+        assert store.spill(tmp) == 4 and store.stats( 490*10**9, 529*10**9 )["samples"] == 40
+        store.trim(300)
+        assert store.spilled == 29 and store.base == 296 and store.resident() == 2
+        assert np.array_equal( np.concatenate([ v for _, v in store.chunks(0, 500) ]), values[296:] )
+
+    print("%s: all tests passed" % sys.argv[0])
@@ -0,0 +1,247 @@
+import sys
+import json
+import threading
+import collections
+import traceback
+from ipmistore import to_ns
+
+#
+# configuration
+#
+STREAM_QUEUE_SIZE = 1000
+
+class IpmiStreamClient:
+    """
+    This class holds one subscriber's filter and its bounded queue of
+    samples not yet sent.
+    """
+
+    def __init__(self, send, sensors=None, rate=None, queue_size=STREAM_QUEUE_SIZE):
+
+        self.send       = send
+        self.sensors    = set(sensors) if sensors else None
+        self.interval   = int(1e9/rate) if rate else 0     # ns between samples of one sensor
+        self.queue      = collections.deque()
+        self.queue_size = queue_size
+        self.lock       = threading.Lock()
+        self.last_sent  = {}
+        self.dropped    = 0
+        self.scheduled  = False
+        self.closed     = False
+
+class IpmiBroadcaster:
+    """
+    This class pushes samples to live subscribers ( the /stream WebSocket
+    and /events Server-Sent Events handlers. )
+
+    publish() is called by the sampling threads and never blocks them: it
+    only appends to each matching client's bounded queue, dropping the
+    sample when the queue is full.  The queues are drained on the IOLoop,
+    with at most one send in flight per client, so a slow client loses
+    samples ( and is told how many ) instead of holding up the others.
+    """
+
+    def __init__(self, queue_size=STREAM_QUEUE_SIZE, debug=False):
+
+        self.queue_size = queue_size
+        self.debug      = debug
+        self.clients    = []
+        self.lock       = threading.Lock()
+        self.ioloop     = None
+
+    def subscribe(self, send, sensors=None, rate=None):
+        """
+        This function adds a subscriber.  It must be called on the IOLoop,
+        and send(message) must return an awaitable.  Only the named sensors
+        are sent ( all if None ), at most rate samples/s per sensor.
+        """
+
+        from tornado.ioloop import IOLoop
+        self.ioloop = IOLoop.current()
+        client = IpmiStreamClient( send, sensors, rate, self.queue_size )
+        with self.lock:
+            self.clients = self.clients + [ client ]
+        return client
+
+    def unsubscribe(self, client):
+
+        client.closed = True
+        with self.lock:
+            self.clients = [ c for c in self.clients if c is not client ]
+
+    def publish(self, ts, sensor, value):
+        """
+        This function offers one sample to every subscriber.
+        """
+
+        clients = self.clients
+        if not clients:
+            return
+        ts = to_ns(ts)
+        for client in clients:
+            if client.sensors is not None and sensor not in client.sensors:
+                continue
+            with client.lock:
+                if client.interval:
+                    if ts - client.last_sent.get(sensor, -client.interval) < client.interval:
+                        continue
+                    client.last_sent[sensor] = ts
+                if len(client.queue) >= client.queue_size:
+                    client.dropped += 1
+                else:
+                    client.queue.append( (ts, sensor, value) )
+                if client.scheduled:
+                    continue
+                client.scheduled = True
+            self.ioloop.add_callback( self._drain, client )
+
+    async def _drain(self, client):
+
+        while not client.closed:
+            with client.lock:
+                samples = list(client.queue)
+                client.queue.clear()
+                dropped = client.dropped
+                client.dropped = 0
+                if not samples and not dropped:
+                    client.scheduled = False
+                    return
+            try:
+                await client.send( json.dumps( { "samples": samples, "dropped": dropped } ) )
+            except:
+                if self.debug: traceback.print_exc()
+                self.unsubscribe(client)
+                return
+
+def stream_handlers(broadcaster):
+    """
+    This function returns the tornado routes for the /stream WebSocket and
+    the /events Server-Sent Events endpoints.  Both take 'sensors' ( comma
+    separated, e.g. 5029,nvidia-0 ) and 'rate' ( Hz per sensor ) arguments
+    and send JSON messages { "samples": [ [ ns, sensor, value ], ... ],
+    "dropped": n }.
+    """
+
+    import tornado.web
+    import tornado.websocket
+    import tornado.locks
+    from tornado.iostream import StreamClosedError
+
+    def parse(handler):
+        sensors = handler.get_argument("sensors", None)
+        rate = handler.get_argument("rate", None)
+        return ( sensors.split(",") if sensors else None ), ( float(rate) if rate else None )
+
+    class StreamHandler(tornado.websocket.WebSocketHandler):
+        """Pushes samples over a WebSocket"""
+        def initialize(self, broadcaster):
+            self.broadcaster = broadcaster
+            self.client = None
+
+        def check_origin(self, origin):
+            return True
+
+        def open(self):
+            sensors, rate = parse(self)
+            self.client = self.broadcaster.subscribe( self.write_message, sensors, rate )
+
+        def on_close(self):
+            if self.client: self.broadcaster.unsubscribe(self.client)
+
+    class EventsHandler(tornado.web.RequestHandler):
+        """Pushes samples as Server-Sent Events"""
+        def initialize(self, broadcaster):
+            self.broadcaster = broadcaster
+            self.client = None
+            self.done = tornado.locks.Event()
+
+        def send(self, message):
+            self.write( "data: %s\n\n" % message )
+            return self.flush()
+
+        async def get(self):
+            sensors, rate = parse(self)
+            self.set_header("Content-Type", "text/event-stream")
+            self.set_header("Cache-Control", "no-cache")
+            await self.flush()
+            self.client = self.broadcaster.subscribe( self.send, sensors, rate )
+            try:
+                await self.done.wait()
+            except StreamClosedError:
+                pass
+
+        def on_connection_close(self):
+            if self.client: self.broadcaster.unsubscribe(self.client)
+            self.done.set()
+
+    return [    (r"/stream", StreamHandler, {'broadcaster':broadcaster} ),
+                (r"/events", EventsHandler, {'broadcaster':broadcaster} ) ]
+
+#
+# To run the unit tests below, type "python ipmistream.py"
+#
+if __name__ == "__main__":
+
+    import time
+    import asyncio
+    import datetime
+    import tornado.web
+    import tornado.websocket
+    from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+    async def test():
+
+        broadcaster = IpmiBroadcaster( queue_size=50 )
+        app = tornado.web.Application( stream_handlers(broadcaster) )
+        server = app.listen(0, "127.0.0.1")
+        port = list(server._sockets.values())[0].getsockname()[1]
+
+        ws = await tornado.websocket.websocket_connect("ws://127.0.0.1:%d/stream?sensors=18,nvidia-0&rate=10" % port)
+        events = []
+        def on_chunk(chunk): events.append(chunk)
+        sse = AsyncHTTPClient().fetch( HTTPRequest("http://127.0.0.1:%d/events?sensors=19" % port, streaming_callback=on_chunk, request_timeout=5), raise_error=False )
+        while len(broadcaster.clients) < 2:
+            await asyncio.sleep(0.01)
+
+        # a sampling thread publishing 1000 samples/s of three sensors
+        t0 = datetime.datetime.now()
+        def sampler():
+            for i in range(1000):
+                dt = t0 + datetime.timedelta(milliseconds=i)
+                for sensor in ( "18", "19", "nvidia-0" ):
+                    broadcaster.publish( dt, sensor, float(i) )
+        start = time.perf_counter()
+        thread = threading.Thread(target=sampler)
+        thread.start()
+        thread.join()
+        assert time.perf_counter() - start < 1.0
+
+        samples = []
+        while len(samples) < 20:
+            message = json.loads( await ws.read_message() )
+            samples.extend( message["samples"] )
+        # 10 Hz per sensor over one second of samples
+        assert len(samples) == 20 and set( s[1] for s in samples ) == { "18", "nvidia-0" }, samples
+        assert [ s[2] for s in samples if s[1] == "18" ] == [ float(i) for i in range(0, 1000, 100) ]
+
+        await asyncio.sleep(0.2)
+        text = b"".join(events).decode()
+        received = [ json.loads(line[6:]) for line in text.split("\n") if line.startswith("data: ") ]
+        values = [ s[2] for m in received for s in m["samples"] ]
+        # the queue holds 50 samples: the rest are dropped and counted, not queued
+        assert len(values) + sum( m["dropped"] for m in received ) == 1000, (len(values), received[-1]["dropped"])
+        assert values == sorted(values) and all( s[1] == "19" for m in received for s in m["samples"] )
+
+        ws.close()
+        while len(broadcaster.clients) > 1:
+            await asyncio.sleep(0.01)
+        server.stop()
+        await server.close_all_connections()
+        try:
+            await sse
+        except Exception:
+            pass    # the server closed the event stream
+        assert broadcaster.clients == []
+
+    asyncio.run( test() )
+    print("%s: all tests passed" % sys.argv[0])
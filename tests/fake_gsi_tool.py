@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+#
+# A stand-in for "gsi_tool info apu-XX [apu-YY ...]" for testing without APUs.
+# Device apu-NN reports a power of 20.5 + NN.  With FAKE_GSI_TOOL_SINGLE set,
+# only the first device is reported, like a gsi_tool that takes one device.
+#
+
+import os
+import sys
+
+devices = [ a for a in sys.argv[1:] if a.startswith("apu-") ]
+if sys.argv[1:2] != ["info"] or not devices:
+    print("usage: gsi_tool info apu-XX", file=sys.stderr)
+    sys.exit(1)
+if os.environ.get("FAKE_GSI_TOOL_SINGLE"):
+    devices = devices[:1]
+
+for device in devices:
+    print("Device          : %s" % device)
+    print("Temperature (C) : 41.000000")
+    print("Power (V)       : %f" % (20.5 + int(device.split("-")[1])))
+    print("")
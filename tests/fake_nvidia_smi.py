@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+#
+# A stand-in for "nvidia-smi --query-gpu=index,power.draw --format=csv,noheader,nounits --loop-ms=N"
+# for testing without GPUs.  The number of GPUs is taken from FAKE_NVIDIA_SMI_GPUS (default 1).
+#
+
+import os
+import sys
+import time
+import math
+
+loop_ms = None
+for arg in sys.argv[1:]:
+    if arg.startswith("--loop-ms="): loop_ms = int(arg.split("=")[1])
+    elif arg.startswith("-lms="): loop_ms = int(arg.split("=")[1])
+
+gpus = int(os.environ.get("FAKE_NVIDIA_SMI_GPUS", "1"))
+header = "--format=csv" in sys.argv[1:]
+start = time.time()
+
+try:
+    while True:
+        if header: print("index, power.draw [W]")
+        for i in range(gpus):
+            power = 60.0 + 40*i + 20*math.sin(time.time() - start + i)
+            print("%d, %.2f%s" % (i, power, "" if "nounits" in " ".join(sys.argv) else " W"))
+        sys.stdout.flush()
+        if loop_ms is None: break
+        time.sleep(loop_ms/1000.0)
+except (BrokenPipeError, KeyboardInterrupt):
+    pass
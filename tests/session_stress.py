@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# Hammers IpmiSessionManager with session starts and stops while sampler
+# threads ingest at full rate.  Every sensor reads a constant power, so each
+# session's energy must be exactly power x duration.  Run from the top level
+# directory, e.g. "python tests/session_stress.py --duration 10 --sessions 200".
+#
+
+import os
+import sys
+import time
+import random
+import argparse
+import contextlib
+import datetime
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ipmisession import IpmiSessionManager
+
+parser  = argparse.ArgumentParser(description='Session manager stress test.')
+parser.add_argument('--duration',   dest='duration', type=float, default=5.0, help='Seconds to run for')
+parser.add_argument('--samplers',   dest='samplers', type=int, default=4, help='The number of sampler threads')
+parser.add_argument('--sensors',    dest='sensors', type=int, default=8, help='The number of sensors of each sampler')
+parser.add_argument('--clients',    dest='clients', type=int, default=8, help='The number of threads starting and stopping sessions')
+parser.add_argument('--sessions',   dest='sessions', type=int, default=100, help='The number of sessions each client keeps open')
+args    = parser.parse_args()
+
+POWER = 100.0
+manager = IpmiSessionManager()
+done = threading.Event()
+failures = []
+counts = { 'samples': 0, 'stops': 0, 'empty': 0 }
+lock = threading.Lock()
+
+def sampler(n):
+    samples = 0
+    while not done.is_set():
+        dt = datetime.datetime.now()
+        for s in range(args.sensors):
+            manager.sensor( dt, s, POWER, node="node%02d" % n )
+        samples += args.sensors
+    with lock: counts['samples'] += samples
+
+def client(n):
+    rng = random.Random(n)
+    open_sessions = []
+    try:
+        while not done.is_set():
+            if len(open_sessions) < args.sessions:
+                session_id = "c%d-%d" % (n, rng.randrange(1<<30))
+                open_sessions.append( (session_id, datetime.datetime.now()) )
+                manager.start( open_sessions[-1][1], session_id )
+                continue
+            session_id, started = open_sessions.pop( rng.randrange(len(open_sessions)) )
+            time.sleep(0.001)
+            stopped = datetime.datetime.now()
+            stats = manager.stop( stopped, session_id, all_stats=rng.random() < 0.1 )
+            if stats == -1:
+                with lock: counts['empty'] += 1
+                continue
+            # every sensor reads POWER throughout the session
+            tot = stats["tot_power"] if isinstance(stats, dict) else stats
+            expected = POWER * args.samplers * args.sensors * (stopped - started).total_seconds()
+            if abs(tot - expected) > 1e-6 * max(1.0, expected):
+                failures.append( (session_id, tot, expected) )
+            # a second stop of the same session must fail
+            if manager.stop( stopped, session_id ) != -1:
+                failures.append( (session_id, "stopped twice") )
+            with lock: counts['stops'] += 1
+    except:
+        import traceback
+        traceback.print_exc()
+        failures.append( (n, sys.exc_info()[1]) )
+
+# every sensor has a sample before any session starts
+for n in range(args.samplers):
+    for s in range(args.sensors):
+        manager.sensor( datetime.datetime.now(), s, POWER, node="node%02d" % n )
+
+threads = [ threading.Thread(target=sampler, args=(n,)) for n in range(args.samplers) ] + \
+          [ threading.Thread(target=client, args=(n,)) for n in range(args.clients) ]
+# the manager's own messages ( e.g. for the second stops ) are not shown
+with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+    start = time.monotonic()
+    for t in threads: t.start()
+    time.sleep(args.duration)
+    done.set()
+    for t in threads: t.join()
+    elapsed = time.monotonic() - start
+
+    for session_id in list(manager.capture_sessions.keys()):
+        manager.stop( datetime.datetime.now(), session_id )
+print("%s: %.0f samples/s, %.0f session stops/s, %d stops without samples, %d samples left in memory" % \
+        ( sys.argv[0], counts['samples']/elapsed, counts['stops']/elapsed, counts['empty'], manager.buffered() ))
+assert not manager.capture_sessions and not manager.started and not manager.stopping
+assert counts['stops'] > 0 and counts['samples'] > 0
+if failures:
+    print("%s: FAILED:" % sys.argv[0], failures[:10])
+    sys.exit(1)
+print("%s: all tests passed" % sys.argv[0])